@@ -1,22 +1,406 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify
+from itertools import islice
+from typing import Iterable, Iterator, List, Optional, Tuple
+from datetime import datetime, timezone
+import json
 import os
-from utils import LogManager, LOG_DIRECTORY
+import sqlite3
+import time
+import zlib
+from utils import LogManager, LogRecord, LogSummary, LogValidationError, RejectedLines, LOG_DIRECTORY, LOG_LEVELS
+from catalog import CatalogEntry
+from columnar import COLUMNAR_BATCH_SIZE, RecordBatch
+from parse_cache import FileIdentity, ParseCache
+from log_files import FileLock, GroupCommit, append_to_file, remove_lock, write_atomic
+from parallel_parse import merge_summaries, parse_lines, parse_log_files, run_parse, summarize_log_file
+from parse_jobs import JobQueue, job_response
+from log_index import (LineIndexCache, in_time_window, is_marked_ordered, is_ordered, last_timestamp,
+                       mark_ordered, parse_time_bound, read_time_window)
+from metrics import count_bytes_read, count_bytes_written, gauge_lines, register_collector, time_stage
+from live_tail import TailHub
+from rollups import ROLLUP_RESOLUTIONS, Rollups, bucket_range
+from rules import current_rules
+import columnar
+import metrics
+import sidecar
 import logging
 
 app = Flask(__name__)
-log_manager = LogManager(LOG_DIRECTORY)
+# parse worker processes load this module again as __mp_main__ when it is run as a script,
+# only the server process migrates the log directory and syncs the catalog
+log_manager = LogManager(LOG_DIRECTORY) if __name__ != '__mp_main__' else None
+parse_cache = ParseCache()
+line_indexes = LineIndexCache()
+
+# lines are streamed to the client in pieces of roughly this many bytes
+STREAM_CHUNK_SIZE = 64 * 1024
+
+NDJSON_MIMETYPES = ('application/x-ndjson', 'application/ndjson', 'application/jsonl')
+
+# lines validated and aggregated per step, so each stage can be timed separately
+PARSE_BATCH_LINES = 1024
+
+# environment variable for the logs per /logs page or fallback value
+LOGS_PAGE_SIZE = int(os.getenv('LOGS_PAGE_SIZE', 100))
+LOGS_PAGE_MAX = 1000
+
+# environment variables for response compression or fallback values
+COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))
+COMPRESS_LEVEL = int(os.getenv('COMPRESS_LEVEL', 6))
+
+# zlib window bits per content coding, "deflate" is the zlib format
+COMPRESS_ENCODINGS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+
+@app.before_request
+def start_timer():
+    if metrics.METRICS_ENABLED:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request(response):
+    if metrics.METRICS_ENABLED and 'request_start' in g:
+        endpoint = request.url_rule.rule if request.url_rule else 'unmatched'
+        metrics.REQUEST_SECONDS.observe(time.perf_counter() - g.request_start, endpoint)
+        metrics.REQUESTS.inc(1, endpoint, str(response.status_code))
+    return response
+
+
+@app.after_request
+def compress_response(response):
+    """
+    Compress successful responses with the best coding the client accepts.
+    Streamed responses are compressed while they are sent, other responses
+    only once they reach COMPRESS_MIN_SIZE bytes.
+    """
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.mimetype == 'text/event-stream'):
+        # event streams must reach the client event by event, which compression would hold back
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = request.accept_encodings.best_match(list(COMPRESS_ENCODINGS))
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = compress_chunks(response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    elif response.calculate_content_length() >= COMPRESS_MIN_SIZE:
+        compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, COMPRESS_ENCODINGS[encoding])
+        response.set_data(compressor.compress(response.get_data()) + compressor.flush())
+    else:
+        return response
+    response.headers['Content-Encoding'] = encoding
+    return response
+
+
+def compress_chunks(chunks: Iterable[bytes], encoding: str) -> Iterator[bytes]:
+    compressor = zlib.compressobj(COMPRESS_LEVEL, zlib.DEFLATED, COMPRESS_ENCODINGS[encoding])
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def file_etag(identity: FileIdentity, rules: Optional[str] = None) -> str:
+    etag = f"{identity.inode:x}-{identity.size:x}-{identity.mtime_ns:x}"
+    return etag if rules is None else f"{etag}-{rules}"
+
+
+def file_last_modified(identity: FileIdentity) -> datetime:
+    return datetime.fromtimestamp(identity.mtime_ns // 1_000_000_000, timezone.utc)
+
+
+def not_modified(identity: FileIdentity, rules: Optional[str] = None) -> Optional[Response]:
+    """
+    A 304 response when the validators of a conditional request still match
+    the log file, decided from its metadata alone. If-None-Match takes
+    precedence over If-Modified-Since. Responses derived with the
+    classification rules pass their fingerprint, it is part of the ETag and
+    If-Modified-Since is ignored, the file time says nothing about a rules reload.
+    """
+    if request.if_none_match:
+        matched = request.if_none_match.contains_weak(file_etag(identity, rules))
+    elif request.if_modified_since and rules is None:
+        matched = file_last_modified(identity) <= request.if_modified_since
+    else:
+        matched = False
+    return with_validators(Response(status=304), identity, rules) if matched else None
+
+
+def with_validators(response: Response, identity: FileIdentity, rules: Optional[str] = None) -> Response:
+    # weak, the same content is sent compressed or not
+    response.set_etag(file_etag(identity, rules), weak=True)
+    if rules is None:
+        response.last_modified = file_last_modified(identity)
+    return response
+
+
+def parse_cache_metrics() -> Iterator[str]:
+    stats = parse_cache.stats()
+    yield from gauge_lines('log_api_parse_cache_hits_total', 'Parse cache hits.', stats["hits"], 'counter')
+    yield from gauge_lines('log_api_parse_cache_misses_total', 'Parse cache misses.', stats["misses"], 'counter')
+    yield from gauge_lines('log_api_parse_cache_entries', 'Summaries held by the parse cache.', stats["entries"])
+
+
+register_collector(parse_cache_metrics)
+
+
+def non_negative_arg(name: str) -> Optional[int]:
+    """Read an optional non-negative integer query parameter."""
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise ValueError(f"Query parameter '{name}' must be a non-negative integer.")
+    return int(value)
+
+
+def stream_log_content(header: dict, lines: Iterable[bytes]) -> Iterator[str]:
+    """Stream a JSON document with the given header fields and lines (or whole-line pieces) as its content."""
+    yield json.dumps(header)[:-1] + ', "content": "'
+
+    chunk = []
+    chunk_size = 0
+    total_size = 0
+    for line in lines:
+        chunk.append(line)
+        chunk_size += len(line)
+        if chunk_size >= STREAM_CHUNK_SIZE:
+            yield json.dumps(b''.join(chunk).decode('utf-8', errors='replace'))[1:-1]
+            total_size += chunk_size
+            chunk = []
+            chunk_size = 0
+    yield json.dumps(b''.join(chunk).decode('utf-8', errors='replace'))[1:-1] + '"}'
+    count_bytes_read(total_size + chunk_size)
+
+
+def read_text_chunks(filename: str) -> Iterator[bytes]:
+    """A whole log in STREAM_CHUNK_SIZE pieces, newlines translated the same way file.read() does."""
+    with open(filename, 'r') as file:
+        while True:
+            chunk = file.read(STREAM_CHUNK_SIZE)
+            if not chunk:
+                return
+            yield chunk.encode()
+
+
+def summarize_lines(lines: Iterable[str], read_stage: Optional[str] = None) -> LogSummary:
+    """
+    LogSummary.update_lines fed batch by batch, so reading the next batch
+    (timed as read_stage when given), validation and aggregation are timed
+    separately.
+    """
+    if not metrics.METRICS_ENABLED:
+        return LogSummary().update_lines(lines)
+
+    summary = LogSummary()
+    rejected_lines = RejectedLines()
+    lines = iter(lines)
+    # columnar batches are larger, so the NumPy calls per batch pay off
+    batch_lines = COLUMNAR_BATCH_SIZE if columnar.COLUMNAR_AGGREGATION else PARSE_BATCH_LINES
+    durations = {read_stage: 0.0, 'validation': 0.0, 'aggregation': 0.0}
+    while True:
+        start = time.perf_counter()
+        batch = list(islice(lines, batch_lines))
+        if not batch:
+            break
+        durations[read_stage] += time.perf_counter() - start
+        summary.update_lines(batch, rejected_lines, durations)
+
+    rejected_lines.report()
+    for stage, seconds in durations.items():
+        if stage is not None:
+            metrics.STAGE_SECONDS.observe(seconds, stage)
+    return summary
+
+
+def record_ordering(filename: str, timestamps: Iterable[str], append: bool) -> None:
+    """Mark a log as ordered when it is written in timestamp order, and no longer once a write breaks it."""
+    if append:
+        if is_marked_ordered(filename) and not is_ordered(timestamps, last_timestamp(filename)):
+            mark_ordered(filename, False)
+    else:
+        mark_ordered(filename, is_ordered(timestamps))
+
+
+def write_update(id: int, content: str, records: List[LogRecord], append: bool) -> None:
+    """
+    Append to or atomically overwrite a stored log while holding its file
+    lock, then bring the ordering marker, caches, catalog, sidecar and
+    rollups up to date. Appended lines extend the sidecar and rollups,
+    any other write rebuilds them.
+    """
+    filename = log_manager.log_path(id)
+    with FileLock(filename):
+        # removed while waiting for the lock
+        if not os.path.exists(filename):
+            raise FileNotFoundError(filename)
+        previous = FileIdentity.of(filename)
+        # appended lines only extend the cached summary when they start on a line of their own
+        incremental = append and log_manager.ends_with_newline(filename)
+        record_ordering(filename, (record.timestamp for record in records), append)
+
+        with time_stage('file_io'):
+            if append:
+                append_to_file(filename, content)
+            else:
+                write_atomic(filename, content)
+
+        current = FileIdentity.of(filename)
+        if incremental:
+            # appended lines are classified and aggregated once for the cached summary, the sidecar and the rollups
+            batch = RecordBatch.from_records(records, LOG_LEVELS) if columnar.np is not None else None
+            appended = LogSummary()
+            if batch is not None and columnar.COLUMNAR_AGGREGATION:
+                appended.add_batch(batch)
+            else:
+                appended.update(records)
+            parse_cache.append(id, previous, current, appended)
+        else:
+            parse_cache.invalidate(id)
+            line_indexes.invalidate(id)
+        with time_stage('sidecar'):
+            if incremental:
+                sidecar.append(filename, previous, current, batch, appended, len(content.encode()))
+            else:
+                # an append that continued an unterminated last line is rebuilt from the file
+                sidecar.build(filename, None if append else records)
+        update_catalog(id, filename, previous, current, records, append, incremental)
+        with time_stage('rollups'):
+            if incremental:
+                update_rollups(id, filename, previous, current, records, batch)
+            else:
+                build_rollups(id, filename, None if append else records)
+    tail_hub.notify(id)
+
+
+def update_catalog(id: int, filename: str, previous: Optional[FileIdentity], current: Optional[FileIdentity],
+                   records: List[LogRecord], append: bool, incremental: bool) -> None:
+    """Bring the catalog entry of a log up to date after a write, call it while holding the file lock."""
+    path = log_manager.relative_path(filename)
+    if not append:
+        log_manager.catalog.put(CatalogEntry.from_records(id, path, current.size, records))
+        return
+    entry = log_manager.catalog.get(id) if incremental else None
+    if entry is not None and previous is not None and entry.size == previous.size:
+        log_manager.catalog.put(entry.extend(records, current.size)._replace(path=path))
+    else:
+        # not cataloged yet or changed outside the API, read once from the file
+        log_manager.catalog.put(log_manager.catalog_entry(id, filename))
+
+
+def update_rollups(id: int, filename: str, previous: Optional[FileIdentity], current: Optional[FileIdentity],
+                   records: List[LogRecord], batch: Optional[RecordBatch]) -> None:
+    """
+    Add appended records, also given as a columnar batch when NumPy is
+    available, to the rollups of a log; call it while holding the file lock.
+    Rollups that did not match the log before the append are rebuilt instead.
+    """
+    if current is None:
+        return
+    if previous is None or log_manager.catalog.rollup_source(id) != (list(previous), current_rules().fingerprint):
+        # no rollups yet, built with other rules or the log changed outside the API
+        build_rollups(id, filename)
+        return
+    rollups = Rollups().add_batch(batch) if batch is not None else Rollups().update(records)
+    log_manager.catalog.put_rollups(id, rollups, current)
+
+
+def build_rollups(id: int, filename: str, records: Optional[List[LogRecord]] = None) -> None:
+    """
+    Build the rollups of a log, call it while holding the file lock. records
+    are the lines of the whole log when the caller has them, otherwise they
+    come from the sidecar or the file.
+    """
+    identity = FileIdentity.of(filename)
+    if identity is None:
+        return
+    log_sidecar = sidecar.load(filename)
+    if log_sidecar is not None:
+        rollups = log_sidecar.rollups()
+    elif records is not None:
+        rollups = Rollups().update(records)
+    else:
+        rollups = Rollups().update(log_manager.iter_records(log_manager.read_log_lines(filename), RejectedLines()))
+    log_manager.catalog.put_rollups(id, rollups, identity, replace=True)
+
+
+def commit_appends(id: int, appended: List[Tuple[str, List[LogRecord]]]) -> None:
+    """Write all appends queued for one log with a single write."""
+    write_update(id, ''.join(content for content, _ in appended),
+                 [record for _, records in appended for record in records], append=True)
+
+
+appends = GroupCommit(commit_appends)
+
+
+def append_metrics() -> Iterator[str]:
+    stats = appends.stats()
+    yield from gauge_lines('log_api_append_commits_total', 'Group commits of appended lines.', stats["commits"], 'counter')
+    yield from gauge_lines('log_api_appends_total', 'Append requests written by group commits.', stats["items"], 'counter')
+
+
+register_collector(append_metrics)
 
 
 @app.route('/get_log/<int:id>', methods=['GET'])
 def get_log(id: int):
-    filename = f"{LOG_DIRECTORY}/log_{id}.log"
-    if os.path.exists(filename):
-        with open(filename, 'r') as file:
-            content = file.read()
+    filename = log_manager.log_path(id)
+    identity = FileIdentity.of(filename)
+    if identity is None:
+        logging.error(f"Log file with id {id} not found.")
+        return jsonify({"error": "Log file not found."}), 404
+
+    try:
+        offset = non_negative_arg('offset')
+        limit = non_negative_arg('limit')
+        tail = non_negative_arg('tail')
+        start_time = parse_time_bound(request.args.get('from'))
+        end_time = parse_time_bound(request.args.get('to'))
+    except ValueError as e:
+        logging.error(str(e))
+        return jsonify({"error": str(e)}), 400
+
+    line_range = offset is not None or limit is not None or tail is not None
+    time_window = start_time is not None or end_time is not None
+
+    if line_range and time_window:
+        logging.error("Line range and time window parameters combined.")
+        return jsonify({"error": "Line range and time window parameters cannot be combined."}), 400
+
+    unchanged = not_modified(identity)
+    if unchanged is not None:
+        logging.info(f"Log file with id {id} not modified.")
+        return unchanged
+
+    if time_window:
+        logging.info(f"Retrieved lines from {start_time} to {end_time} of log file with id {id}.")
+        header = {"id": id, "from": start_time, "to": end_time}
+        content = read_time_window(filename, start_time, end_time)
+    elif not line_range:
         logging.info(f"Retrieved log file with id {id}.")
-        return jsonify({"id": id, "content": content}), 200
-    logging.error(f"Log file with id {id} not found.")
-    return jsonify({"error": "Log file not found."}), 404
+        header = {"id": id}
+        content = read_text_chunks(filename)
+    else:
+        # ranged reads seek straight to the first requested line through the line index
+        index = line_indexes.get(id, filename)
+        total = index.line_count
+        if tail is not None:
+            start = max(total - tail, 0)
+            count = total - start
+        else:
+            start = min(offset or 0, total)
+            count = total - start if limit is None else min(limit, total - start)
+
+        logging.info(f"Retrieved lines {start}-{start + count} of log file with id {id}.")
+        header = {"id": id, "offset": start, "lines": count, "total_lines": total}
+        content = index.read_lines(start, count)
+
+    response = Response(stream_log_content(header, content), status=200, mimetype='application/json')
+    return with_validators(response, identity)
 
 
 @app.route('/save_log', methods=['POST'])
@@ -26,28 +410,98 @@ def save_log():
         logging.error("No request body provided.")
         return jsonify({"error": "No request body provided."}), 400
 
-    lines = log_manager.request_body_formatting(data['content']).split('\n')
-    valid_lines = [line for line in lines if log_manager.validate_log_entry(line)]
+    with time_stage('request_body_formatting'):
+        lines = log_manager.request_body_formatting(data['content']).split('\n')
+    with time_stage('validation'):
+        records = log_manager.tokenize_lines(lines)
 
-    if not valid_lines:
+    if not records:
         logging.error("No valid log file entries provided.")
         return jsonify({"error": "No valid log file entries provided."}), 400
 
-    new_id = log_manager.get_next_id()
-    filename = f"{LOG_DIRECTORY}/log_{new_id}.log"
-
-    # check if filename already exists (to avoid overwriting)
-    if os.path.exists(filename):
-        new_id = log_manager.get_highest_log_id()
-        filename = f"{LOG_DIRECTORY}/log_{new_id}.log"
+    # the allocator reserves the file, so concurrent saves never share an ID
+    new_id = log_manager.allocate_id()
+    filename = log_manager.log_path(new_id)
 
-    with open(filename, 'w') as file:
-        file.write('\n'.join(valid_lines) + '\n')
+    content = '\n'.join(record.line for record in records) + '\n'
+    try:
+        with time_stage('file_io'):
+            with open(filename, 'w') as file:
+                file.write(content)
+    except OSError as e:
+        # give the reserved file up, it would otherwise stay behind as an empty log
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        logging.error(f"Could not write log file log_{new_id}.log: {str(e)}")
+        return jsonify({"error": "Log file could not be saved."}), 500
+    count_bytes_written(len(content))
+    record_ordering(filename, (record.timestamp for record in records), append=False)
+    log_manager.catalog.put(CatalogEntry.from_records(new_id, log_manager.relative_path(filename),
+                                                      len(content.encode()), records))
+    with FileLock(filename):
+        with time_stage('sidecar'):
+            sidecar.build(filename, records)
+        with time_stage('rollups'):
+            build_rollups(new_id, filename, records)
 
     logging.info(f"Log file saved successfully! Filename log_{new_id}.log")
     return jsonify({"message": f"Log file saved successfully! Filename log_{new_id}.log", "id": new_id}), 200
 
 
+@app.route('/bulk_save_log', methods=['POST'])
+def bulk_save_log():
+    """
+    Save many logs in one request. An NDJSON body holds one {"content": ...}
+    object per new log file, any other body is read as plain log lines that
+    are split into files of lines_per_file lines (one file when unset).
+    The body is read as a stream and written out while it arrives.
+    """
+    try:
+        lines_per_file = non_negative_arg('lines_per_file') or 0
+    except ValueError as e:
+        logging.error(str(e))
+        return jsonify({"error": str(e)}), 400
+
+    files = []
+    invalid_records = 0
+    rejected_lines = RejectedLines()
+    lines = log_manager.read_stream_lines(request.stream)
+
+    if request.mimetype in NDJSON_MIMETYPES:
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                content = json.loads(line)['content']
+                body_lines = log_manager.request_body_formatting(content).split('\n')
+            except (ValueError, KeyError, TypeError, AttributeError):
+                invalid_records += 1
+                continue
+            files.append(log_manager.create_log_writer(rejected_lines).write_lines(body_lines).close())
+    else:
+        writer = log_manager.create_log_writer(rejected_lines)
+        for line in lines:
+            writer.write_line(line)
+            if lines_per_file and writer.lines >= lines_per_file:
+                files.append(writer.close())
+                writer = log_manager.create_log_writer(rejected_lines)
+        files.append(writer.close())
+    rejected_lines.report()
+
+    saved = [file for file in files if file["id"] is not None]
+    rejected = sum(file["rejected"] for file in files)
+
+    if not saved:
+        logging.error("No valid log file entries provided.")
+        return jsonify({"error": "No valid log file entries provided.", "rejected": rejected,
+                        "invalid_records": invalid_records}), 400
+
+    logging.info(f"Bulk saved {len(saved)} log files.")
+    return jsonify({"files": saved, "rejected": rejected, "invalid_records": invalid_records}), 200
+
+
 @app.route('/update_log/<int:id>', methods=['PUT'])
 def update_log(id: int):
     data = request.json
@@ -55,32 +509,58 @@ def update_log(id: int):
         logging.error("No request body provided. Nothing to update.")
         return jsonify({"error": "No request body provided."}), 400
 
-    filename = f"{LOG_DIRECTORY}/log_{id}.log"
+    filename = log_manager.log_path(id)
     if not os.path.exists(filename):
         logging.error(f"Log file not found. Filename log_{id}.log")
         return jsonify({"error": "Log file not found."}), 404
 
-    lines = log_manager.request_body_formatting(data['content']).split('\n')
-    valid_lines = [line for line in lines if log_manager.validate_log_entry(line)]
+    with time_stage('request_body_formatting'):
+        lines = log_manager.request_body_formatting(data['content']).split('\n')
+    with time_stage('validation'):
+        records = log_manager.tokenize_lines(lines)
 
-    if not valid_lines:
+    if not records:
         logging.error("No valid log file entries provided.")
         return jsonify({"error": "No valid log file entries provided."}), 400
 
     append = request.args.get('append', 'false').lower() == 'true'
-    mode = 'a' if append else 'w'
+    content = '\n'.join(record.line for record in records) + '\n'
+    try:
+        if append:
+            # concurrent appends to this log are written together by one of the requests
+            appends.submit(id, (content, records))
+        else:
+            write_update(id, content, records, append=False)
+    except FileNotFoundError:
+        logging.error(f"Log file not found. Filename log_{id}.log")
+        return jsonify({"error": "Log file not found."}), 404
+    count_bytes_written(len(content))
 
-    with open(filename, mode) as file:
-        file.write('\n'.join(valid_lines) + '\n')
     logging.info(f"Log file log_{id}.log updated successfully!")
     return jsonify({"message": f"Log file log_{id}.log updated successfully!"}), 200
 
 
 @app.route('/delete_log/<int:id>', methods=['DELETE'])
 def delete_log(id: int):
-    filename = f"{LOG_DIRECTORY}/log_{id}.log"
-    if os.path.exists(filename):
-        os.remove(filename)
+    filename = log_manager.log_path(id)
+    deleted = False
+    try:
+        with FileLock(filename):
+            # a concurrent delete may have won the lock first
+            deleted = os.path.exists(filename)
+            if deleted:
+                os.remove(filename)
+                mark_ordered(filename, False)
+                sidecar.remove(filename)
+                parse_cache.invalidate(id)
+                line_indexes.invalidate(id)
+                log_manager.catalog.remove(id)
+    except FileNotFoundError:
+        pass
+    if deleted:
+        # only once released, see remove_lock
+        remove_lock(filename)
+        tail_hub.notify(id)
         logging.info(f"Log file log_{id}.log deleted.")
         return jsonify({"message": f"Log file log_{id}.log deleted."}), 200
     logging.error(f"Specified log file not found. Filename log_{id}.log")
@@ -88,33 +568,352 @@ def delete_log(id: int):
 
 
 @app.route('/parse_log', methods=['POST'])
-@app.route('/parse_log/<int:log_id>', methods=['POST'])
+@app.route('/parse_log/<int:log_id>', methods=['GET', 'POST'])
 def parse_log(log_id=None):
+    try:
+        start_time = parse_time_bound(request.args.get('from'))
+        end_time = parse_time_bound(request.args.get('to'))
+    except ValueError as e:
+        logging.error(str(e))
+        return jsonify({"error": str(e)}), 400
+    time_window = start_time is not None or end_time is not None
+
+    identity = None
     if log_id is not None:
-        filename = f"{LOG_DIRECTORY}/log_{log_id}.log"
-        if not os.path.exists(filename):
+        filename = log_manager.log_path(log_id)
+        identity = FileIdentity.of(filename)
+        if identity is None:
             logging.error(f"Log file not found. Filename log_{log_id}.log")
             return jsonify({"error": "Log file not found."}), 404
-        with open(filename, 'r') as file:
-            content = file.read()
+        # the summary only depends on the stored file and the rules, so a client that has it skips the parse,
+        # 304 only answers GET and HEAD
+        rules = current_rules().fingerprint
+        unchanged = not_modified(identity, rules) if request.method == 'GET' else None
+        if unchanged is not None:
+            logging.info(f"Log file with id {log_id} not modified.")
+            return unchanged
+        if time_window:
+            # window summaries are not cached, the sidecar records are filtered instead
+            with time_stage('sidecar'):
+                log_sidecar = sidecar.load(filename)
+                summary = log_sidecar.summary(start_time, end_time) if log_sidecar is not None else None
+            if summary is None:
+                # only the byte range of the window is read
+                lines = (line.decode('utf-8', errors='replace').rstrip('\r\n')
+                         for line in read_time_window(filename, start_time, end_time)
+                         if in_time_window(line[1:20].decode('utf-8', errors='replace'), start_time, end_time))
+                summary = summarize_lines(lines, read_stage='file_io')
+        else:
+            summary = stored_summary(log_id, filename, identity)
     else:
         data = request.json
         if not data or 'content' not in data:
             logging.error("Invalid request to parse log-type content.")
             return jsonify({"error": "Invalid request."}), 400
-        content = data['content']
+        with time_stage('request_body_formatting'):
+            lines = log_manager.request_body_formatting(data['content']).split('\n')
+        if time_window:
+            lines = [line for line in lines if in_time_window(line[1:20], start_time, end_time)]
+        summary = summarize_lines(lines)
 
-    lines = log_manager.request_body_formatting(content).split('\n')
-    valid_lines = [line for line in lines if log_manager.validate_log_entry(line)]
-
-    if not valid_lines:
+    if not summary.line_count:
         logging.error("No valid log file entries provided.")
         return jsonify({"error": "No valid log file entries provided."}), 400
 
-    results = log_manager.parse_log_content(valid_lines)
+    percentiles = request.args.get('percentiles', 'false').lower() == 'true'
+    with time_stage('serialization'):
+        response = jsonify(summary.to_dict(percentiles))
     logging.info("Log parsed successfully")
+    if identity is not None:
+        response = with_validators(response, identity, rules)
+    return response, 200
+
+
+def stored_summary(log_id: int, filename: str, identity: FileIdentity) -> LogSummary:
+    """Summary of a whole stored log from the parse cache, its sidecar or the text, in that order."""
+    summary = parse_cache.get(log_id, identity)
+    if summary is None:
+        with time_stage('sidecar'):
+            log_sidecar = sidecar.load(filename)
+            summary = log_sidecar.summary() if log_sidecar is not None else None
+        if summary is None:
+            # stored logs are streamed line by line, so memory stays flat regardless of file size
+            summary = summarize_lines(log_manager.read_log_lines(filename), read_stage='file_io')
+        parse_cache.put(log_id, identity, summary)
+    return summary
+
+
+def tail_snapshot(log_id: int, filename: str) -> Optional[Tuple[FileIdentity, LogSummary]]:
+    # under the file lock, so the summary covers exactly the bytes of identity
+    try:
+        with FileLock(filename):
+            identity = FileIdentity.of(filename)
+            if identity is None:
+                return None
+            return identity, stored_summary(log_id, filename, identity)
+    except FileNotFoundError:
+        return None
+
+
+tail_hub = TailHub(tail_snapshot)
+
+
+def tail_metrics() -> Iterator[str]:
+    yield from gauge_lines('log_api_tail_subscribers', 'Live tail subscribers.', tail_hub.subscriber_count())
+
+
+register_collector(tail_metrics)
+
+
+@app.route('/tail_log/<int:id>', methods=['GET'])
+def tail_log(id: int):
+    """
+    Server-Sent Events stream of the lines appended to a stored log and of
+    the updated parse statistics, see live_tail for the events.
+    """
+    filename = log_manager.log_path(id)
+    if not os.path.exists(filename):
+        logging.error(f"Log file with id {id} not found.")
+        return jsonify({"error": "Log file not found."}), 404
+
+    logging.info(f"Live tail of log file with id {id} started.")
+    events = tail_hub.subscribe(id, filename, request.headers.get('Last-Event-ID'))
+    return Response(events, status=200, mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@app.route('/logs', methods=['GET'])
+def list_logs():
+    """
+    Page through the stored logs in id order, answered from the catalog
+    alone. The next page starts after the id returned as "next".
+    """
+    try:
+        limit = non_negative_arg('limit')
+        after = non_negative_arg('after')
+    except ValueError as e:
+        logging.error(str(e))
+        return jsonify({"error": str(e)}), 400
+    limit = min(limit, LOGS_PAGE_MAX) if limit else LOGS_PAGE_SIZE
+
+    try:
+        # one more than asked for tells whether there is a next page
+        entries = log_manager.catalog.page(after, limit + 1)
+    except sqlite3.Error as e:
+        logging.error(f"Could not read log catalog: {str(e)}")
+        return jsonify({"error": "Log catalog unavailable."}), 503
+
+    page = entries[:limit]
+    return jsonify({
+        "logs": [entry.to_dict() for entry in page],
+        "next": page[-1].id if len(entries) > limit else None
+    }), 200
+
+
+job_queue = JobQueue(os.path.join(LOG_DIRECTORY, '.jobs'))
+
+
+def job_metrics() -> Iterator[str]:
+    stats = job_queue.stats()
+    yield from gauge_lines('log_api_parse_jobs_active', 'Parse jobs queued or running.', stats["active"])
+    yield from gauge_lines('log_api_parse_jobs_submitted_total', 'Parse jobs accepted.', stats["submitted"], 'counter')
+    yield from gauge_lines('log_api_parse_jobs_rejected_total', 'Parse jobs refused with 429.', stats["rejected"],
+                           'counter')
+
+
+register_collector(job_metrics)
+
+
+def run_parse_job(log_id: Optional[int], content: Optional[str], percentiles: bool) -> dict:
+    """Body of a parse job, the heavy part runs in the parse worker processes when there are several."""
+    if log_id is not None:
+        filename = log_manager.log_path(log_id)
+        identity = FileIdentity.of(filename)
+        if identity is None:
+            raise FileNotFoundError("Log file not found.")
+        summary = parse_cache.get(log_id, identity)
+        if summary is None:
+            try:
+                summary = run_parse(summarize_log_file, filename)
+            except FileNotFoundError:
+                # deleted after the job was queued, other errors are recorded as they are
+                raise FileNotFoundError("Log file not found.") from None
+            parse_cache.put(log_id, identity, summary)
+    else:
+        summary = run_parse(parse_lines, log_manager.request_body_formatting(content).split('\n'))
+
+    if not summary.line_count:
+        raise LogValidationError("No valid log file entries provided.")
+    return summary.to_dict(percentiles)
+
+
+@app.route('/parse_jobs', methods=['POST'])
+def submit_parse_job():
+    """
+    Queue a parse of inline content ({"content": ...}) or of a stored log
+    ({"id": 1}) and return its job id at once, 429 when the queue is full.
+    """
+    data = request.json
+    log_id = data.get('id') if isinstance(data, dict) else None
+    content = data.get('content') if isinstance(data, dict) else None
+    if (log_id is None) == (content is None) or (log_id is not None and not isinstance(log_id, int)):
+        logging.error("Invalid request to submit a parse job.")
+        return jsonify({"error": "Provide either content or the id of a stored log."}), 400
+    if log_id is not None and FileIdentity.of(log_manager.log_path(log_id)) is None:
+        logging.error(f"Log file not found. Filename log_{log_id}.log")
+        return jsonify({"error": "Log file not found."}), 404
+
+    percentiles = request.args.get('percentiles', 'false').lower() == 'true'
+    job = job_queue.submit(lambda: run_parse_job(log_id, content, percentiles))
+    if job is None:
+        logging.error("Parse job queue is full.")
+        response = jsonify({"error": "Too many parse jobs, retry later."})
+        response.headers['Retry-After'] = '1'
+        return response, 429
+
+    logging.info(f"Parse job {job['job_id']} queued.")
+    response = jsonify(job_response(job))
+    response.headers['Location'] = f"/parse_jobs/{job['job_id']}"
+    return response, 202
+
+
+@app.route('/parse_jobs/<job_id>', methods=['GET'])
+def get_parse_job(job_id: str):
+    """Poll a parse job: 202 while it is queued or running, 200 once it finished."""
+    job = job_queue.get(job_id)
+    if job is None:
+        logging.error(f"Parse job {job_id} not found.")
+        return jsonify({"error": "Parse job not found or expired."}), 404
+    finished = job["status"] in ('done', 'failed')
+    return jsonify(job_response(job)), 200 if finished else 202
+
+
+@app.route('/rollups/<int:id>', methods=['GET'])
+def get_rollups(id: int):
+    """
+    Time series of a stored log at the resolution given as minute, hour or
+    day, read from its rollups only. from and to select the buckets that
+    overlap a time window.
+    """
+    resolution = request.args.get('resolution', 'hour')
+    if resolution not in ROLLUP_RESOLUTIONS:
+        logging.error(f"Invalid rollup resolution '{resolution}'.")
+        return jsonify({"error": f"Resolution must be one of {', '.join(ROLLUP_RESOLUTIONS)}."}), 400
+    try:
+        start_time = parse_time_bound(request.args.get('from'))
+        end_time = parse_time_bound(request.args.get('to'))
+    except ValueError as e:
+        logging.error(str(e))
+        return jsonify({"error": str(e)}), 400
+
+    filename = log_manager.log_path(id)
+    identity = FileIdentity.of(filename)
+    if identity is None:
+        logging.error(f"Log file not found. Filename log_{id}.log")
+        return jsonify({"error": "Log file not found."}), 404
+    rules = current_rules().fingerprint
+    unchanged = not_modified(identity, rules)
+    if unchanged is not None:
+        logging.info(f"Log file with id {id} not modified.")
+        return unchanged
+
+    if log_manager.catalog.rollup_source(id) != (list(identity), rules):
+        # saved by /bulk_save_log, changed outside the API or the rules changed since
+        try:
+            with FileLock(filename), time_stage('rollups'):
+                build_rollups(id, filename)
+                identity = FileIdentity.of(filename) or identity
+        except FileNotFoundError:
+            logging.error(f"Log file not found. Filename log_{id}.log")
+            return jsonify({"error": "Log file not found."}), 404
+    try:
+        buckets = log_manager.catalog.rollups(id, resolution, *bucket_range(resolution, start_time, end_time))
+    except sqlite3.Error as e:
+        logging.error(f"Could not read log catalog: {str(e)}")
+        return jsonify({"error": "Log catalog unavailable."}), 503
+
+    logging.info(f"Retrieved {len(buckets)} {resolution} rollups of log file with id {id}.")
+    response = jsonify({"id": id, "resolution": resolution,
+                        "buckets": [bucket.to_dict(name) for name, bucket in buckets]})
+    return with_validators(response, identity, rules), 200
+
+
+@app.route('/parse_logs', methods=['POST'])
+def parse_logs():
+    """
+    Parse several stored logs into one combined summary. The body selects
+    the logs with {"ids": [1, 2]}, {"ids": "all"} or {"from_id": 1, "to_id": 10}.
+    Uncached files are parsed in parallel by the worker process pool.
+    """
+    data = request.json
+    if not data:
+        logging.error("Invalid request to parse multiple logs.")
+        return jsonify({"error": "Invalid request."}), 400
+
+    ids = data.get('ids')
+    if ids == 'all':
+        log_ids = log_manager.list_log_ids()
+    elif isinstance(ids, list) and all(isinstance(log_id, int) for log_id in ids):
+        log_ids = list(dict.fromkeys(ids))
+    elif isinstance(data.get('from_id'), int) and isinstance(data.get('to_id'), int):
+        log_ids = [log_id for log_id in log_manager.list_log_ids() if data['from_id'] <= log_id <= data['to_id']]
+    else:
+        logging.error("Invalid log selection to parse.")
+        return jsonify({"error": "Provide ids as a list or \"all\", or from_id and to_id."}), 400
+
+    partials = {}
+    errors = {}
+    pending = []
+    for log_id in log_ids:
+        filename = log_manager.log_path(log_id)
+        identity = FileIdentity.of(filename)
+        if identity is None:
+            errors[str(log_id)] = "Log file not found."
+            continue
+        summary = parse_cache.get(log_id, identity)
+        if summary is None:
+            pending.append((log_id, filename, identity))
+        else:
+            partials[log_id] = summary
+
+    results = parse_log_files([filename for _, filename, _ in pending])
+    for (log_id, _, identity), (summary, error) in zip(pending, results):
+        if error is not None:
+            errors[str(log_id)] = error
+        else:
+            parse_cache.put(log_id, identity, summary)
+            partials[log_id] = summary
+
+    parsed = [log_id for log_id in log_ids if log_id in partials]
+    percentiles = request.args.get('percentiles', 'false').lower() == 'true'
+    results = merge_summaries([partials[log_id] for log_id in parsed]).to_dict(percentiles)
+    results["parsed"] = parsed
+    results["errors"] = errors
+    logging.info(f"Parsed {len(parsed)} log files, {len(errors)} failed.")
     return jsonify(results), 200
 
 
+@app.route('/cache_stats', methods=['GET'])
+def cache_stats():
+    return jsonify(parse_cache.stats()), 200
+
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Prometheus text exposition of latency histograms and counters."""
+    if not metrics.METRICS_ENABLED:
+        return jsonify({"error": "Metrics are disabled."}), 404
+    return Response(metrics.expose(), status=200, mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/health', methods=['GET'])
+def health():
+    """Readiness check used by load balancers and the server launcher."""
+    if os.path.isdir(LOG_DIRECTORY) and os.access(LOG_DIRECTORY, os.W_OK):
+        return jsonify({"status": "ok", "pid": os.getpid()}), 200
+    logging.error("Health check failed, log directory is not writable.")
+    return jsonify({"status": "unavailable", "error": "Log directory is not writable."}), 503
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,104 @@
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+# environment variables for application logging or fallback values
+APP_LOG_FILE = os.getenv('APP_LOG_FILE', 'app.log')
+APP_LOG_LEVEL = os.getenv('APP_LOG_LEVEL', 'INFO')
+# records waiting for the writer thread, further records are dropped
+APP_LOG_QUEUE_SIZE = int(os.getenv('APP_LOG_QUEUE_SIZE', 10000))
+# records accepted per second, 0 disables the limit
+APP_LOG_RATE_LIMIT = int(os.getenv('APP_LOG_RATE_LIMIT', 1000))
+
+LOG_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+
+class BoundedQueueHandler(QueueHandler):
+    """Queue records for a background writer, dropping them instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Let at most `rate` records through per second. The number of suppressed
+    records is appended to the next record that gets through.
+    """
+
+    def __init__(self, rate: int):
+        super().__init__()
+        self.rate = rate
+        self.suppressed = 0
+        self._window = 0
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if self.rate <= 0:
+            return True
+        with self._lock:
+            window = int(time.monotonic())
+            if window != self._window:
+                self._window = window
+                self._count = 0
+            self._count += 1
+            if self._count > self.rate:
+                self.suppressed += 1
+                return False
+            if self.suppressed:
+                record.msg = f"{record.getMessage()} ({self.suppressed} log records suppressed)"
+                record.args = None
+                self.suppressed = 0
+        return True
+
+
+def configure_logging(logger: Optional[logging.Logger] = None, filename: str = APP_LOG_FILE,
+                      level: str = APP_LOG_LEVEL, queue_size: int = APP_LOG_QUEUE_SIZE,
+                      rate_limit: int = APP_LOG_RATE_LIMIT, force: bool = False) -> Optional[QueueListener]:
+    """
+    Send application logs through a bounded queue to a background thread
+    that writes the log file, so request handlers never wait on disk.
+    Like logging.basicConfig, nothing is changed when the logger already
+    has handlers unless force is set.
+    """
+    logger = logger or logging.getLogger()
+    if logger.handlers and not force:
+        return None
+
+    file_handler = logging.FileHandler(filename)
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+
+    log_queue = queue.Queue(maxsize=queue_size)
+    queue_handler = BoundedQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(rate_limit))
+    logger.addHandler(queue_handler)
+    logger.setLevel(level)
+
+    listener = QueueListener(log_queue, file_handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(stop_listener, listener)
+    return listener
+
+
+def stop_listener(listener: QueueListener) -> None:
+    """Flush the queued records on exit, the writer thread is a daemon so a full queue is simply left behind."""
+    if listener._thread is None:
+        # already stopped
+        return
+    try:
+        listener.stop()
+    except queue.Full:
+        pass
@@ -0,0 +1,101 @@
+"""
+Compare request throughput of the Flask development server (app.run, as
+used by app.py and flask_service.py) with the gunicorn launcher in serve.py.
+Both servers run against a temporary LOG_DIRECTORY.
+
+Usage: python bench_server.py [--requests 2000] [--clients 16] [--workers 4] [--threads 4]
+"""
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+PARSE_BODY = json.dumps({"content": "\n".join(
+    f"[2024-07-19 10:00:{i % 60:02d}] MEASUREMENT: o2 concentration - {20 + i % 5}" for i in range(200))})
+
+
+def wait_until_ready(port: int, timeout: float = 30.0) -> None:
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/health')
+            if connection.getresponse().status == 200:
+                return
+        except OSError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"Server on port {port} did not become ready.")
+
+
+def run_client(port: int, count: int) -> int:
+    """Send count parse requests over one keep-alive connection, return the number of 200 responses."""
+    ok = 0
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    for _ in range(count):
+        connection.request('POST', '/parse_log', body=PARSE_BODY, headers={'Content-Type': 'application/json'})
+        response = connection.getresponse()
+        response.read()
+        if response.status == 200:
+            ok += 1
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+    connection.close()
+    return ok
+
+
+def measure(port: int, requests: int, clients: int) -> float:
+    per_client = requests // clients
+    with ProcessPoolExecutor(max_workers=clients) as executor:
+        start = time.perf_counter()
+        ok = sum(executor.map(run_client, [port] * clients, [per_client] * clients))
+        elapsed = time.perf_counter() - start
+    return ok / elapsed
+
+
+def start_server(command: list, port: int, log_directory: str) -> subprocess.Popen:
+    env = dict(os.environ, LOG_DIRECTORY=log_directory)
+    process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                               cwd=os.path.dirname(os.path.abspath(__file__)))
+    wait_until_ready(port)
+    return process
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    servers = {
+        "dev server": (lambda port: [sys.executable, '-c',
+                                     f"from app import app; app.run(port={port}, threaded=True)"], 5101),
+        "gunicorn": (lambda port: [sys.executable, 'serve.py', '--bind', f'127.0.0.1:{port}',
+                                   '--workers', str(args.workers), '--threads', str(args.threads)], 5102),
+    }
+
+    results = {}
+    with tempfile.TemporaryDirectory() as log_directory:
+        for name, (command, port) in servers.items():
+            process = start_server(command(port), port, log_directory)
+            try:
+                results[name] = measure(port, args.requests, args.clients)
+            finally:
+                process.terminate()
+                process.wait()
+
+    for name, throughput in results.items():
+        print(f"{name:<11} {throughput:8.1f} req/s")
+    print(f"speedup     {results['gunicorn'] / results['dev server']:8.1f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,240 @@
+"""
+Benchmark suite for LogManager and the Flask endpoints.
+
+Synthetic logs are generated with a configurable level mix, MEASUREMENT
+concentration lines, alarm WARNINGs and invalid lines. Every benchmark is
+timed for each requested size, results are written as JSON and compared
+against a stored baseline; a slowdown beyond --threshold fails the run.
+
+Usage:
+    python benchmark.py [--sizes 1000 10000 100000] [--repeat 3]
+                        [--output bench_results.json] [--baseline bench_baseline.json]
+                        [--threshold 0.25] [--update-baseline]
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from typing import Callable, Dict, Iterator, List
+
+DEFAULT_LEVEL_MIX = {'INFO': 0.4, 'DEBUG': 0.15, 'ERROR': 0.05, 'MEASUREMENT': 0.3, 'WARNING': 0.1}
+GASES = ['o2', 'co2', 'co', 'ch4', 'h2s']
+BASELINE_FILE = 'bench_baseline.json'
+
+
+def parse_level_mix(value: str) -> Dict[str, float]:
+    """Parse "INFO=0.4,MEASUREMENT=0.3,..." into level weights."""
+    mix = {}
+    for part in value.split(','):
+        level, weight = part.split('=')
+        mix[level.strip().upper()] = float(weight)
+    return mix
+
+
+def generate_lines(count: int, level_mix: Dict[str, float] = None, invalid_ratio: float = 0.02,
+                   alarm_ratio: float = 0.5, seed: int = 0) -> Iterator[str]:
+    """
+    Yield count synthetic log lines with ordered timestamps. alarm_ratio is
+    the share of WARNING lines that report an alarm.
+    """
+    rng = random.Random(seed)
+    level_mix = level_mix or DEFAULT_LEVEL_MIX
+    levels = list(level_mix)
+    weights = [level_mix[level] for level in levels]
+    start = datetime(2024, 7, 19)
+
+    for i in range(count):
+        if rng.random() < invalid_ratio:
+            yield rng.choice(["garbage line", "[2024-07-19 25:00:00] INFO: Bad hour", "[2024-07-19 10:00:00] TRACE: x"])
+            continue
+        timestamp = (start + timedelta(seconds=i)).strftime('%Y-%m-%d %H:%M:%S')
+        level = rng.choices(levels, weights)[0]
+        if level == 'MEASUREMENT':
+            message = f"{rng.choice(GASES)} concentration - {rng.uniform(0, 500):.2f}"
+        elif level == 'WARNING':
+            message = "Going to o2 alarm" if rng.random() < alarm_ratio else "Sensor drift detected"
+        elif level == 'ERROR':
+            message = "Failed to connect"
+        else:
+            message = f"Sensor check {i} completed"
+        yield f"[{timestamp}] {level}: {message}"
+
+
+def legacy_validate_log_entry(entry: str) -> bool:
+    """The split + strptime validation used before the single-pass tokenizer."""
+    try:
+        timestamp, rest = entry.split('] ', 1)
+        datetime.strptime(timestamp[1:], '%Y-%m-%d %H:%M:%S')
+        level, message = rest.split(': ', 1)
+        return level in ['INFO', 'ERROR', 'MEASUREMENT', 'WARNING', 'DEBUG']
+    except ValueError:
+        return False
+
+
+def legacy_parse(lines: List[str]) -> int:
+    """The list-based aggregation used before running statistics."""
+    valid_lines = [line for line in lines if legacy_validate_log_entry(line)]
+    log_counts = {'ERROR': 0, 'INFO': 0, 'MEASUREMENT': 0, 'WARNING': 0, 'DEBUG': 0}
+    measurements = {}
+    alarms = []
+    for line in valid_lines:
+        timestamp, rest = line.split('] ', 1)
+        log_level, message = rest.split(': ', 1)
+        log_counts[log_level] += 1
+        if log_level == 'MEASUREMENT' and 'concentration' in message:
+            parts = message.split('concentration')
+            try:
+                measurements.setdefault(parts[0].strip(), []).append(float(parts[1].split('-')[-1].strip()))
+            except ValueError:
+                pass
+        elif log_level == 'WARNING' and 'alarm' in message.lower():
+            alarms.append(timestamp[1:])
+    for values in measurements.values():
+        sum(values), max(values), min(values)
+    return len(valid_lines)
+
+
+def best_time(function: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def benchmark_log_manager(lines: List[str], repeat: int) -> Dict[str, float]:
+    from utils import LogManager
+
+    content = '\n'.join(lines)
+    valid_lines = [line for line in lines if LogManager.tokenize_log_entry(line) is not None]
+    return {
+        "request_body_formatting": best_time(lambda: LogManager.request_body_formatting(content), repeat),
+        "validate_log_entry": best_time(lambda: [LogManager.validate_log_entry(line) for line in lines], repeat),
+        "tokenize_lines": best_time(lambda: LogManager.tokenize_lines(lines), repeat),
+        "parse_log_content": best_time(lambda: LogManager.parse_log_content(valid_lines), repeat),
+        "legacy_parse": best_time(lambda: legacy_parse(lines), repeat),
+    }
+
+
+def benchmark_endpoints(lines: List[str], repeat: int) -> Dict[str, float]:
+    from app import app, parse_cache
+
+    client = app.test_client()
+    content = '\n'.join(lines)
+    append_content = '\n'.join(lines[:max(len(lines) // 100, 1)])
+
+    def post(url: str, **kwargs):
+        response = client.post(url, **kwargs)
+        assert response.status_code == 200, (url, response.status_code)
+        return response
+
+    log_id = post('/save_log', json={'content': content}).json['id']
+    results = {
+        "save_log": best_time(lambda: post('/save_log', json={'content': content}), repeat),
+        "get_log": best_time(lambda: client.get(f'/get_log/{log_id}').data, repeat),
+        "get_log_tail": best_time(lambda: client.get(f'/get_log/{log_id}?tail=100').data, repeat),
+        "parse_log": best_time(lambda: post('/parse_log', json={'content': content}), repeat),
+        "parse_log_stored": best_time(lambda: (parse_cache.invalidate(log_id), post(f'/parse_log/{log_id}')), repeat),
+        "parse_log_cached": best_time(lambda: post(f'/parse_log/{log_id}'), repeat),
+        "update_log_append": best_time(
+            lambda: client.put(f'/update_log/{log_id}?append=true', json={'content': append_content}), repeat),
+    }
+    results["delete_log"] = best_time(lambda: client.delete(f'/delete_log/{log_id}'), 1)
+    return results
+
+
+def run_suite(sizes: List[int], repeat: int, level_mix: Dict[str, float], invalid_ratio: float) -> Dict[str, float]:
+    results = {}
+    for size in sizes:
+        lines = list(generate_lines(size, level_mix, invalid_ratio))
+        timings = benchmark_log_manager(lines, repeat)
+        timings.update(benchmark_endpoints(lines, repeat))
+        for name, seconds in timings.items():
+            results[f"{name}[n={size}]"] = seconds
+        print(f"n={size}: " + ", ".join(f"{name} {seconds:.4f}s" for name, seconds in timings.items()), flush=True)
+    return results
+
+
+def compare_results(results: Dict[str, float], baseline: Dict[str, float], threshold: float,
+                    min_seconds: float = 0.005) -> List[str]:
+    """
+    Benchmarks that got slower than baseline by more than threshold (0.25 = 25%).
+    Differences below min_seconds are treated as timer noise.
+    """
+    regressions = []
+    for name, seconds in results.items():
+        reference = baseline.get(name)
+        if reference and seconds > reference * (1 + threshold) and seconds - reference > min_seconds:
+            regressions.append(f"{name}: {seconds:.4f}s vs baseline {reference:.4f}s ({seconds / reference - 1:+.0%})")
+    return regressions
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1_000, 10_000, 100_000],
+                        help="log sizes in lines, e.g. 1000 up to 10000000 (generated logs are held in memory)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs per benchmark, the fastest one is kept")
+    parser.add_argument('--level-mix', type=parse_level_mix, default=DEFAULT_LEVEL_MIX,
+                        help="level weights, e.g. INFO=0.4,DEBUG=0.15,ERROR=0.05,MEASUREMENT=0.3,WARNING=0.1")
+    parser.add_argument('--invalid-ratio', type=float, default=0.02)
+    parser.add_argument('--output', default='bench_results.json')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    parser.add_argument('--min-seconds', type=float, default=0.005, help="ignore slowdowns smaller than this")
+    parser.add_argument('--update-baseline', action='store_true', help="store this run as the new baseline")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    output = os.path.abspath(args.output)
+    baseline_file = os.path.abspath(args.baseline)
+
+    with tempfile.TemporaryDirectory(prefix='bench_logs_') as log_directory:
+        # utils and app read LOG_DIRECTORY when imported, so they are imported by the benchmarks only
+        os.environ['LOG_DIRECTORY'] = log_directory
+        results = run_suite(args.sizes, args.repeat, args.level_mix, args.invalid_ratio)
+
+    report = {
+        "meta": {
+            "created": datetime.now().isoformat(timespec='seconds'),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "sizes": args.sizes,
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(output, 'w') as file:
+        json.dump(report, file, indent=2)
+    print(f"Results written to {output}")
+
+    if args.update_baseline:
+        with open(baseline_file, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Baseline updated: {baseline_file}")
+        return 0
+
+    if not os.path.exists(baseline_file):
+        print("No baseline to compare against, run with --update-baseline to store one.")
+        return 0
+
+    with open(baseline_file, 'r') as file:
+        baseline = json.load(file)["results"]
+    regressions = compare_results(results, baseline, args.threshold, args.min_seconds)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        return 1
+    print(f"No regressions beyond {args.threshold:.0%} against {baseline_file}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,219 @@
+"""
+SQLite catalog of the stored logs.
+
+One row per log with its path relative to the log directory, size, number
+of valid lines, earliest and latest timestamp and line count per level.
+The catalog is kept up to date by every save, update and delete, and
+rebuilt for logs it misses on startup, so listing logs never has to look
+at the log directory. The time-bucketed rollups of each log (see
+rollups.py) are kept next to it, with the identity of the file and the
+rules fingerprint they were built from. It only describes the logs: when
+it is lost it is rebuilt from the files.
+"""
+from collections import Counter
+from typing import Any, Dict, Iterable, List, NamedTuple, Optional, Tuple
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from rollups import ROLLUP_RESOLUTIONS, Bucket, Rollups
+
+# environment variable for the catalog database or fallback value (.catalog.sqlite in the log directory)
+LOG_CATALOG = os.getenv('LOG_CATALOG')
+
+CATALOG_FILENAME = '.catalog.sqlite'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS logs (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    line_count INTEGER NOT NULL,
+    first_timestamp TEXT,
+    last_timestamp TEXT,
+    level_counts TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS rollups (
+    id INTEGER NOT NULL,
+    resolution TEXT NOT NULL,
+    bucket TEXT NOT NULL,
+    level_counts TEXT NOT NULL,
+    alarms INTEGER NOT NULL,
+    measurements TEXT NOT NULL,
+    PRIMARY KEY (id, resolution, bucket)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS rollup_sources (
+    id INTEGER PRIMARY KEY,
+    source TEXT NOT NULL,
+    rules TEXT NOT NULL
+);
+"""
+
+COLUMNS = "id, path, size, line_count, first_timestamp, last_timestamp, level_counts"
+
+ROLLUP_COLUMNS = "bucket, level_counts, alarms, measurements"
+
+
+class CatalogEntry(NamedTuple):
+    """What the catalog knows about one log, first/last timestamp are the earliest and latest one."""
+    id: int
+    path: str
+    size: int
+    line_count: int
+    first_timestamp: Optional[str]
+    last_timestamp: Optional[str]
+    level_counts: Dict[str, int]
+
+    @classmethod
+    def from_records(cls, log_id: int, path: str, size: int, records: Iterable) -> 'CatalogEntry':
+        """Entry of a log holding exactly the given LogRecords."""
+        return cls(log_id, path, size, 0, None, None, {}).extend(records, size)
+
+    def extend(self, records: Iterable, size: int) -> 'CatalogEntry':
+        """Entry after the given LogRecords were appended and the file grew to size."""
+        records = list(records)
+        level_counts = Counter(self.level_counts)
+        level_counts.update(record.level for record in records)
+        timestamps = [record.timestamp for record in records]
+        if self.first_timestamp is not None:
+            timestamps += [self.first_timestamp, self.last_timestamp]
+        return self._replace(size=size, line_count=self.line_count + len(records),
+                             first_timestamp=min(timestamps, default=None),
+                             last_timestamp=max(timestamps, default=None), level_counts=dict(level_counts))
+
+    def to_dict(self) -> Dict[str, Any]:
+        return self._asdict()
+
+
+class LogCatalog:
+    """
+    The catalog database, shared by threads and server workers. Each thread
+    keeps its own connection, reopened when the database file was replaced
+    or removed; WAL mode lets readers go on while a worker writes.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._local = threading.local()
+
+    def _connect(self) -> sqlite3.Connection:
+        try:
+            inode = os.stat(self.path).st_ino
+        except FileNotFoundError:
+            inode = None
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and inode is not None and inode == self._local.inode:
+            return connection
+        if connection is not None:
+            connection.close()
+
+        connection = sqlite3.connect(self.path, timeout=30)
+        # losing the last commits on power loss is fine, they are rebuilt from the files
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.executescript(SCHEMA)
+        self._local.connection = connection
+        self._local.inode = os.stat(self.path).st_ino
+        return connection
+
+    def _write(self, *statements: Tuple[str, List[tuple]]) -> None:
+        """Run (statement, rows) pairs in one transaction."""
+        try:
+            with self._connect() as connection:
+                for statement, rows in statements:
+                    connection.executemany(statement, rows)
+        except sqlite3.Error as e:
+            logging.warning(f"Could not update log catalog {self.path}: {str(e)}")
+
+    @staticmethod
+    def _entry(row: tuple) -> CatalogEntry:
+        return CatalogEntry(*row[:-1], json.loads(row[-1]))
+
+    @staticmethod
+    def _bucket(row: tuple) -> Tuple[str, Bucket]:
+        name, level_counts, alarms, measurements = row
+        return name, Bucket(json.loads(level_counts), alarms, json.loads(measurements))
+
+    def put(self, *entries: CatalogEntry) -> None:
+        self._write((f"INSERT OR REPLACE INTO logs ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                     [(*entry[:-1], json.dumps(entry.level_counts)) for entry in entries]))
+
+    def remove(self, *log_ids: int) -> None:
+        rows = [(log_id,) for log_id in log_ids]
+        self._write(("DELETE FROM logs WHERE id = ?", rows),
+                    ("DELETE FROM rollups WHERE id = ?", rows),
+                    ("DELETE FROM rollup_sources WHERE id = ?", rows))
+
+    def get(self, log_id: int) -> Optional[CatalogEntry]:
+        try:
+            row = self._connect().execute(f"SELECT {COLUMNS} FROM logs WHERE id = ?", (log_id,)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not read log catalog {self.path}: {str(e)}")
+            return None
+        return None if row is None else self._entry(row)
+
+    def page(self, after: Optional[int] = None, limit: int = 100) -> List[CatalogEntry]:
+        """Up to limit entries with ids above after, in id order. Raises sqlite3.Error."""
+        rows = self._connect().execute(f"SELECT {COLUMNS} FROM logs WHERE id > ? ORDER BY id LIMIT ?",
+                                       (-1 if after is None else after, limit)).fetchall()
+        return [self._entry(row) for row in rows]
+
+    def paths(self) -> Dict[int, str]:
+        """Path of every cataloged log by id. Raises sqlite3.Error."""
+        return dict(self._connect().execute("SELECT id, path FROM logs"))
+
+    def move(self, *moves: Tuple[int, str]) -> None:
+        """Record new paths, given as (id, path) pairs."""
+        self._write(("UPDATE logs SET path = ? WHERE id = ?", [(path, log_id) for log_id, path in moves]))
+
+    def put_rollups(self, log_id: int, rollups: Rollups, source: Iterable[int], replace: bool = False) -> None:
+        """
+        Store the rollups of a log whose file now has the identity source.
+        They replace the stored buckets of the log, or with replace=False are
+        added to them, for appended lines.
+        """
+        try:
+            with self._connect() as connection:
+                if replace:
+                    connection.execute("DELETE FROM rollups WHERE id = ?", (log_id,))
+                rows = []
+                for resolution in ROLLUP_RESOLUTIONS:
+                    buckets = {name: bucket for (bucket_resolution, name), bucket in rollups.buckets.items()
+                               if bucket_resolution == resolution}
+                    if not buckets:
+                        continue
+                    if not replace:
+                        # appended lines mostly land in the last buckets, only their range is read
+                        stored = connection.execute(
+                            f"SELECT {ROLLUP_COLUMNS} FROM rollups WHERE id = ? AND resolution = ? "
+                            "AND bucket BETWEEN ? AND ?", (log_id, resolution, min(buckets), max(buckets)))
+                        for name, bucket in map(self._bucket, stored):
+                            if name in buckets:
+                                buckets[name] = bucket.merge(buckets[name])
+                    rows.extend((log_id, resolution, name, json.dumps(bucket.level_counts), bucket.alarms,
+                                 json.dumps(bucket.measurements)) for name, bucket in buckets.items())
+                connection.executemany(f"INSERT OR REPLACE INTO rollups (id, resolution, {ROLLUP_COLUMNS}) "
+                                       "VALUES (?, ?, ?, ?, ?, ?)", rows)
+                connection.execute("INSERT OR REPLACE INTO rollup_sources (id, source, rules) VALUES (?, ?, ?)",
+                                   (log_id, json.dumps(list(source)), rollups.rules.fingerprint))
+        except sqlite3.Error as e:
+            logging.warning(f"Could not update rollups in log catalog {self.path}: {str(e)}")
+
+    def rollup_source(self, log_id: int) -> Optional[Tuple[List[int], str]]:
+        """File identity and rules fingerprint the stored rollups of a log were built from."""
+        try:
+            row = self._connect().execute("SELECT source, rules FROM rollup_sources WHERE id = ?",
+                                          (log_id,)).fetchone()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not read log catalog {self.path}: {str(e)}")
+            return None
+        return None if row is None else (json.loads(row[0]), row[1])
+
+    def rollups(self, log_id: int, resolution: str, lowest: str, highest: str) -> List[Tuple[str, Bucket]]:
+        """(name, bucket) of the buckets between two names, in time order. Raises sqlite3.Error."""
+        rows = self._connect().execute(
+            f"SELECT {ROLLUP_COLUMNS} FROM rollups WHERE id = ? AND resolution = ? AND bucket BETWEEN ? AND ? "
+            "ORDER BY bucket", (log_id, resolution, lowest, highest)).fetchall()
+        return [self._bucket(row) for row in rows]
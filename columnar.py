@@ -0,0 +1,203 @@
+"""
+Columnar record batches with vectorized aggregation.
+
+Validated lines are stored column by column (timestamp, level code, gas
+dictionary code, measurement value and alarm flag) and the aggregates
+behind /parse_log are computed over whole columns with NumPy: level counts
+with bincount, per gas count/sum/min/max/mean/variance with grouped
+reductions and the quantile sketch buckets with unique. The classification
+rules run once per distinct message of a level, not once per line. NumPy is
+optional, without it LogSummary aggregates LogRecords one by one.
+"""
+from typing import Dict, List, Sequence
+import logging
+import os
+
+from rules import current_rules
+from stats import EXACT_SHIFT, MeasurementStats
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# environment variable to switch vectorized aggregation off or fallback value
+COLUMNAR_AGGREGATION = np is not None and os.getenv('COLUMNAR_AGGREGATION', 'true').lower() == 'true'
+
+# environment variable for the lines per columnar batch or fallback value
+COLUMNAR_BATCH_SIZE = int(os.getenv('COLUMNAR_BATCH_SIZE', 65536))
+
+# gas code of rows without a measurement
+NO_GAS = -1
+
+# positions of the digits in "YYYY-MM-DD hh:mm:ss"
+_DIGIT_COLUMNS = [0, 1, 2, 3, 5, 6, 8, 9, 11, 12, 14, 15, 17, 18]
+
+
+class RecordBatch:
+    """
+    Validated log records stored as parallel columns. Rows without a
+    measurement have gas code NO_GAS and a NaN value, gas names are
+    dictionary encoded in order of first appearance.
+    """
+
+    def __init__(self, timestamps: List[str], levels: List[str], messages: List[str], log_levels: Sequence[str]):
+        self.log_levels = tuple(log_levels)
+        self.gases: Dict[str, int] = {}
+        self.timestamps = timestamps
+        rows = len(timestamps)
+
+        level_codes = {level: code for code, level in enumerate(self.log_levels)}
+        self.level_codes = np.fromiter(map(level_codes.__getitem__, levels), dtype=np.uint8, count=rows)
+        self.gas_codes = np.full(rows, NO_GAS, dtype=np.int32)
+        self.values = np.full(rows, np.nan)
+        self.alarm_flags = np.zeros(rows, dtype=bool)
+
+        # only messages of levels that have classification rules are looked at, each distinct message of
+        # a level is classified once and its result spread over its rows
+        rules = current_rules()
+        gas_numbers: Dict[str, int] = {}
+        for level in rules.levels:
+            code = level_codes.get(level)
+            level_rows = np.flatnonzero(self.level_codes == code) if code is not None else []
+            if not len(level_rows):
+                continue
+            level_messages = list(map(messages.__getitem__, level_rows.tolist()))
+            distinct = {message: index for index, message in enumerate(dict.fromkeys(level_messages))}
+            inverse = np.fromiter(map(distinct.__getitem__, level_messages), dtype=np.int64, count=len(level_rows))
+            alarm_indexes, measurements = rules.classify_batch(level, list(distinct))
+            alarms = np.zeros(len(distinct), dtype=bool)
+            alarms[alarm_indexes] = True
+            invalid = np.zeros(len(distinct), dtype=bool)
+            gas_codes = np.full(len(distinct), NO_GAS, dtype=np.int32)
+            values = np.full(len(distinct), np.nan)
+            for index, gas, value in measurements:
+                try:
+                    values[index] = float(value)
+                except ValueError:
+                    invalid[index] = True
+                    continue
+                gas_codes[index] = gas_numbers.setdefault(gas, len(gas_numbers))
+            self.alarm_flags[level_rows] = alarms[inverse]
+            self.gas_codes[level_rows] = gas_codes[inverse]
+            self.values[level_rows] = values[inverse]
+            for row in level_rows[invalid[inverse]].tolist():
+                logging.warning(f"Invalid measurement value: {messages[row]}")
+
+        # gases are numbered in order of first appearance, like LogSummary.add does
+        measured = np.flatnonzero(self.gas_codes != NO_GAS)
+        if len(measured):
+            names = list(gas_numbers)
+            codes, first_rows = np.unique(self.gas_codes[measured], return_index=True)
+            order = codes[np.argsort(first_rows)]
+            renumbered = np.empty(len(names), dtype=np.int32)
+            renumbered[order] = np.arange(len(order), dtype=np.int32)
+            self.gas_codes[measured] = renumbered[self.gas_codes[measured]]
+            self.gases = {names[code]: number for number, code in enumerate(order.tolist())}
+
+    def __len__(self) -> int:
+        return len(self.timestamps)
+
+    @classmethod
+    def from_records(cls, records: Sequence, log_levels: Sequence[str]) -> 'RecordBatch':
+        """Batch of LogRecords that were already tokenized."""
+        return cls([record.timestamp for record in records], [record.level for record in records],
+                   [record.message for record in records], log_levels)
+
+    def epoch_seconds(self) -> 'np.ndarray':
+        """Timestamps as int64 seconds since the epoch."""
+        return np.array(self.timestamps, dtype='datetime64[s]').astype(np.int64)
+
+    def level_counts(self) -> Dict[str, int]:
+        return level_counts(self.level_codes, self.log_levels)
+
+    def alarm_timestamps(self) -> List[str]:
+        timestamps = self.timestamps
+        return [timestamps[row] for row in np.flatnonzero(self.alarm_flags).tolist()]
+
+    def measurements(self) -> Dict[str, MeasurementStats]:
+        """Statistics per gas, in order of first appearance."""
+        return grouped_measurements(self.gas_codes, self.values, self.gases)
+
+
+def timestamp_numbers(timestamps: Sequence[str]) -> 'np.ndarray':
+    """"YYYY-MM-DD hh:mm:ss" strings as YYYYMMDDhhmmss int64 numbers."""
+    if not len(timestamps):
+        return np.zeros(0, dtype=np.int64)
+    characters = np.array(timestamps, dtype='U19').view(np.uint32).reshape(-1, 19)
+    digits = characters[:, _DIGIT_COLUMNS].astype(np.int64) - ord('0')
+    return digits @ 10 ** np.arange(13, -1, -1, dtype=np.int64)
+
+
+def level_counts(level_codes: 'np.ndarray', log_levels: Sequence[str]) -> Dict[str, int]:
+    counts = np.bincount(level_codes, minlength=len(log_levels))
+    return dict(zip(log_levels, counts.tolist()))
+
+
+def grouped_measurements(gas_codes: 'np.ndarray', values: 'np.ndarray',
+                         gases: Sequence[str]) -> Dict[str, MeasurementStats]:
+    """Statistics per gas of the rows with a gas code, gases without rows are left out."""
+    if not len(gases):
+        return {}
+    measured = gas_codes != NO_GAS
+    codes = gas_codes[measured]
+    values = values[measured]
+
+    # group the values by gas, keeping their order within a gas
+    values = values[np.argsort(codes, kind='stable')]
+    ends = np.cumsum(np.bincount(codes, minlength=len(gases))).tolist()
+
+    measurements = {}
+    start = 0
+    for gas_type, end in zip(gases, ends):
+        if end > start:
+            measurements[gas_type] = _series_stats(values[start:end])
+        start = end
+    return measurements
+
+
+def _series_stats(values: 'np.ndarray') -> MeasurementStats:
+    if not np.isfinite(values).all():
+        # inf/nan follow Python comparison rules, which NumPy reductions do not
+        stats = MeasurementStats()
+        for value in values.tolist():
+            stats.add(value)
+        return stats
+
+    count = len(values)
+    exact = exact_sum(values)
+    mean = exact / (count << EXACT_SHIFT)
+    stats = MeasurementStats.from_moments(count, exact, float(values.min()), float(values.max()),
+                                          mean, float(np.square(values - mean).sum()))
+    sketch = stats.sketch
+    sketch.add_buckets(_bucket_counts(values[values > 1e-9], sketch._log_gamma),
+                       _bucket_counts(-values[values < -1e-9], sketch._log_gamma),
+                       int(np.count_nonzero(np.abs(values) <= 1e-9)))
+    return stats
+
+
+def exact_sum(values: 'np.ndarray') -> int:
+    """Sum of finite values in exact units, the same as adding up stats.exact_units of each."""
+    mantissas, exponents = np.frexp(values)
+    # each value is integers * 2**(exponents - 53) exactly
+    integers = (mantissas * 2.0 ** 53).astype(np.int64)
+    keys, groups = np.unique(exponents, return_inverse=True)
+    groups = groups.reshape(-1)
+    # 27 bit halves, so their sums per exponent stay exact in float64
+    high = np.bincount(groups, weights=integers >> 26, minlength=len(keys))
+    low = np.bincount(groups, weights=integers & ((1 << 26) - 1), minlength=len(keys))
+    total = 0
+    for exponent, high_sum, low_sum in zip(keys.tolist(), high.tolist(), low.tolist()):
+        units = (int(high_sum) << 26) + int(low_sum)
+        shift = exponent - 53 + EXACT_SHIFT
+        # only subnormals shift right, their trailing bits are zero
+        total += units << shift if shift >= 0 else units >> -shift
+    return total
+
+
+def _bucket_counts(values: 'np.ndarray', log_gamma: float) -> Dict[int, int]:
+    """QuantileSketch bucket counts of positive values."""
+    if not len(values):
+        return {}
+    keys, counts = np.unique(np.ceil(np.log(values) / log_gamma).astype(np.int64), return_counts=True)
+    return dict(zip(keys.tolist(), counts.tolist()))
@@ -0,0 +1,324 @@
+"""
+Live tail of stored logs for Server-Sent Events subscribers.
+
+One watcher thread per server worker follows every log that has
+subscribers. It wakes up on inotify events of the logs' directories on Linux,
+on writes made through this worker, and otherwise every TAIL_POLL_MS
+milliseconds. Newly appended complete lines are read and validated once
+per log, turned into encoded events and kept in a short per-log buffer.
+A subscriber is only a position in that buffer waiting on the log's
+condition, so idle subscribers cost no work besides the worker thread
+serving their stream.
+
+Events sent to a subscriber:
+ - snapshot: the parse_log_content summary of the whole log when subscribing,
+   with measurement counts and percentiles
+ - lines: newly appended valid lines and the number of rejected ones
+ - stats: the updated totals, with only the new alarm timestamps and the
+   measurements of gases that received new values
+ - reset: a new snapshot after the log was overwritten
+ - deleted: the log was removed, the stream ends
+Every event id is the byte offset in the log the event reflects.
+"""
+from collections import deque
+from typing import Callable, Deque, Dict, Iterator, List, Optional, Tuple
+import ctypes
+import ctypes.util
+import json
+import logging
+import os
+import select
+import threading
+
+from parse_cache import FileIdentity
+from utils import LogManager, LogSummary, RejectedLines
+
+# environment variable for the file polling interval in milliseconds or fallback value
+TAIL_POLL_MS = int(os.getenv('TAIL_POLL_MS', 1000))
+
+# environment variable for the seconds between keep-alive comments or fallback value
+TAIL_HEARTBEAT_SECONDS = int(os.getenv('TAIL_HEARTBEAT_SECONDS', 15))
+
+# environment variable for the events buffered per log or fallback value
+TAIL_BUFFER_EVENTS = int(os.getenv('TAIL_BUFFER_EVENTS', 256))
+
+# inotify event masks, see inotify(7)
+IN_MODIFY = 0x002
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+HEARTBEAT = b': keep-alive\n\n'
+
+# loads the summary of a whole log together with the identity of the file it was parsed from
+Snapshot = Callable[[int, str], Optional[Tuple[FileIdentity, LogSummary]]]
+
+
+def format_event(event: str, offset: int, data: dict) -> bytes:
+    return f"id: {offset}\nevent: {event}\ndata: {json.dumps(data)}\n\n".encode()
+
+
+class _Wakeup:
+    """Wait for a change in a watched directory, or until the polling interval passed."""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._watched = set()
+        try:
+            self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        except (OSError, AttributeError):
+            # no inotify, changes are found by polling
+            fd = -1
+        self._inotify = fd if fd >= 0 else None
+
+    def watch(self, directory: str) -> None:
+        if self._inotify is None or directory in self._watched:
+            return
+        if self._libc.inotify_add_watch(self._inotify, os.fsencode(directory),
+                                        IN_MODIFY | IN_MOVED_TO | IN_CREATE | IN_DELETE) >= 0:
+            self._watched.add(directory)
+
+    def notify(self) -> None:
+        self._event.set()
+
+    def wait(self, timeout: float) -> None:
+        if self._inotify is None:
+            self._event.wait(timeout)
+        elif not self._event.is_set():
+            readable, _, _ = select.select([self._inotify], [], [], timeout)
+            if readable:
+                try:
+                    # only the wakeup matters, the events themselves are dropped
+                    while os.read(self._inotify, 65536):
+                        pass
+                except BlockingIOError:
+                    pass
+        self._event.clear()
+
+    def close(self) -> None:
+        if self._inotify is not None:
+            os.close(self._inotify)
+            self._inotify = None
+
+
+class _FollowedLog:
+    """A log with subscribers: the running summary and the latest events."""
+
+    def __init__(self, log_id: int, filename: str):
+        self.log_id = log_id
+        self.filename = filename
+        self.condition = threading.Condition()
+        self.events: Deque[Tuple[int, int, bytes]] = deque(maxlen=TAIL_BUFFER_EVENTS)
+        self.next_sequence = 0
+        self.identity: Optional[FileIdentity] = None
+        self.offset = 0
+        self.summary = LogSummary()
+        self.subscribers = 0
+        self.closed = False
+
+    def reset(self, identity: FileIdentity, summary: LogSummary) -> None:
+        # a copy, the summary may be shared with the parse cache
+        self.identity = identity
+        self.offset = identity.size
+        self.summary = LogSummary().merge(summary)
+
+    def snapshot_event(self, event: str = 'snapshot') -> bytes:
+        return format_event(event, self.offset, self.summary.to_dict(percentiles=True))
+
+    def publish(self, data: bytes) -> None:
+        """Buffer an event and wake the subscribers, call it while holding the condition."""
+        self.events.append((self.next_sequence, self.offset, data))
+        self.next_sequence += 1
+        self.condition.notify_all()
+
+    def buffered_after(self, sequence: int) -> Optional[List[bytes]]:
+        """Events from sequence on, None when some of them already left the buffer."""
+        if not self.events:
+            return [] if sequence >= self.next_sequence else None
+        first = self.events[0][0]
+        if sequence < first:
+            return None
+        return [data for _, _, data in list(self.events)[sequence - first:]]
+
+    def sequence_after_offset(self, offset: int) -> Optional[int]:
+        """Buffer position right after the event with id offset, None when it is not buffered."""
+        if offset == self.offset:
+            return self.next_sequence
+        for sequence, event_offset, _ in self.events:
+            if event_offset == offset:
+                return sequence + 1
+        return None
+
+
+class TailHub:
+    """Fan-out of appended log lines to the SSE subscribers of one worker process."""
+
+    def __init__(self, snapshot: Snapshot):
+        self.snapshot = snapshot
+        self._lock = threading.Lock()
+        self._followed: Dict[int, _FollowedLog] = {}
+        self._thread: Optional[threading.Thread] = None
+        self._wakeup: Optional[_Wakeup] = None
+
+    def notify(self, log_id: int) -> None:
+        """Wake the watcher after a write through this worker."""
+        with self._lock:
+            if log_id in self._followed and self._wakeup is not None:
+                self._wakeup.notify()
+
+    def subscriber_count(self) -> int:
+        with self._lock:
+            return sum(followed.subscribers for followed in self._followed.values())
+
+    def subscribe(self, log_id: int, filename: str, last_event_id: Optional[str] = None) -> Iterator[bytes]:
+        """
+        Encoded events for one subscriber, starting with a snapshot. A client
+        reconnecting with the id of a buffered event gets the events it missed
+        instead. The subscription ends when the generator is closed.
+        """
+        followed = self._follow(log_id, filename)
+        try:
+            with followed.condition:
+                position = None
+                if last_event_id is not None and last_event_id.isdigit():
+                    position = followed.sequence_after_offset(int(last_event_id))
+                if followed.closed:
+                    pending = [format_event('deleted', followed.offset, {"id": log_id})]
+                elif position is None:
+                    pending = [followed.snapshot_event()]
+                else:
+                    pending = followed.buffered_after(position)
+                position = followed.next_sequence
+                closed = followed.closed
+            yield b''.join(pending) if pending else HEARTBEAT
+            if closed:
+                return
+
+            while True:
+                with followed.condition:
+                    if position >= followed.next_sequence and not followed.closed:
+                        followed.condition.wait(TAIL_HEARTBEAT_SECONDS)
+                    pending = followed.buffered_after(position)
+                    if pending is None:
+                        # fell behind the buffer, start over from the current totals
+                        pending = [followed.snapshot_event('reset')]
+                    position = followed.next_sequence
+                    closed = followed.closed
+                if pending:
+                    yield b''.join(pending)
+                elif not closed:
+                    yield HEARTBEAT
+                if closed:
+                    return
+        finally:
+            self._unfollow(followed)
+
+    def _follow(self, log_id: int, filename: str) -> _FollowedLog:
+        with self._lock:
+            followed = self._followed.get(log_id)
+            if followed is not None:
+                followed.subscribers += 1
+                return followed
+
+        # loaded before it is published, so no other subscriber sees it without its snapshot
+        loading = _FollowedLog(log_id, filename)
+        loaded = self.snapshot(log_id, filename)
+        if loaded is None:
+            loading.closed = True
+            loading.subscribers += 1
+            return loading
+        loading.reset(*loaded)
+
+        with self._lock:
+            # a subscriber that came at the same time may have published it first
+            followed = self._followed.get(log_id)
+            if followed is None:
+                followed = self._followed[log_id] = loading
+            followed.subscribers += 1
+            if self._thread is None:
+                self._wakeup = _Wakeup()
+                self._thread = threading.Thread(target=self._watch, name='log-tail', daemon=True)
+                self._thread.start()
+            self._wakeup.watch(os.path.dirname(filename) or '.')
+        return followed
+
+    def _unfollow(self, followed: _FollowedLog) -> None:
+        with self._lock:
+            followed.subscribers -= 1
+            if not followed.subscribers and self._followed.get(followed.log_id) is followed:
+                del self._followed[followed.log_id]
+
+    def _close(self, followed: _FollowedLog) -> None:
+        """Tell the subscribers of a removed log, call it while holding its condition."""
+        followed.closed = True
+        followed.publish(format_event('deleted', followed.offset, {"id": followed.log_id}))
+        with self._lock:
+            if self._followed.get(followed.log_id) is followed:
+                del self._followed[followed.log_id]
+
+    def _watch(self) -> None:
+        while True:
+            self._wakeup.wait(TAIL_POLL_MS / 1000)
+            with self._lock:
+                followed_logs = list(self._followed.values())
+                if not followed_logs:
+                    self._wakeup.close()
+                    self._wakeup = None
+                    self._thread = None
+                    return
+            for followed in followed_logs:
+                try:
+                    with followed.condition:
+                        if not followed.closed and followed.identity is not None:
+                            self._check(followed)
+                except Exception as e:
+                    logging.error(f"Live tail of log file with id {followed.log_id} failed: {str(e)}")
+
+    def _check(self, followed: _FollowedLog) -> None:
+        identity = FileIdentity.of(followed.filename)
+        if identity is None:
+            self._close(followed)
+        elif identity.inode != followed.identity.inode or identity.size < followed.offset:
+            # overwritten, the running totals no longer describe the file
+            loaded = self.snapshot(followed.log_id, followed.filename)
+            if loaded is None:
+                self._close(followed)
+            else:
+                followed.reset(*loaded)
+                followed.publish(followed.snapshot_event('reset'))
+        elif identity.size > followed.offset:
+            self._read_appended(followed)
+
+    def _read_appended(self, followed: _FollowedLog) -> None:
+        try:
+            with open(followed.filename, 'rb') as file:
+                if os.fstat(file.fileno()).st_ino != followed.identity.inode:
+                    # replaced since it was checked, picked up on the next round
+                    return
+                file.seek(followed.offset)
+                data = file.read()
+        except FileNotFoundError:
+            return
+        # a line still being written is read once it is complete
+        end = data.rfind(b'\n') + 1
+        if not end:
+            return
+
+        lines = [line.rstrip('\r') for line in data[:end].decode('utf-8', errors='replace').split('\n')[:-1]]
+        rejected = RejectedLines()
+        records = list(LogManager.iter_records(lines, rejected))
+        appended = LogSummary().update(records)
+        followed.offset += end
+        followed.identity = FileIdentity.of(followed.filename) or followed.identity
+        followed.summary.merge(appended)
+
+        totals = followed.summary.to_dict(percentiles=True)
+        stats = {
+            "log_message_count": totals["log_message_count"],
+            "measurements": {gas: totals["measurements"][gas] for gas in appended.measurements},
+            "alarms": {"count": totals["alarms"]["count"], "timestamps": appended.alarms}
+        }
+        followed.publish(format_event('lines', followed.offset,
+                                      {"lines": [record.line for record in records], "rejected": rejected.count})
+                         + format_event('stats', followed.offset, stats))
@@ -0,0 +1,212 @@
+"""
+Safe concurrent writes to stored log files.
+
+Every log has a lock file next to it (log_<id>.log.lock) that is locked
+with flock, or msvcrt on Windows, so writers in different server workers
+exclude each other per log while writes to other logs go on in parallel.
+Appends that queue up for the same log while a write is running are
+written together by one request (group commit), overwrites go to a
+temporary file that is renamed over the log so readers never see a
+partly written file.
+"""
+from typing import Any, Callable, Dict, Generic, Hashable, List, TypeVar
+import os
+import threading
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# environment variable to fsync every log write or fallback value
+LOG_FSYNC = os.getenv('LOG_FSYNC', 'false').lower() == 'true'
+
+LOCK_SUFFIX = '.lock'
+
+T = TypeVar('T')
+
+
+class FileLock:
+    """
+    Exclusive lock on a log file shared by all threads and processes, held
+    as a context manager. No lock file is created for a log that does not
+    exist, entering then raises FileNotFoundError. A lock file removed by
+    remove_lock while waiting for it is not held on to, the lock is taken
+    again on the file now at its path. A thread that already holds the lock
+    of a log enters it again without waiting.
+    """
+
+    # lock files held by each thread
+    _held = threading.local()
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self.path = filename + LOCK_SUFFIX
+        self._file = None
+        self._nested = False
+
+    def __enter__(self) -> 'FileLock':
+        held = self._held.__dict__.setdefault('paths', set())
+        if self.path in held:
+            self._nested = True
+            return self
+        self._acquire()
+        held.add(self.path)
+        return self
+
+    def _acquire(self) -> None:
+        while True:
+            # a lock file left behind by a removed log is opened without recreating the log's
+            self._file = open(self.path, 'a+b' if os.path.exists(self.filename) else 'r+b')
+            try:
+                self._lock()
+                if os.path.samestat(os.fstat(self._file.fileno()), os.stat(self.path)):
+                    return
+            except FileNotFoundError:
+                pass
+            except BaseException:
+                self._file.close()
+                raise
+            self._unlock()
+            self._file.close()
+
+    def _lock(self) -> None:
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        else:
+            self._file.seek(0)
+            while True:
+                try:
+                    # LK_LOCK gives up after about 10 seconds
+                    msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    continue
+
+    def _unlock(self) -> None:
+        if fcntl is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        else:
+            self._file.seek(0)
+            msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+
+    def __exit__(self, *exc_info) -> bool:
+        if self._nested:
+            self._nested = False
+            return False
+        self._held.paths.discard(self.path)
+        self._unlock()
+        self._file.close()
+        self._file = None
+        return False
+
+
+def remove_lock(filename: str) -> None:
+    """
+    Remove the lock file of a deleted log, call it after releasing the lock.
+    Holders that got it in the meantime still exclude each other, and no
+    new lock file is created while the log does not exist.
+    """
+    try:
+        os.remove(filename + LOCK_SUFFIX)
+    except OSError:
+        pass
+
+
+def append_to_file(filename: str, content: str, fsync: bool = LOG_FSYNC) -> None:
+    with open(filename, 'a') as file:
+        file.write(content)
+        if fsync:
+            file.flush()
+            os.fsync(file.fileno())
+
+
+def write_atomic(filename: str, content: str, fsync: bool = LOG_FSYNC) -> None:
+    """Replace a file in one step: write a temporary file next to it and rename it over the original."""
+    temp_path = f"{filename}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_path, 'w') as file:
+            file.write(content)
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temp_path, filename)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+class _Pending(Generic[T]):
+    __slots__ = ('item', 'wakeup', 'done', 'error')
+
+    def __init__(self, item: T):
+        self.item = item
+        self.wakeup = threading.Event()
+        self.done = False
+        self.error: BaseException = None
+
+
+class GroupCommit(Generic[T]):
+    """
+    Batch concurrent writes per key. The first request for a key becomes
+    the leader and commits its item together with everything queued while
+    it waited for the previous commit; the others block until their item
+    has been committed. Leadership passes to the next waiting request, so
+    no request keeps writing on behalf of others indefinitely.
+    """
+
+    def __init__(self, commit: Callable[[Hashable, List[T]], None]):
+        self.commit = commit
+        self._lock = threading.Lock()
+        self._queues: Dict[Hashable, List[_Pending[T]]] = {}
+        self._leading: set = set()
+        self.commits = 0
+        self.items = 0
+
+    def submit(self, key: Hashable, item: T) -> None:
+        """Queue an item and return once it is committed, re-raising the commit's error."""
+        pending = _Pending(item)
+        with self._lock:
+            self._queues.setdefault(key, []).append(pending)
+            leader = key not in self._leading
+            if leader:
+                self._leading.add(key)
+
+        if not leader:
+            pending.wakeup.wait()
+            if not pending.done:
+                # promoted to leader by the previous one
+                leader = True
+
+        if leader:
+            self._lead(key)
+        if pending.error is not None:
+            raise pending.error
+
+    def _lead(self, key: Hashable) -> None:
+        with self._lock:
+            batch = self._queues.pop(key)
+        try:
+            self.commit(key, [pending.item for pending in batch])
+        except BaseException as e:
+            for pending in batch:
+                pending.error = e
+        finally:
+            with self._lock:
+                self.commits += 1
+                self.items += len(batch)
+                waiting = self._queues.get(key)
+                if waiting:
+                    waiting[0].wakeup.set()
+                else:
+                    self._leading.discard(key)
+            for pending in batch:
+                pending.done = True
+                pending.wakeup.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"commits": self.commits, "items": self.items}
@@ -0,0 +1,253 @@
+from bisect import bisect_right
+from collections import OrderedDict
+from typing import Callable, Iterable, Iterator, List, Optional, Tuple
+import mmap
+import os
+import re
+import threading
+
+# bytes scanned per index checkpoint, a lookup never reads more than this to find a line
+INDEX_BLOCK_SIZE = 64 * 1024
+
+# environment variable for the number of line indexes kept in memory or fallback value
+LINE_INDEX_CACHE_SIZE = int(os.getenv('LINE_INDEX_CACHE_SIZE', 256))
+
+# marker written next to a log whose lines were checked to be in timestamp order
+ORDERED_SUFFIX = '.ordered'
+
+LINE_TIMESTAMP_PATTERN = re.compile(rb'\[([0-9]{4}-[0-9]{2}-[0-9]{2} [0-9]{2}:[0-9]{2}:[0-9]{2})\] ')
+
+# "2024-07-19", "2024-07-19 10", ... "2024-07-19 10:00:00", a prefix of a log timestamp
+TIME_BOUND_PATTERN = re.compile(r'[0-9]{4}(-[0-9]{2}(-[0-9]{2}( [0-9]{2}(:[0-9]{2}(:[0-9]{2})?)?)?)?)?')
+
+
+class LineIndex:
+    """
+    Sparse line-offset index of a log file. One checkpoint (line number,
+    byte offset of that line) is kept per INDEX_BLOCK_SIZE bytes, so any
+    line can be reached with one seek and a short forward scan.
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.inode: Optional[int] = None
+        self.size = 0
+        self.newlines = 0
+        self.line_starts: List[int] = [0]
+        self.offsets: List[int] = [0]
+
+    @property
+    def line_count(self) -> int:
+        """Number of lines, counting an unterminated last line."""
+        return self.newlines + (1 if self.size > self.offsets[-1] else 0)
+
+    def refresh(self) -> 'LineIndex':
+        """
+        Bring the index up to date with the file. Appended bytes are scanned
+        incrementally, a replaced or truncated file is re-indexed from scratch.
+        """
+        with self._lock:
+            stat = os.stat(self.filename)
+            if stat.st_ino != self.inode or stat.st_size < self.size:
+                self.inode = stat.st_ino
+                self.size = 0
+                self.newlines = 0
+                self.line_starts = [0]
+                self.offsets = [0]
+            if stat.st_size != self.size:
+                self._scan()
+        return self
+
+    def _scan(self) -> None:
+        with open(self.filename, 'rb') as file:
+            file.seek(self.size)
+            position = self.size
+            while True:
+                block = file.read(INDEX_BLOCK_SIZE)
+                if not block:
+                    break
+                newlines = block.count(b'\n')
+                if newlines:
+                    self.newlines += newlines
+                    self.line_starts.append(self.newlines)
+                    self.offsets.append(position + block.rindex(b'\n') + 1)
+                position += len(block)
+            self.size = position
+
+    def seek_line(self, file, line: int) -> None:
+        """Position a binary file object at the start of the given line."""
+        checkpoint = bisect_right(self.line_starts, line) - 1
+        file.seek(self.offsets[checkpoint])
+        for _ in range(line - self.line_starts[checkpoint]):
+            file.readline()
+
+    def read_lines(self, start: int, count: int) -> Iterator[bytes]:
+        """Yield count raw lines starting at line number start, reading nothing else."""
+        with open(self.filename, 'rb') as file:
+            self.seek_line(file, start)
+            for _ in range(count):
+                line = file.readline()
+                if not line:
+                    break
+                yield line
+
+
+class LineIndexCache:
+    """Bounded LRU of line indexes, one per log id."""
+
+    def __init__(self, max_entries: int = LINE_INDEX_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._indexes: 'OrderedDict[int, LineIndex]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, log_id: int, filename: str) -> LineIndex:
+        with self._lock:
+            index = self._indexes.get(log_id)
+            if index is None or index.filename != filename:
+                index = LineIndex(filename)
+            self._indexes[log_id] = index
+            self._indexes.move_to_end(log_id)
+            while len(self._indexes) > self.max_entries:
+                self._indexes.popitem(last=False)
+        return index.refresh()
+
+    def invalidate(self, log_id: int) -> None:
+        with self._lock:
+            self._indexes.pop(log_id, None)
+
+
+def parse_time_bound(value: Optional[str]) -> Optional[str]:
+    """
+    Normalize a from/to query value. Any prefix of a log timestamp is
+    accepted, "T" may separate date and time.
+    """
+    if value is None:
+        return None
+    value = value.strip().replace('T', ' ')
+    if not TIME_BOUND_PATTERN.fullmatch(value):
+        raise ValueError(f"Invalid time bound '{value}', expected YYYY-MM-DD HH:MM:SS or a prefix of it.")
+    return value
+
+
+def in_time_window(timestamp: str, start: Optional[str], end: Optional[str]) -> bool:
+    """Both bounds are inclusive, end matches on its own precision."""
+    return (start is None or timestamp >= start) and (end is None or timestamp[:len(end)] <= end)
+
+
+def is_ordered(timestamps: Iterable[str], previous: Optional[str] = None) -> bool:
+    """Check that timestamps never go backwards, optionally continuing from a previous one."""
+    for timestamp in timestamps:
+        if previous is not None and timestamp < previous:
+            return False
+        previous = timestamp
+    return True
+
+
+def is_marked_ordered(filename: str) -> bool:
+    return os.path.exists(filename + ORDERED_SUFFIX)
+
+
+def mark_ordered(filename: str, ordered: bool) -> None:
+    """
+    Record whether a log may be binary searched by timestamp. A log without
+    the marker, e.g. one written outside the API, is treated as unordered.
+    """
+    marker = filename + ORDERED_SUFFIX
+    if ordered:
+        open(marker, 'a').close()
+    elif os.path.exists(marker):
+        os.remove(marker)
+
+
+def scan_ordered(filename: str) -> bool:
+    """Read a whole log to check that its timestamped lines, the ones a binary search looks at, are in order."""
+    with open(filename, 'rb') as file:
+        return is_ordered(match.group(1) for match in map(LINE_TIMESTAMP_PATTERN.match, file) if match)
+
+
+def last_timestamp(filename: str) -> Optional[str]:
+    """Timestamp of the last timestamped line, found by scanning backwards."""
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = len(mm)
+            while end > 0:
+                start = mm.rfind(b'\n', 0, end - 1) + 1
+                match = LINE_TIMESTAMP_PATTERN.match(mm, start)
+                if match:
+                    return match.group(1).decode()
+                end = start
+    return None
+
+
+def _next_timestamped(mm: mmap.mmap, position: int, limit: int) -> Tuple[int, Optional[bytes]]:
+    """First line starting at or after position (a line start) that has a timestamp."""
+    while position < limit:
+        match = LINE_TIMESTAMP_PATTERN.match(mm, position)
+        if match:
+            return position, match.group(1)
+        newline = mm.find(b'\n', position, limit)
+        if newline == -1:
+            break
+        position = newline + 1
+    return limit, None
+
+
+def _bisect_lines(mm: mmap.mmap, predicate: Callable[[bytes], bool]) -> int:
+    """Offset of the first line whose timestamp satisfies a monotonic predicate."""
+    low, high = 0, len(mm)
+    while low < high:
+        middle = mm.rfind(b'\n', low, (low + high) // 2) + 1 or low
+        position, timestamp = _next_timestamped(mm, middle, high)
+        if timestamp is None or predicate(timestamp):
+            high = middle
+        else:
+            newline = mm.find(b'\n', position, high)
+            low = high if newline == -1 else newline + 1
+    return low
+
+
+def find_time_window(filename: str, start: Optional[str], end: Optional[str]) -> Tuple[int, int]:
+    """
+    Byte range [begin, end) of the lines between two timestamps, found by
+    binary search over a memory-mapped log. Only valid for ordered logs.
+    """
+    with open(filename, 'rb') as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            return 0, 0
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            begin = 0 if start is None else _bisect_lines(mm, lambda ts: ts >= start.encode())
+            finish = len(mm) if end is None else _bisect_lines(mm, lambda ts: ts[:len(end)] > end.encode())
+            return begin, max(begin, finish)
+
+
+def read_byte_range(filename: str, begin: int, end: int) -> Iterator[bytes]:
+    """Yield the raw lines between two line-start offsets."""
+    with open(filename, 'rb') as file:
+        file.seek(begin)
+        position = begin
+        while position < end:
+            line = file.readline()
+            if not line:
+                break
+            position += len(line)
+            yield line
+
+
+def read_time_window(filename: str, start: Optional[str], end: Optional[str]) -> Iterator[bytes]:
+    """
+    Yield the raw lines of a log between two timestamps. Logs marked as
+    ordered are binary searched, any other log falls back to a full scan.
+    """
+    if is_marked_ordered(filename):
+        begin, finish = find_time_window(filename, start, end)
+        yield from read_byte_range(filename, begin, finish)
+        return
+
+    with open(filename, 'rb') as file:
+        for line in file:
+            match = LINE_TIMESTAMP_PATTERN.match(line)
+            if match and in_time_window(match.group(1).decode(), start, end):
+                yield line
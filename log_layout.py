@@ -0,0 +1,114 @@
+"""
+Sharded layout of the log directory.
+
+Logs are stored as <directory>/<shard>/log_<id>.log, the shard being the id
+divided by LOG_SHARD_SIZE, zero padded: with the default of 1000 logs per
+shard, log 1234 lives in 0001/log_1234.log. The files kept next to a log
+(sidecar index, ordering marker) share its name as a prefix and move with
+it. Logs found anywhere else, like the flat log_<id>.log of earlier
+versions, are moved into their shard on startup and are still found where
+they are until then.
+"""
+from typing import Dict, Iterator, List, Tuple
+import logging
+import os
+import re
+
+from log_files import LOCK_SUFFIX, FileLock, remove_lock
+
+# environment variable for the logs per shard directory or fallback value, 0 keeps all logs in one directory
+LOG_SHARD_SIZE = int(os.getenv('LOG_SHARD_SIZE', 1000))
+
+# a log or one of the files kept next to it
+LOG_FILE_PATTERN = re.compile(r'log_([0-9]+)\.log(\..*)?')
+
+
+def flat_path(directory: str, log_id: int) -> str:
+    return os.path.join(directory, f"log_{log_id}.log")
+
+
+def log_path(directory: str, log_id: int, shard_size: int = LOG_SHARD_SIZE) -> str:
+    """Where a log belongs in the layout."""
+    if not shard_size:
+        return flat_path(directory, log_id)
+    return os.path.join(directory, f"{log_id // shard_size:04d}", f"log_{log_id}.log")
+
+
+def find_log(directory: str, log_id: int) -> str:
+    """The path of a stored log, falling back to the flat path for logs not migrated yet."""
+    path = log_path(directory, log_id)
+    if not os.path.exists(path):
+        flat = flat_path(directory, log_id)
+        if flat != path and os.path.exists(flat):
+            return flat
+    return path
+
+
+def _scan(directory: str) -> Dict[int, List[str]]:
+    """Logs of one directory with the names of their files, the log itself first."""
+    files: Dict[int, List[str]] = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            match = LOG_FILE_PATTERN.fullmatch(entry.name)
+            if match is None or not entry.is_file():
+                continue
+            names = files.setdefault(int(match.group(1)), [])
+            if match.group(2) is None:
+                names.insert(0, entry.name)
+            else:
+                names.append(entry.name)
+    # companions of a log that is gone are left alone
+    return {log_id: names for log_id, names in files.items() if LOG_FILE_PATTERN.fullmatch(names[0]).group(2) is None}
+
+
+def _directories(directory: str) -> Iterator[str]:
+    yield directory
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.name.isdigit() and entry.is_dir():
+                yield entry.path
+
+
+def iter_log_files(directory: str) -> Iterator[Tuple[int, str]]:
+    """(id, path) of every stored log, flat or in any shard."""
+    for subdirectory in _directories(directory):
+        for log_id, names in _scan(subdirectory).items():
+            yield log_id, os.path.join(subdirectory, names[0])
+
+
+def migrate(directory: str) -> int:
+    """
+    Move every log that is not where log_path puts it, together with the
+    files next to it, while holding its lock. Returns the number of logs moved.
+    """
+    moved = 0
+    for subdirectory in list(_directories(directory)):
+        for log_id, names in _scan(subdirectory).items():
+            source = os.path.join(subdirectory, names[0])
+            target = log_path(directory, log_id)
+            if source == target:
+                continue
+            if os.path.exists(target):
+                logging.warning(f"Log file {source} not migrated, {target} already exists.")
+                continue
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            try:
+                with FileLock(source):
+                    if not os.path.exists(source):
+                        # moved by another worker in the meantime
+                        continue
+                    # the log goes first, readers look for it at its new path before the old one
+                    for name in names:
+                        if name.endswith(LOCK_SUFFIX) or name.endswith('.tmp'):
+                            continue
+                        try:
+                            os.rename(os.path.join(subdirectory, name), target + name[len(names[0]):])
+                        except FileNotFoundError:
+                            pass
+            except FileNotFoundError:
+                continue
+            remove_lock(source)
+            moved += 1
+    if moved:
+        logging.info(f"Moved {moved} log files into shard directories.")
+    return moved
@@ -0,0 +1,168 @@
+"""
+Lightweight Prometheus-style instrumentation: counters, latency histograms
+and a text exposition for the /metrics endpoint.
+
+Metrics live in the memory of one process, so with several server workers
+each scrape sees the worker that answered it.
+"""
+from bisect import bisect_left
+from contextlib import nullcontext
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+import os
+import threading
+import time
+
+# environment variable to switch instrumentation off or fallback value
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+
+LATENCY_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_NULL_TIMER = nullcontext()
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, *labelvalues: str) -> None:
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def value(self, *labelvalues: str) -> float:
+        return self._values.get(labelvalues, 0)
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        if not items and not self.labelnames:
+            items = [((), 0)]
+        for labelvalues, value in items:
+            lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = LATENCY_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        # per label values: bucket counts (the last one is +Inf), sum
+        self._series: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labelvalues)
+            if series is None:
+                series = self._series[labelvalues] = ([0] * (len(self.buckets) + 1), [0.0])
+            series[0][index] += 1
+            series[1][0] += value
+
+    def count(self, *labelvalues: str) -> int:
+        series = self._series.get(labelvalues)
+        return sum(series[0]) if series else 0
+
+    def expose(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((labels, (list(counts), total[0])) for labels, (counts, total) in self._series.items())
+        for labelvalues, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else repr(bound)
+                bucket_label = f'le="{le}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labelvalues, bucket_label)} {cumulative}")
+            labels = _format_labels(self.labelnames, labelvalues)
+            lines.append(f"{self.name}_sum{labels} {_format_value(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class StageTimer:
+    """Context manager that records the duration of one processing stage."""
+    __slots__ = ('stage', 'start')
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        STAGE_SECONDS.observe(time.perf_counter() - self.start, self.stage)
+        return False
+
+
+REQUEST_SECONDS = Histogram('log_api_request_seconds', 'Request handling time per endpoint.', ['endpoint'])
+REQUESTS = Counter('log_api_requests_total', 'Handled requests per endpoint and status code.', ['endpoint', 'status'])
+STAGE_SECONDS = Histogram('log_api_stage_seconds', 'Time spent per processing stage.', ['stage'])
+LINES_ACCEPTED = Counter('log_api_lines_accepted_total', 'Log lines that passed validation.')
+LINES_REJECTED = Counter('log_api_lines_rejected_total', 'Log lines rejected by validation.')
+BYTES_READ = Counter('log_api_bytes_read_total', 'Bytes read from stored log files.')
+BYTES_WRITTEN = Counter('log_api_bytes_written_total', 'Bytes written to stored log files.')
+
+_METRICS = [REQUEST_SECONDS, REQUESTS, STAGE_SECONDS, LINES_ACCEPTED, LINES_REJECTED, BYTES_READ, BYTES_WRITTEN]
+_collectors: List[Callable[[], Iterable[str]]] = []
+
+
+def time_stage(stage: str):
+    """Time a block as the given stage, nearly free when metrics are disabled."""
+    return StageTimer(stage) if METRICS_ENABLED else _NULL_TIMER
+
+
+def count_lines(accepted: int, rejected: int) -> None:
+    if METRICS_ENABLED:
+        if accepted:
+            LINES_ACCEPTED.inc(accepted)
+        if rejected:
+            LINES_REJECTED.inc(rejected)
+
+
+def count_bytes_read(amount: int) -> None:
+    if METRICS_ENABLED:
+        BYTES_READ.inc(amount)
+
+
+def count_bytes_written(amount: int) -> None:
+    if METRICS_ENABLED:
+        BYTES_WRITTEN.inc(amount)
+
+
+def register_collector(collector: Callable[[], Iterable[str]]) -> None:
+    """Add a callback producing exposition lines for values owned by other components."""
+    _collectors.append(collector)
+
+
+def gauge_lines(name: str, documentation: str, value: float, metric_type: str = 'gauge') -> List[str]:
+    return [f"# HELP {name} {documentation}", f"# TYPE {name} {metric_type}", f"{name} {_format_value(value)}"]
+
+
+def expose() -> str:
+    """Render all metrics in the Prometheus text format."""
+    lines = []
+    for metric in _METRICS:
+        lines.extend(metric.expose())
+    for collector in _collectors:
+        lines.extend(collector())
+    return '\n'.join(lines) + '\n'
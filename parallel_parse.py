@@ -0,0 +1,93 @@
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Callable, List, Optional, Tuple, TypeVar
+import logging
+import multiprocessing
+import os
+import threading
+
+from utils import LogManager, LogSummary
+import sidecar
+
+# environment variable for the number of parse worker processes or fallback value
+PARSE_WORKERS = int(os.getenv('PARSE_WORKERS', os.cpu_count() or 1))
+
+T = TypeVar('T')
+
+_executor: Optional[Executor] = None
+_executor_lock = threading.Lock()
+
+
+def get_executor() -> Executor:
+    """
+    Process pool shared by all requests, started on first use. Workers are
+    not forked from the server, whose other threads may hold locks at that
+    moment, but started by a fork server, or spawned where there is none.
+    """
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            method = 'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else 'spawn'
+            context = multiprocessing.get_context(method)
+            if method == 'forkserver':
+                # imported once in the fork server, every worker starts with the parse modules loaded
+                context.set_forkserver_preload(['parallel_parse'])
+            _executor = ProcessPoolExecutor(max_workers=max(PARSE_WORKERS, 1), mp_context=context)
+        return _executor
+
+
+def summarize_log_file(filename: str) -> LogSummary:
+    """Worker side of a parse of one stored log, from its sidecar when there is one."""
+    log_sidecar = sidecar.load(filename)
+    if log_sidecar is not None:
+        return log_sidecar.summary()
+    return LogSummary().update_lines(LogManager.read_log_lines(filename))
+
+
+def parse_log_file(filename: str) -> Tuple[Optional[LogSummary], Optional[str]]:
+    """
+    Worker side of a multi-log parse: stream one file into a partial
+    summary. Errors are returned instead of raised so one bad file does
+    not fail the batch.
+    """
+    try:
+        return summarize_log_file(filename), None
+    except FileNotFoundError:
+        return None, "Log file not found."
+    except (OSError, UnicodeDecodeError) as e:
+        logging.error(f"Could not parse {filename}: {str(e)}")
+        return None, str(e)
+
+
+def parse_lines(lines: List[str]) -> LogSummary:
+    """Worker side of an inline parse job."""
+    return LogSummary().update_lines(lines)
+
+
+def run_parse(function: Callable[..., T], *args) -> T:
+    """Run one parse in the worker process pool, or in the calling thread without one."""
+    if PARSE_WORKERS <= 1:
+        return function(*args)
+    return get_executor().submit(function, *args).result()
+
+
+def parse_log_files(filenames: List[str]) -> List[Tuple[Optional[LogSummary], Optional[str]]]:
+    """Parse several logs in parallel, results keep the order of filenames."""
+    if len(filenames) <= 1 or PARSE_WORKERS <= 1:
+        return [parse_log_file(filename) for filename in filenames]
+    chunksize = max(len(filenames) // (PARSE_WORKERS * 4), 1)
+    return list(get_executor().map(parse_log_file, filenames, chunksize=chunksize))
+
+
+def merge_summaries(summaries: List[LogSummary]) -> LogSummary:
+    merged = LogSummary()
+    for summary in summaries:
+        merged.merge(summary)
+    return merged
+
+
+def shutdown() -> None:
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown()
+            _executor = None
@@ -0,0 +1,94 @@
+from collections import OrderedDict
+from typing import Dict, NamedTuple, Optional
+import os
+import threading
+
+from rules import current_rules
+from utils import LogSummary
+
+# environment variable for the number of cached parse summaries or fallback value
+PARSE_CACHE_SIZE = int(os.getenv('PARSE_CACHE_SIZE', 128))
+
+
+class FileIdentity(NamedTuple):
+    """What a cached summary was built from: inode, size and mtime of the log file."""
+    inode: int
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def of(cls, filename: str) -> Optional['FileIdentity']:
+        try:
+            stat = os.stat(filename)
+        except OSError:
+            return None
+        return cls(stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class ParseCache:
+    """
+    LRU cache of parsed log summaries. An entry is only served while the
+    log file still has the identity it was parsed from, so any change made
+    outside the API is picked up as a miss.
+    """
+
+    def __init__(self, max_entries: int = PARSE_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries: 'OrderedDict[int, tuple[FileIdentity, str, LogSummary]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, log_id: int, identity: Optional[FileIdentity]) -> Optional[LogSummary]:
+        with self._lock:
+            entry = self._entries.get(log_id)
+            # summaries made with classification rules that were replaced since are misses too
+            if entry is None or identity is None or entry[0] != identity or entry[1] != current_rules().fingerprint:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(log_id)
+            self.hits += 1
+            return entry[2]
+
+    def put(self, log_id: int, identity: Optional[FileIdentity], summary: LogSummary) -> None:
+        if identity is None or self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[log_id] = (identity, current_rules().fingerprint, summary)
+            self._entries.move_to_end(log_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def append(self, log_id: int, previous: Optional[FileIdentity], current: Optional[FileIdentity],
+               appended: LogSummary) -> None:
+        """
+        Fold the summary of appended lines into a cached summary without
+        re-parsing the file. The entry is dropped instead when it no longer
+        matches the file as it was right before the append.
+        """
+        with self._lock:
+            entry = self._entries.get(log_id)
+            if entry is None:
+                return
+            if previous is None or current is None or entry[0] != previous or entry[1] != current_rules().fingerprint:
+                del self._entries[log_id]
+                return
+            # update a copy, readers may still hold the cached summary
+            summary = LogSummary().merge(entry[2]).merge(appended)
+            self._entries[log_id] = (current, entry[1], summary)
+
+    def invalidate(self, log_id: int) -> None:
+        with self._lock:
+            self._entries.pop(log_id, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions
+            }
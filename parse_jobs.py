@@ -0,0 +1,163 @@
+"""
+Asynchronous parse jobs.
+
+A submitted job runs on a small thread pool of the server worker that took
+it, so a long parse never holds a request thread. Each worker accepts at
+most JOB_QUEUE_SIZE jobs that are queued or running and refuses more until
+some finish. The state of a job is kept as a JSON file in the job directory
+(.jobs in the log directory), so it can be polled through any server
+worker. Finished jobs are removed JOB_RESULT_TTL seconds after they were
+last written.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from log_files import write_atomic
+from utils import LogValidationError
+
+# environment variable for the parse job threads per server worker or fallback value
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+
+# environment variable for the queued and running jobs per server worker or fallback value
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 32))
+
+# environment variable for the seconds a job result is kept or fallback value
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', 600))
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# expired jobs are looked for at most this often
+SWEEP_INTERVAL = 60
+
+
+class JobQueue:
+    """Bounded queue of parse jobs with results kept as files for a limited time."""
+
+    def __init__(self, directory: str, workers: int = JOB_WORKERS, max_jobs: int = JOB_QUEUE_SIZE,
+                 ttl: int = JOB_RESULT_TTL):
+        self.directory = directory
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max(workers, 1), thread_name_prefix='parse-job')
+        self._lock = threading.Lock()
+        self._active = 0
+        self._last_sweep = 0.0
+        self.submitted = 0
+        self.rejected = 0
+
+    def _path(self, job_id: str) -> str:
+        return os.path.join(self.directory, f"{job_id}.json")
+
+    def _save(self, job: Dict[str, Any]) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        write_atomic(self._path(job["job_id"]), json.dumps(job), fsync=False)
+
+    def submit(self, run: Callable[[], Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """
+        Queue run, which returns the job result or raises LogValidationError
+        for a job that has nothing to parse. Returns the queued job, or None
+        when the queue is full.
+        """
+        with self._lock:
+            if self._active >= self.max_jobs:
+                self.rejected += 1
+                return None
+            self._active += 1
+            self.submitted += 1
+
+        job = {"job_id": uuid.uuid4().hex, "status": QUEUED, "submitted_at": time.time()}
+        try:
+            self._save(job)
+            self._executor.submit(self._run, dict(job), run)
+        except BaseException:
+            self._finish()
+            raise
+        self.sweep()
+        return job
+
+    def _finish(self) -> None:
+        with self._lock:
+            self._active -= 1
+
+    def _run(self, job: Dict[str, Any], run: Callable[[], Dict[str, Any]]) -> None:
+        try:
+            job.update(status=RUNNING, started_at=time.time())
+            self._save(job)
+            try:
+                job.update(status=DONE, result=run())
+            except (LogValidationError, FileNotFoundError) as e:
+                job.update(status=FAILED, error=str(e), error_type=type(e).__name__)
+            except Exception as e:
+                logging.error(f"Parse job {job['job_id']} failed: {type(e).__name__}: {str(e)}")
+                job.update(status=FAILED, error=str(e) or "Parse failed.", error_type=type(e).__name__)
+            job["finished_at"] = time.time()
+            self._save(job)
+        except OSError as e:
+            logging.error(f"Could not store parse job {job['job_id']}: {str(e)}")
+        finally:
+            self._finish()
+
+    def get(self, job_id: str) -> Optional[Dict[str, Any]]:
+        """The stored state of a job, None when it is unknown or expired."""
+        if not job_id.isalnum():
+            return None
+        path = self._path(job_id)
+        try:
+            if time.time() - os.stat(path).st_mtime > self.ttl:
+                os.remove(path)
+                return None
+            with open(path, 'r') as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return None
+
+    def sweep(self) -> None:
+        """Remove expired job files, at most once per SWEEP_INTERVAL."""
+        now = time.time()
+        with self._lock:
+            if now - self._last_sweep < SWEEP_INTERVAL:
+                return
+            self._last_sweep = now
+        try:
+            with os.scandir(self.directory) as entries:
+                for entry in entries:
+                    if entry.name.endswith('.json') and now - entry.stat().st_mtime > self.ttl:
+                        os.remove(entry.path)
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"active": self._active, "submitted": self.submitted, "rejected": self.rejected}
+
+
+def job_response(job: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    What polling a job returns: the parse_log_content result of a finished
+    job with the job's status and timing next to it.
+    """
+    now = time.time()
+    started = job.get("started_at")
+    finished = job.get("finished_at")
+    response = dict(job.get("result") or {})
+    response.update({
+        "job_id": job["job_id"],
+        "status": job["status"],
+        "timing": {
+            "queued_seconds": round((started or now) - job["submitted_at"], 6),
+            "run_seconds": None if started is None else round((finished or now) - started, 6)
+        }
+    })
+    for key in ("error", "error_type"):
+        if key in job:
+            response[key] = job[key]
+    return response
@@ -0,0 +1,178 @@
+"""
+Time-bucketed rollups of stored logs for downsampled dashboards.
+
+Each log keeps per minute, per hour and per day buckets with the line
+count per level, the number of alarms and the count, sum, lowest and
+highest value per gas, classified by the same rules as /parse_log. A
+bucket is named by the timestamp prefix it covers ("2024-07-19 10:05",
+"2024-07-19 10", "2024-07-19"), so buckets sort and compare like the
+timestamps themselves. The rollups are kept in the log catalog and
+updated by every save and update; a time series is then read from the
+buckets alone, whatever the number of lines behind them.
+
+Rollups are computed with NumPy from the sidecar index records, or from
+the batch of appended lines, when there is one, the lines are already
+classified there, and from LogRecords otherwise.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from columnar import NO_GAS, RecordBatch, np, timestamp_numbers
+from rules import ALARM, Classification, CompiledRules, current_rules
+
+# timestamp prefix length of each resolution, finest first
+ROLLUP_RESOLUTIONS = {'minute': 16, 'hour': 13, 'day': 10}
+
+# a YYYYMMDDhhmmss timestamp number divided by this is the bucket of a resolution
+_DIVISORS = {'minute': 100, 'hour': 10000, 'day': 1000000}
+
+# completes a bucket name into the first timestamp it covers
+_TIMESTAMP_FILL = "0000-00-00 00:00:00"
+
+
+class Bucket:
+    """Aggregates of the lines in one bucket, measurements as [count, total, lowest, highest] per gas."""
+
+    def __init__(self, level_counts: Optional[Dict[str, int]] = None, alarms: int = 0,
+                 measurements: Optional[Dict[str, List[float]]] = None):
+        self.level_counts = level_counts or {}
+        self.alarms = alarms
+        self.measurements = measurements or {}
+
+    def add(self, level: str, classification: Optional[Classification]) -> None:
+        self.level_counts[level] = self.level_counts.get(level, 0) + 1
+        if classification is None:
+            return
+        if classification.kind == ALARM:
+            self.alarms += 1
+            return
+        try:
+            value = float(classification.value)
+        except ValueError:
+            # reported by the parse itself, not counted here either
+            return
+        self.add_value(classification.gas, value)
+
+    def add_value(self, gas: str, value: float) -> None:
+        stats = self.measurements.get(gas)
+        if stats is None:
+            self.measurements[gas] = [1, value, value, value]
+        else:
+            stats[0] += 1
+            stats[1] += value
+            stats[2] = min(stats[2], value)
+            stats[3] = max(stats[3], value)
+
+    def merge(self, other: 'Bucket') -> 'Bucket':
+        for level, count in other.level_counts.items():
+            self.level_counts[level] = self.level_counts.get(level, 0) + count
+        self.alarms += other.alarms
+        for gas, (count, total, lowest, highest) in other.measurements.items():
+            stats = self.measurements.get(gas)
+            if stats is None:
+                self.measurements[gas] = [count, total, lowest, highest]
+            else:
+                self.measurements[gas] = [stats[0] + count, stats[1] + total, min(stats[2], lowest),
+                                          max(stats[3], highest)]
+        return self
+
+    def to_dict(self, name: str) -> Dict[str, Any]:
+        return {
+            "start": name + _TIMESTAMP_FILL[len(name):],
+            "log_message_count": dict(self.level_counts),
+            "alarms": self.alarms,
+            "measurements": {gas: {"count": count, "average": total / count, "highest": highest, "lowest": lowest}
+                             for gas, (count, total, lowest, highest) in self.measurements.items()}
+        }
+
+
+class Rollups:
+    """The buckets of a run of records at every resolution, keyed by (resolution, bucket name)."""
+
+    def __init__(self, rules: Optional[CompiledRules] = None):
+        self.rules = rules or current_rules()
+        self.buckets: Dict[Tuple[str, str], Bucket] = {}
+
+    def update(self, records: Iterable) -> 'Rollups':
+        """Add LogRecords. Records go into minute buckets, the coarser ones are merged from those."""
+        (finest, length), *coarser = ROLLUP_RESOLUTIONS.items()
+        minutes: Dict[str, Bucket] = {}
+        classify = self.rules.classify
+        for record in records:
+            name = record.timestamp[:length]
+            bucket = minutes.get(name)
+            if bucket is None:
+                bucket = minutes[name] = Bucket()
+            bucket.add(record.level, classify(record.level, record.message))
+
+        for name, bucket in minutes.items():
+            self._merge((finest, name), bucket)
+            for resolution, coarse_length in coarser:
+                self._merge((resolution, name[:coarse_length]), bucket)
+        return self
+
+    def add_batch(self, batch: RecordBatch) -> 'Rollups':
+        """Add the records of a columnar batch, classified when the batch was built."""
+        return self.add_columns(timestamp_numbers(batch.timestamps), batch.level_codes, batch.alarm_flags,
+                                batch.gas_codes, batch.values, list(batch.gases), batch.log_levels)
+
+    def add_columns(self, timestamps: 'np.ndarray', levels: 'np.ndarray', alarms: 'np.ndarray', gases: 'np.ndarray',
+                    values: 'np.ndarray', gas_names: Sequence[str], log_levels: Sequence[str]) -> 'Rollups':
+        """
+        Add records given as columns, like the sidecar index keeps them:
+        YYYYMMDDhhmmss timestamp numbers, level codes into log_levels, alarm
+        flags, gas codes into gas_names (NO_GAS without a measurement) and values.
+        """
+        measured = gases != NO_GAS
+        finite = measured & np.isfinite(values)
+        level_count, gas_count = len(log_levels), len(gas_names)
+        for resolution, divisor in _DIVISORS.items():
+            keys, rows = np.unique(timestamps // divisor, return_inverse=True)
+            rows = rows.reshape(-1)
+            size = len(keys) * gas_count
+            cells = rows[finite] * gas_count + gases[finite]
+            counts = np.bincount(cells, minlength=size)
+            totals = np.bincount(cells, weights=values[finite], minlength=size)
+            lowest = np.full(size, np.inf)
+            np.minimum.at(lowest, cells, values[finite])
+            highest = np.full(size, -np.inf)
+            np.maximum.at(highest, cells, values[finite])
+
+            level_counts = np.bincount(rows * level_count + levels, minlength=len(keys) * level_count)
+            alarm_counts = np.bincount(rows[alarms], minlength=len(keys)).tolist()
+            buckets = []
+            for row, counts_row in enumerate(level_counts.reshape(-1, level_count).tolist()):
+                buckets.append(Bucket({log_levels[code]: count for code, count in enumerate(counts_row) if count},
+                                      alarm_counts[row]))
+            for cell in np.flatnonzero(counts).tolist():
+                row, gas = divmod(cell, gas_count)
+                buckets[row].measurements[gas_names[gas]] = [int(counts[cell]), float(totals[cell]),
+                                                             float(lowest[cell]), float(highest[cell])]
+            # inf and nan follow Python comparison rules, which NumPy reductions do not
+            for row in np.flatnonzero(measured & ~finite).tolist():
+                buckets[rows[row]].add_value(gas_names[gases[row]], float(values[row]))
+
+            length = ROLLUP_RESOLUTIONS[resolution]
+            for key, bucket in zip(keys.tolist(), buckets):
+                digits = f"{key * divisor:014d}"
+                name = f"{digits[:4]}-{digits[4:6]}-{digits[6:8]} {digits[8:10]}:{digits[10:12]}"[:length]
+                self._merge((resolution, name), bucket, shared=False)
+        return self
+
+    def _merge(self, key: Tuple[str, str], bucket: Bucket, shared: bool = True) -> None:
+        """Add a bucket under key, one that is shared with other keys is copied rather than kept."""
+        existing = self.buckets.get(key)
+        if existing is None:
+            self.buckets[key] = Bucket().merge(bucket) if shared else bucket
+        else:
+            existing.merge(bucket)
+
+
+def bucket_range(resolution: str, start: Optional[str], end: Optional[str]) -> Tuple[str, str]:
+    """
+    Lowest and highest bucket name of a resolution that overlap a from/to
+    window, end matching on its own precision like in_time_window.
+    """
+    length = ROLLUP_RESOLUTIONS[resolution]
+    # '~' sorts after every character of a timestamp
+    return ('' if start is None else start[:length],
+            '~' if end is None else end[:length] + '~')
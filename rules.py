@@ -0,0 +1,208 @@
+"""
+Classification rules for log messages: which messages are alarms and which
+hold a gas measurement, in what format.
+
+The rules are read from a JSON file (CLASSIFICATION_RULES, the built-in
+DEFAULT_RULES while it does not exist) and compiled into one regular
+expression per log level, an alternation of every rule that applies to
+that level. Alarm keywords are folded into a trie shaped expression, so
+dozens of keywords still cost one scan of the message:
+
+    {
+        "alarms": [{"levels": ["WARNING"], "keywords": ["alarm", "threshold exceeded"]}],
+        "measurements": [{"levels": ["MEASUREMENT"],
+                          "pattern": "(?P<gas>.*?)concentration(?:(?:(?!concentration)[^-])*-)*(?P<value>(?:(?!concentration)[^-])*)"}]
+    }
+
+Keywords match anywhere in the message, case-insensitively unless the rule
+sets "case_sensitive". Measurement patterns match from the start of the
+message and name the gas and value with the groups "gas" and "value"; the
+first rule that matches wins, before any alarm keyword. The file is checked for changes at most every
+RULES_RELOAD_SECONDS and a changed file is used from then on. A file that
+fails to load is logged and the rules in use are kept.
+"""
+from typing import Any, Dict, List, NamedTuple, Optional, Sequence, Tuple
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+# environment variable for the rules file or fallback value
+CLASSIFICATION_RULES = os.getenv('CLASSIFICATION_RULES', 'rules.json')
+
+# environment variable for the seconds between checks of the rules file or fallback value
+RULES_RELOAD_SECONDS = int(os.getenv('RULES_RELOAD_SECONDS', 5))
+
+ALARM = 'alarm'
+MEASUREMENT = 'measurement'
+
+DEFAULT_RULES = {
+    "alarms": [{"levels": ["WARNING"], "keywords": ["alarm"]}],
+    "measurements": [{"levels": ["MEASUREMENT"],
+                      # the last "-" field before any second "concentration", like the original split parser
+                      "pattern": "(?P<gas>.*?)concentration(?:(?:(?!concentration)[^-])*-)*"
+                                 "(?P<value>(?:(?!concentration)[^-])*)"}]
+}
+
+
+class Classification(NamedTuple):
+    """What a message is, with the raw gas name and value text of a measurement."""
+    kind: str
+    gas: Optional[str] = None
+    value: Optional[str] = None
+
+
+ALARM_CLASSIFICATION = Classification(ALARM)
+
+
+def _trie_pattern(keywords: List[str]) -> str:
+    """One alternation of the keywords with shared prefixes factored out, e.g. al(?:arm|ert)."""
+    trie: Dict[str, Any] = {}
+    for keyword in keywords:
+        node = trie
+        for character in keyword:
+            node = node.setdefault(character, {})
+        node[''] = {}
+
+    def pattern(node: Dict[str, Any]) -> str:
+        branches = [re.escape(character) + pattern(child) for character, child in node.items() if character]
+        if '' in node:
+            # a keyword ends here, a longer one may continue
+            return f"(?:{'|'.join(branches)})?" if branches else ''
+        return branches[0] if len(branches) == 1 else f"(?:{'|'.join(branches)})"
+
+    return pattern(trie)
+
+
+class CompiledRules:
+    """
+    A rules configuration compiled per log level into one alternation of its
+    measurement patterns and one keyword trie per case sensitivity.
+    """
+
+    def __init__(self, config: Dict[str, Any]):
+        self.fingerprint = hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+        formats: Dict[str, List[str]] = {}
+        # alternative of each measurement rule to its gas and value groups
+        self._groups: Dict[str, Tuple[str, str]] = {}
+        # case-insensitive keywords are searched in the lowercased message, a plain literal search
+        keywords: Dict[Tuple[str, bool], List[str]] = {}
+
+        for number, rule in enumerate(config.get("measurements", [])):
+            name = f"m{number}"
+            pattern = rule["pattern"]
+            if not {"gas", "value"} <= set(re.compile(pattern).groupindex):
+                raise ValueError(f"Measurement pattern {pattern!r} needs the groups 'gas' and 'value'.")
+            for group in ("gas", "value"):
+                pattern = pattern.replace(f"(?P<{group}>", f"(?P<{name}_{group}>")
+                pattern = pattern.replace(f"(?P={group})", f"(?P={name}_{group})")
+            for level in rule.get("levels", ["MEASUREMENT"]):
+                formats.setdefault(level, []).append(f"(?P<{name}>{pattern})")
+            self._groups[name] = (f"{name}_gas", f"{name}_value")
+
+        for rule in config.get("alarms", []):
+            lowercase = not rule.get("case_sensitive", False)
+            for level in rule.get("levels", ["WARNING"]):
+                keywords.setdefault((level, lowercase), []).extend(
+                    keyword.lower() if lowercase else keyword for keyword in rule["keywords"])
+
+        self._formats = {level: re.compile('|'.join(patterns), re.DOTALL).match
+                         for level, patterns in formats.items()}
+        self._keywords: Dict[str, List[Tuple[Any, bool]]] = {}
+        for (level, lowercase), words in keywords.items():
+            self._keywords.setdefault(level, []).append((re.compile(_trie_pattern(words)).search, lowercase))
+        self.levels = frozenset(self._formats) | frozenset(self._keywords)
+
+    def classify(self, level: str, message: str) -> Optional[Classification]:
+        """Measurement, alarm or None. A message that matches a measurement format is a measurement."""
+        formats = self._formats.get(level)
+        if formats is not None:
+            match = formats(message)
+            if match is not None:
+                gas, value = match.group(*self._groups[match.lastgroup])
+                return Classification(MEASUREMENT, gas.strip(), value.strip())
+        for search, lowercase in self._keywords.get(level, ()):
+            if search(message.lower() if lowercase else message):
+                return ALARM_CLASSIFICATION
+        return None
+
+
+    def classify_batch(self, level: str, messages: Sequence[str]) -> Tuple[List[int], List[Tuple[int, str, str]]]:
+        """
+        Classify many messages of one level at once, like classify: the
+        indexes of the alarms and (index, gas, value) of the measurements.
+        """
+        alarms: List[int] = []
+        measurements: List[Tuple[int, str, str]] = []
+        unmatched: Sequence[int] = range(len(messages))
+        formats = self._formats.get(level)
+        if formats is not None:
+            groups = self._groups
+            unmatched = []
+            for index, match in enumerate(map(formats, messages)):
+                if match is None:
+                    unmatched.append(index)
+                else:
+                    gas, value = match.group(*groups[match.lastgroup])
+                    measurements.append((index, gas.strip(), value.strip()))
+        for search, lowercase in self._keywords.get(level, ()):
+            found = [index for index in unmatched
+                     if search(messages[index].lower() if lowercase else messages[index])]
+            alarms.extend(found)
+            if found:
+                unmatched = sorted(set(unmatched) - set(found))
+        alarms.sort()
+        return alarms, measurements
+
+
+class RuleSet:
+    """The rules in use, reloaded when the rules file changes."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._rules = CompiledRules(DEFAULT_RULES)
+        self._stamp: Optional[Tuple[int, int]] = None
+        self._checked = float('-inf')
+
+    def current(self) -> CompiledRules:
+        if time.monotonic() - self._checked >= RULES_RELOAD_SECONDS:
+            self.reload()
+        return self._rules
+
+    def reload(self) -> CompiledRules:
+        """Compile the rules file again if it changed since it was last read."""
+        with self._lock:
+            self._checked = time.monotonic()
+            try:
+                stat = os.stat(self.path)
+                stamp = (stat.st_ino, stat.st_mtime_ns)
+            except FileNotFoundError:
+                stamp = None
+            if stamp == self._stamp:
+                return self._rules
+            try:
+                if stamp is None:
+                    rules = CompiledRules(DEFAULT_RULES)
+                else:
+                    with open(self.path, 'r') as file:
+                        rules = CompiledRules(json.load(file))
+            except (OSError, ValueError, KeyError, TypeError, re.error) as e:
+                logging.error(f"Could not load classification rules from {self.path}: {str(e)}")
+                self._stamp = stamp
+                return self._rules
+            if rules.fingerprint != self._rules.fingerprint:
+                logging.info(f"Classification rules {rules.fingerprint} loaded from {self.path}.")
+            self._rules = rules
+            self._stamp = stamp
+            return rules
+
+
+rule_set = RuleSet(CLASSIFICATION_RULES)
+
+
+def current_rules() -> CompiledRules:
+    return rule_set.current()
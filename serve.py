@@ -0,0 +1,76 @@
+"""
+Run the Flask app on Linux with a pre-fork, multi-worker gunicorn server.
+This is the production counterpart of flask_service.py on Windows.
+
+Usage: python serve.py [--bind 0.0.0.0:5000] [--workers 9] [--threads 4] [--max-requests 10000]
+                       [--worker-class sync]
+
+Signals sent to the master process:
+ - HUP: graceful reload, new workers are started before the old ones stop
+ - TERM: graceful shutdown, in-flight requests finish within --graceful-timeout
+ - INT, QUIT: immediate shutdown
+ - TTIN, TTOU: add or remove one worker
+"""
+import argparse
+import multiprocessing
+import os
+
+from gunicorn.app.base import BaseApplication
+
+import parallel_parse
+
+
+def worker_exit(server, worker):
+    # parse worker processes belong to the request worker that started them
+    parallel_parse.shutdown()
+
+
+class LogAPIServer(BaseApplication):
+    def __init__(self, options: dict):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        from app import app
+        return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--bind', default=os.getenv('SERVER_BIND', '0.0.0.0:5000'))
+    parser.add_argument('--workers', type=int,
+                        default=int(os.getenv('SERVER_WORKERS', multiprocessing.cpu_count() * 2 + 1)))
+    parser.add_argument('--threads', type=int, default=int(os.getenv('SERVER_THREADS', 4)),
+                        help="threads per worker, more than one selects the gthread worker")
+    parser.add_argument('--worker-class', default=os.getenv('SERVER_WORKER_CLASS'),
+                        help="gunicorn worker class, by default gthread with more than one thread, else sync")
+    parser.add_argument('--max-requests', type=int, default=int(os.getenv('SERVER_MAX_REQUESTS', 10000)),
+                        help="recycle a worker after this many requests, 0 disables recycling")
+    parser.add_argument('--max-requests-jitter', type=int, default=int(os.getenv('SERVER_MAX_REQUESTS_JITTER', 500)))
+    parser.add_argument('--timeout', type=int, default=int(os.getenv('SERVER_TIMEOUT', 120)))
+    parser.add_argument('--graceful-timeout', type=int, default=int(os.getenv('SERVER_GRACEFUL_TIMEOUT', 30)))
+    parser.add_argument('--access-log', default=os.getenv('SERVER_ACCESS_LOG'))
+    return parser.parse_args(argv)
+
+
+def build_options(args: argparse.Namespace) -> dict:
+    return {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': args.worker_class or ('gthread' if args.threads > 1 else 'sync'),
+        'max_requests': args.max_requests,
+        'max_requests_jitter': args.max_requests_jitter,
+        'timeout': args.timeout,
+        'graceful_timeout': args.graceful_timeout,
+        'accesslog': args.access_log,
+        'worker_exit': worker_exit,
+    }
+
+
+if __name__ == '__main__':
+    LogAPIServer(build_options(parse_args())).run()
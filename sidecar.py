@@ -0,0 +1,330 @@
+"""
+Binary sidecar index kept next to each stored log (log_<id>.log.idx).
+
+A sidecar holds one fixed-width record per valid line (timestamp, level,
+flags, gas code and measurement value) followed by a small JSON footer
+with the totals of the whole log: level counts, per gas statistics with
+their quantile sketches and the gas dictionary. A full /parse_log/<id> is
+answered from the footer and a scan of the alarm flags, a time window
+filters the memory-mapped records; neither tokenizes any text.
+
+Timestamps are stored as the number YYYYMMDDhhmmss, so they compare the
+same way the timestamp strings do. The footer also records the identity
+of the log it was built from, a missing, stale or damaged sidecar is
+rebuilt from the log on first use. Sidecars need NumPy.
+"""
+from typing import Any, Dict, List, Optional
+import json
+import logging
+import os
+import struct
+import threading
+
+from columnar import NO_GAS, RecordBatch, grouped_measurements, level_counts, np, timestamp_numbers
+from log_files import FileLock
+from parse_cache import FileIdentity
+from rollups import Rollups
+from rules import current_rules
+from stats import MeasurementStats
+from utils import LOG_LEVELS, LogManager, LogRecord, LogSummary, RejectedLines
+
+# environment variable to switch sidecar indexes off or fallback value
+SIDECAR_INDEX = np is not None and os.getenv('SIDECAR_INDEX', 'true').lower() == 'true'
+
+SIDECAR_SUFFIX = '.idx'
+SIDECAR_VERSION = 2
+
+# the file ends with the footer length and this magic, a torn write leaves neither
+MAGIC = b'LOGIDX01'
+TRAILER = struct.Struct('<I8s')
+
+ALARM_FLAG = 1
+
+RECORD_DTYPE = None if np is None else np.dtype([
+    ('timestamp', '<i8'),
+    ('level', 'u1'),
+    ('flags', 'u1'),
+    ('gas', '<i4'),
+    ('value', '<f8'),
+])
+
+
+def sidecar_path(filename: str) -> str:
+    return filename + SIDECAR_SUFFIX
+
+
+def format_timestamp(number: int) -> str:
+    digits = f"{number:014d}"
+    return f"{digits[:4]}-{digits[4:6]}-{digits[6:8]} {digits[8:10]}:{digits[10:12]}:{digits[12:]}"
+
+
+def bound_number(bound: Optional[str], fill: str) -> Optional[int]:
+    """
+    A from/to bound (a timestamp prefix) as a timestamp number, padded with
+    fill digits: '0' gives the first timestamp it covers, '9' the last.
+    """
+    if bound is None:
+        return None
+    digits = bound.replace('-', '').replace(' ', '').replace(':', '')
+    return int(digits.ljust(14, fill))
+
+
+def _stats_state(stats: MeasurementStats) -> Dict[str, Any]:
+    sketch = stats.sketch
+    return {
+        "count": stats.count,
+        "exact": stats.exact,
+        "nonfinite": stats.nonfinite,
+        "lowest": stats.lowest,
+        "highest": stats.highest,
+        "mean": stats.mean,
+        "m2": stats.m2,
+        "positive": sorted(sketch.positive.items()),
+        "negative": sorted(sketch.negative.items()),
+        "zero": sketch.zero_count
+    }
+
+
+def _stats_from_state(state: Dict[str, Any]) -> MeasurementStats:
+    stats = MeasurementStats.from_moments(state["count"], state["exact"], state["lowest"], state["highest"],
+                                          state["mean"], state["m2"], state["nonfinite"])
+    stats.sketch.add_buckets(dict(state["positive"]), dict(state["negative"]), state["zero"])
+    return stats
+
+
+class SidecarWriter:
+    """Encode batches as sidecar records while keeping the totals for the footer."""
+
+    def __init__(self):
+        self.summary = LogSummary()
+        self.gases: Dict[str, int] = {}
+        self.records = 0
+        self.alarms = 0
+
+    @classmethod
+    def from_footer(cls, footer: Dict[str, Any]) -> 'SidecarWriter':
+        """Continue the totals of an existing sidecar."""
+        writer = cls()
+        writer.summary.log_counts.update(footer["log_counts"])
+        writer.summary.measurements = {gas: _stats_from_state(state) for gas, state in footer["measurements"].items()}
+        writer.gases = {gas: code for code, gas in enumerate(footer["gases"])}
+        writer.records = footer["records"]
+        writer.alarms = footer["alarms"]
+        return writer
+
+    def encode(self, batch: RecordBatch, summary: Optional[LogSummary] = None) -> bytes:
+        """
+        Records of a batch, ready to be written after the previous ones.
+        summary is the batch already aggregated, when the caller has it.
+        """
+        records = np.zeros(len(batch), dtype=RECORD_DTYPE)
+        records['timestamp'] = timestamp_numbers(batch.timestamps)
+        records['level'] = batch.level_codes
+        records['flags'] = batch.alarm_flags * ALARM_FLAG
+        # batch gas codes to sidecar gas codes, the extra last entry maps NO_GAS (-1) to itself
+        codes = [self.gases.setdefault(gas, len(self.gases)) for gas in batch.gases]
+        records['gas'] = np.array(codes + [NO_GAS], dtype=np.int32)[batch.gas_codes]
+        records['value'] = batch.values
+
+        if summary is not None:
+            self.summary.merge(summary)
+        else:
+            self.summary.add_batch(batch)
+        self.records += len(batch)
+        self.alarms += int(np.count_nonzero(batch.alarm_flags))
+        return records.tobytes()
+
+    def footer(self, identity: FileIdentity) -> bytes:
+        body = json.dumps({
+            "version": SIDECAR_VERSION,
+            "source": list(identity),
+            "rules": current_rules().fingerprint,
+            "records": self.records,
+            "alarms": self.alarms,
+            "log_counts": self.summary.log_counts,
+            "gases": list(self.gases),
+            "measurements": {gas: _stats_state(stats) for gas, stats in self.summary.measurements.items()}
+        }).encode()
+        return body + TRAILER.pack(len(body), MAGIC)
+
+
+class Sidecar:
+    """A memory-mapped sidecar that matches its log file."""
+
+    def __init__(self, path: str, footer: Dict[str, Any], records: 'np.ndarray'):
+        self.path = path
+        self.footer = footer
+        self.records = records
+        self.gases: List[str] = footer["gases"]
+
+    @property
+    def records_size(self) -> int:
+        return self.footer["records"] * RECORD_DTYPE.itemsize
+
+    @classmethod
+    def open(cls, filename: str, identity: Optional[FileIdentity] = None) -> Optional['Sidecar']:
+        """
+        The sidecar of a log, None when it is missing, damaged, was built
+        from a different version of the log than identity (the current one
+        when not given) or with other classification rules.
+        """
+        identity = identity or FileIdentity.of(filename)
+        path = sidecar_path(filename)
+        try:
+            with open(path, 'rb') as file:
+                size = file.seek(0, os.SEEK_END)
+                if size < TRAILER.size:
+                    return None
+                file.seek(size - TRAILER.size)
+                footer_size, magic = TRAILER.unpack(file.read(TRAILER.size))
+                if magic != MAGIC or footer_size > size - TRAILER.size:
+                    return None
+                file.seek(size - TRAILER.size - footer_size)
+                footer = json.loads(file.read(footer_size))
+        except (OSError, ValueError):
+            return None
+
+        count = footer.get("records", -1)
+        if (footer.get("version") != SIDECAR_VERSION or identity is None
+                or tuple(footer.get("source", ())) != identity
+                or footer.get("rules") != current_rules().fingerprint
+                or count * RECORD_DTYPE.itemsize != size - TRAILER.size - footer_size):
+            return None
+        if count == 0:
+            return cls(path, footer, np.zeros(0, dtype=RECORD_DTYPE))
+        try:
+            return cls(path, footer, np.memmap(path, dtype=RECORD_DTYPE, mode='r', shape=(count,)))
+        except (OSError, ValueError):
+            # replaced or truncated since the footer was read
+            return None
+
+    def summary(self, start: Optional[str] = None, end: Optional[str] = None) -> LogSummary:
+        """
+        Summary of the whole log from the footer totals, or of the lines
+        between two time bounds (see log_index.in_time_window) from the records.
+        """
+        summary = LogSummary()
+        records = self.records
+        if start is None and end is None:
+            summary.log_counts.update(self.footer["log_counts"])
+            summary.measurements = {gas: _stats_from_state(state)
+                                    for gas, state in self.footer["measurements"].items()}
+        else:
+            timestamps = records['timestamp']
+            selected = np.ones(len(records), dtype=bool)
+            if start is not None:
+                selected &= timestamps >= bound_number(start, '0')
+            if end is not None:
+                selected &= timestamps <= bound_number(end, '9')
+            records = records[selected]
+            summary.log_counts.update(level_counts(records['level'], LOG_LEVELS))
+            summary.measurements = grouped_measurements(records['gas'], records['value'], self.gases)
+
+        alarm_rows = np.flatnonzero(records['flags'] & ALARM_FLAG)
+        summary.alarms = [format_timestamp(number) for number in records['timestamp'][alarm_rows].tolist()]
+        return summary
+
+    def rollups(self, first: int = 0) -> Rollups:
+        """Rollups of the records from row first on, the last rows being the latest appended lines."""
+        records = self.records[first:]
+        return Rollups().add_columns(records['timestamp'], records['level'], (records['flags'] & ALARM_FLAG) != 0,
+                                     records['gas'], records['value'], self.gases, LOG_LEVELS)
+
+
+def _temp_path(path: str) -> str:
+    return f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def build(filename: str, records: Optional[List[LogRecord]] = None) -> None:
+    """
+    Write the sidecar of a log. records are the lines of the whole log when
+    the caller already has them tokenized, otherwise the log is read.
+    """
+    if not SIDECAR_INDEX:
+        return
+    try:
+        # writes and appends to the sidecar hold the log's lock as well
+        with FileLock(filename):
+            _build(filename, records)
+    except FileNotFoundError:
+        pass
+
+
+def _build(filename: str, records: Optional[List[LogRecord]]) -> None:
+    identity = FileIdentity.of(filename)
+    if identity is None:
+        return
+    if records is not None:
+        batches = [RecordBatch.from_records(records, LOG_LEVELS)]
+    else:
+        batches = LogManager.iter_batches(LogManager.read_log_lines(filename), RejectedLines())
+
+    path = sidecar_path(filename)
+    temp_path = _temp_path(path)
+    writer = SidecarWriter()
+    try:
+        with open(temp_path, 'wb') as file:
+            for batch in batches:
+                file.write(writer.encode(batch))
+            file.write(writer.footer(identity))
+        os.replace(temp_path, path)
+    except OSError as e:
+        logging.warning(f"Could not write sidecar index {path}: {str(e)}")
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def append(filename: str, previous: Optional[FileIdentity], current: Optional[FileIdentity],
+           batch: RecordBatch, summary: LogSummary, size: int) -> None:
+    """
+    Add the batch of appended records, with their summary and the size in
+    bytes of their lines, to the sidecar in place; call it while holding the
+    log's lock. The sidecar is rebuilt instead when it did not match the log
+    right before the append, or the log grew by more than the appended lines.
+    """
+    if not SIDECAR_INDEX:
+        return
+    sidecar = Sidecar.open(filename, previous) if previous is not None else None
+    if sidecar is None or current is None or current.size != previous.size + size:
+        build(filename)
+        return
+
+    writer = SidecarWriter.from_footer(sidecar.footer)
+    records_size = sidecar.records_size
+    path = sidecar.path
+    del sidecar
+    data = writer.encode(batch, summary) + writer.footer(current)
+    try:
+        with open(path, 'r+b') as file:
+            # the old footer is overwritten, readers only map the records before it
+            file.seek(records_size)
+            file.write(data)
+            file.truncate()
+    except OSError as e:
+        logging.warning(f"Could not append to sidecar index {path}: {str(e)}")
+        remove(filename)
+
+
+def load(filename: str) -> Optional[Sidecar]:
+    """The up-to-date sidecar of a log, rebuilt when needed. None when sidecars are off or the log is missing."""
+    if not SIDECAR_INDEX:
+        return None
+    sidecar = Sidecar.open(filename)
+    if sidecar is not None:
+        return sidecar
+    try:
+        with FileLock(filename):
+            # rebuilt or appended to by another writer while waiting for the lock
+            sidecar = Sidecar.open(filename)
+            if sidecar is None:
+                _build(filename, None)
+                sidecar = Sidecar.open(filename)
+    except FileNotFoundError:
+        return None
+    return sidecar
+
+
+def remove(filename: str) -> None:
+    path = sidecar_path(filename)
+    if os.path.exists(path):
+        os.remove(path)
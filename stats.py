@@ -0,0 +1,199 @@
+import math
+from typing import Dict, Optional
+
+# finite values are summed exactly, as integer multiples of the smallest float 2**-EXACT_SHIFT
+EXACT_SHIFT = 1074
+
+
+def exact_units(value: float) -> int:
+    """A finite float as an exact integer number of 2**-EXACT_SHIFT units."""
+    numerator, denominator = value.as_integer_ratio()
+    return numerator << (EXACT_SHIFT + 1 - denominator.bit_length())
+
+
+class QuantileSketch:
+    """
+    Bounded-size, mergeable quantile sketch. Values are counted in
+    logarithmic buckets, so every estimate is within relative_accuracy
+    of a real value (the DDSketch approach).
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 2048):
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive: Dict[int, int] = {}
+        self.negative: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+
+    def _key(self, value: float) -> int:
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, key: int) -> float:
+        return 2 * self.gamma ** key / (self.gamma + 1)
+
+    def add(self, value: float) -> None:
+        if not math.isfinite(value):
+            return
+        if value > 1e-9:
+            key = self._key(value)
+            self.positive[key] = self.positive.get(key, 0) + 1
+        elif value < -1e-9:
+            key = self._key(-value)
+            self.negative[key] = self.negative.get(key, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+        if len(self.positive) + len(self.negative) > self.max_buckets:
+            self._collapse()
+
+    def add_buckets(self, positive: Dict[int, int], negative: Dict[int, int], zero_count: int) -> None:
+        """Add bucket counts that were computed elsewhere, e.g. vectorized with _key's formula."""
+        for key, count in positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zero_count += zero_count
+        self.count += sum(positive.values()) + sum(negative.values()) + zero_count
+        self._collapse()
+
+    def merge(self, other: 'QuantileSketch') -> 'QuantileSketch':
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge quantile sketches with different accuracy.")
+        for key, count in other.positive.items():
+            self.positive[key] = self.positive.get(key, 0) + count
+        for key, count in other.negative.items():
+            self.negative[key] = self.negative.get(key, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self._collapse()
+        return self
+
+    def _collapse(self) -> None:
+        # fold the buckets closest to zero together, keeping the tails accurate
+        while len(self.positive) + len(self.negative) > self.max_buckets:
+            store = self.positive if len(self.positive) >= len(self.negative) else self.negative
+            lowest, second = sorted(store)[:2]
+            store[second] += store.pop(lowest)
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Estimate the q-th quantile (0 <= q <= 1), None when empty."""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for key in sorted(self.negative, reverse=True):
+            seen += self.negative[key]
+            if seen > rank:
+                return -self._value(key)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for key in sorted(self.positive):
+            seen += self.positive[key]
+            if seen > rank:
+                return self._value(key)
+        return self._value(max(self.positive))
+
+
+class MeasurementStats:
+    """
+    Running statistics of one measurement series: count, sum, min, max,
+    Welford mean/variance and a quantile sketch. Two instances can be
+    merged, so partial results from chunks or files combine cheaply. The
+    sum is kept exactly, so it comes out like math.fsum of all values
+    whatever batches and merges they went through.
+    """
+    __slots__ = ('count', 'exact', 'nonfinite', 'lowest', 'highest', 'mean', 'm2', 'sketch')
+
+    def __init__(self):
+        self.count = 0
+        # sum of the finite values in exact units and of the others (inf, -inf, nan) as a float
+        self.exact = 0
+        self.nonfinite = 0.0
+        self.lowest: Optional[float] = None
+        self.highest: Optional[float] = None
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sketch = QuantileSketch()
+
+    @classmethod
+    def from_moments(cls, count: int, exact: int, lowest: float, highest: float,
+                     mean: float, m2: float, nonfinite: float = 0.0) -> 'MeasurementStats':
+        """Statistics of a series aggregated elsewhere, the sketch is left for the caller to fill."""
+        stats = cls()
+        stats.count = count
+        stats.exact = exact
+        stats.nonfinite = nonfinite
+        stats.lowest = lowest
+        stats.highest = highest
+        stats.mean = mean
+        stats.m2 = m2
+        return stats
+
+    def add(self, value: float) -> None:
+        self.count += 1
+        if math.isfinite(value):
+            self.exact += exact_units(value)
+        else:
+            self.nonfinite += value
+        if self.lowest is None or value < self.lowest:
+            self.lowest = value
+        if self.highest is None or value > self.highest:
+            self.highest = value
+        delta = value - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (value - self.mean)
+        self.sketch.add(value)
+
+    def merge(self, other: 'MeasurementStats') -> 'MeasurementStats':
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.lowest, self.highest = other.lowest, other.highest
+        else:
+            self.lowest = min(self.lowest, other.lowest)
+            self.highest = max(self.highest, other.highest)
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.count = count
+        self.exact += other.exact
+        self.nonfinite += other.nonfinite
+        self.sketch.merge(other.sketch)
+        return self
+
+    @property
+    def total(self) -> float:
+        """Sum of the values, correctly rounded."""
+        if self.nonfinite != 0:
+            # inf, -inf or nan, whatever the finite values add up to
+            return self.nonfinite
+        try:
+            return self.exact / (1 << EXACT_SHIFT)
+        except OverflowError:
+            return math.copysign(math.inf, self.exact)
+
+    @property
+    def variance(self) -> Optional[float]:
+        """Population variance, None when empty."""
+        return self.m2 / self.count if self.count else None
+
+    def to_dict(self, percentiles: bool = False) -> Dict[str, Optional[float]]:
+        result = {
+            "average": self.total / self.count if self.count else None,
+            "highest": self.highest,
+            "lowest": self.lowest
+        }
+        if percentiles:
+            result.update({
+                "count": self.count,
+                "stddev": math.sqrt(self.variance) if self.count else None,
+                "p50": self.sketch.quantile(0.50),
+                "p95": self.sketch.quantile(0.95),
+                "p99": self.sketch.quantile(0.99)
+            })
+        return result
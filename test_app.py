@@ -1,8 +1,35 @@
 import unittest
+import gzip
+import io
 import json
+import logging
+import math
 import os
-from app import app
-from utils import LogManager, LOG_DIRECTORY
+import queue
+import random
+import shutil
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+from app import app, job_queue, parse_cache, tail_snapshot
+import metrics
+from utils import LogManager, LogIdAllocator, LogSummary, RejectedLines, LOG_DIRECTORY, LOG_LEVELS
+from benchmark import compare_results, generate_lines
+from app_logging import BoundedQueueHandler, RateLimitFilter, configure_logging
+from stats import MeasurementStats, QuantileSketch, exact_units
+from log_index import LineIndex, find_time_window, is_marked_ordered
+import columnar
+import parallel_parse
+import sidecar
+from log_files import FileLock, GroupCommit, append_to_file, remove_lock
+from log_layout import log_path
+import live_tail
+from live_tail import TailHub
+from rules import ALARM, DEFAULT_RULES, MEASUREMENT, Classification, CompiledRules, RuleSet
+from rollups import ROLLUP_RESOLUTIONS, Rollups, bucket_range
 
 
 class FlaskAPITests(unittest.TestCase):
@@ -16,9 +43,8 @@ class FlaskAPITests(unittest.TestCase):
             os.makedirs(self.test_log_dir)
 
     def tearDown(self):
-        for file in os.listdir(self.test_log_dir):
-            os.remove(os.path.join(self.test_log_dir, file))
-        os.rmdir(self.test_log_dir)
+        # logs saved through the API are in shard directories
+        shutil.rmtree(self.test_log_dir)
 
     def test_get_log_success(self):
         with open(f"{self.test_log_dir}/log_1.log", 'w') as f:
@@ -122,22 +148,76 @@ class FlaskAPITests(unittest.TestCase):
         self.assertIn('measurements', data)
         self.assertIn('alarms', data)
 
+    def test_parse_stored_log_matches_inline(self):
+        log_content = ("[2024-07-19 10:00:00] INFO: System started\n"
+                       "Invalid log\n"
+                       "[2024-07-19 10:03:00] MEASUREMENT: o2 concentration - 25\n"
+                       "[2024-07-19 10:04:00] WARNING: Going to o2 alarm\n")
+        with open(f"{self.test_log_dir}/log_1.log", 'w') as f:
+            f.write(log_content)
+
+        stored = self.app.post('/parse_log/1')
+        inline = self.app.post('/parse_log', json={'content': log_content})
+        self.assertEqual(stored.status_code, 200)
+        self.assertEqual(json.loads(stored.data), json.loads(inline.data))
+
+    def test_read_log_lines_single_line_file(self):
+        content = "[2024-07-19 10:00:00] INFO: Test[2024-07-19 10:01:00] ERROR: Another test"
+        with open(f"{self.test_log_dir}/log_1.log", 'w') as f:
+            f.write(content)
+
+        lines = list(LogManager.read_log_lines(f"{self.test_log_dir}/log_1.log"))
+        self.assertEqual(lines, LogManager.request_body_formatting(content).split('\n'))
+
     def test_parse_log_invalid_content(self):
         response = self.app.post('/parse_log', json={'content': "Invalid log"})
         self.assertEqual(response.status_code, 400)
 
-    def test_get_next_id(self):
-        for i in range(1, 4):
-            open(f"{self.test_log_dir}/log_{i}.log", 'w').close()
+    def test_save_log_write_failure_releases_id(self):
+        real_open = open
+
+        def failing_open(file, mode='r', *args, **kwargs):
+            if 'w' in mode and os.path.basename(str(file)).startswith('log_'):
+                raise OSError("No space left on device")
+            return real_open(file, mode, *args, **kwargs)
 
-        self.assertEqual(LogManager.get_next_id(), 4)
+        with mock.patch('builtins.open', failing_open):
+            response = self.app.post('/save_log', json={'content': "[2024-07-19 10:00:00] INFO: Test log"})
+        self.assertEqual(response.status_code, 500)
+        self.assertFalse([name for _, _, names in os.walk(self.test_log_dir)
+                          for name in names if name.startswith('log_') and name.endswith('.log')])
 
-    def test_get_highest_log_id(self):
-        open(f"{self.test_log_dir}/log_1.log", 'w').close()
-        open(f"{self.test_log_dir}/log_5.log", 'w').close()
-        open(f"{self.test_log_dir}/log_3.log", 'w').close()
+    def test_allocator_skips_existing_files(self):
+        allocator = LogIdAllocator(self.test_log_dir)
+        open(f"{self.test_log_dir}/log_{allocator.reconcile()}.log", 'w').close()
 
-        self.assertEqual(LogManager.get_highest_log_id(), 6)
+        new_id = allocator.allocate()
+        self.assertTrue(os.path.exists(log_path(self.test_log_dir, new_id)))
+        self.assertEqual(allocator.allocate(), new_id + 1)
+
+    def test_allocator_reconciles_from_disk(self):
+        open(f"{self.test_log_dir}/log_7.log", 'w').close()
+        self.assertEqual(LogIdAllocator(self.test_log_dir).allocate(), 8)
+
+        # a fresh allocator picks up the persisted counter
+        self.assertEqual(LogIdAllocator(self.test_log_dir).allocate(), 9)
+
+    def test_allocator_concurrent_ids_unique(self):
+        allocators = [LogIdAllocator(self.test_log_dir) for _ in range(2)]
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            ids = list(executor.map(lambda i: allocators[i % 2].allocate(), range(50)))
+
+        self.assertEqual(len(set(ids)), 50)
+
+    def test_save_log_does_not_overwrite(self):
+        first = self.app.post('/save_log', json={'content': "[2024-07-19 10:00:00] INFO: First"})
+        second = self.app.post('/save_log', json={'content': "[2024-07-19 10:00:00] INFO: Second"})
+        self.assertNotEqual(json.loads(first.data)['id'], json.loads(second.data)['id'])
+
+    def test_health(self):
+        response = self.app.get('/health')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["status"], "ok")
 
     def test_request_body_formatting(self):
         input_body = "[2024-07-19 10:00:00] INFO: Test[2024-07-19 10:01:00] ERROR: Another test"
@@ -156,10 +236,54 @@ class FlaskAPITests(unittest.TestCase):
         invalid_entry = "[2024-07-19 10:00:00] INVALID: Wrong level"
         self.assertFalse(LogManager.validate_log_entry(invalid_entry))
 
+    def test_validate_log_entry_unpadded_timestamp(self):
+        # timestamps must be zero-padded, so they compare and index as fixed-width strings
+        for entry in ["[2024-7-19 10:00:00] INFO: Unpadded month", "[2024-07-19 9:00:00] INFO: Unpadded hour"]:
+            self.assertFalse(LogManager.validate_log_entry(entry))
+
+        content = "[2024-7-19 10:00:00] INFO: Unpadded month\n[2024-07-19 10:01:00] INFO: Padded"
+        new_id = json.loads(self.app.post('/save_log', json={'content': content}).data)['id']
+        data = json.loads(self.app.get(f'/get_log/{new_id}').data)
+        self.assertEqual(data['content'].splitlines(), ["[2024-07-19 10:01:00] INFO: Padded"])
+
     def test_validate_log_entry_malformed(self):
         malformed_entry = "This is not a valid log entry"
         self.assertFalse(LogManager.validate_log_entry(malformed_entry))
 
+    def test_validate_log_entry_reports_once(self):
+        rejected_lines = RejectedLines()
+        with self.assertLogs(level=logging.ERROR) as logs:
+            for entry in ["Invalid log", "[2024-07-19 10:00:00] INFO: Started", "Another invalid log"]:
+                LogManager.validate_log_entry(entry, rejected_lines)
+            self.assertEqual(rejected_lines.samples, ["Invalid log", "Another invalid log"])
+            rejected_lines.report()
+        self.assertEqual(len(logs.records), 1)
+        self.assertIn("failed for 2 entries", logs.output[0])
+
+    def test_tokenize_log_entry(self):
+        record = LogManager.tokenize_log_entry("[2024-07-19 10:00:00] MEASUREMENT: o2 concentration - 25")
+        self.assertEqual(record.timestamp, "2024-07-19 10:00:00")
+        self.assertEqual(record.level, "MEASUREMENT")
+        self.assertEqual(record.message, "o2 concentration - 25")
+
+    def test_tokenize_log_entry_calendar_dates(self):
+        self.assertIsNotNone(LogManager.tokenize_log_entry("[2024-02-29 10:00:00] INFO: Leap day"))
+        self.assertIsNone(LogManager.tokenize_log_entry("[2023-02-29 10:00:00] INFO: Not a leap year"))
+        self.assertIsNone(LogManager.tokenize_log_entry("[2024-04-31 10:00:00] INFO: No such day"))
+
+    def test_tokenize_lines_drops_invalid(self):
+        lines = ["[2024-07-19 10:00:00] INFO: Valid", "Invalid log", ""]
+        records = LogManager.tokenize_lines(lines)
+        self.assertEqual([record.line for record in records], ["[2024-07-19 10:00:00] INFO: Valid"])
+
+    def test_tokenize_lines_logs_one_summary(self):
+        lines = ["Invalid log"] * 500 + ["[2024-07-19 10:00:00] INFO: Valid"]
+        with self.assertLogs(level='ERROR') as captured:
+            LogManager.tokenize_lines(lines)
+        self.assertEqual(len(captured.records), 1)
+        self.assertIn("500 entries", captured.output[0])
+        self.assertIn("Invalid log", captured.output[0])
+
     def test_parse_log_content(self):
         log_data = [
             "[2024-07-19 10:00:00] INFO: System started",
@@ -245,6 +369,1016 @@ class FlaskAPITests(unittest.TestCase):
         self.assertEqual(result["log_message_count"]["MEASUREMENT"], 1)
         self.assertEqual(result["measurements"], {})
 
+    def test_parse_log_percentiles(self):
+        log_content = "\n".join(f"[2024-07-19 10:00:{i:02d}] MEASUREMENT: o2 concentration - {i + 1}"
+                                for i in range(50))
+        response = self.app.post('/parse_log?percentiles=true', json={'content': log_content})
+        o2 = json.loads(response.data)["measurements"]["o2"]
+        self.assertEqual(o2["count"], 50)
+        self.assertAlmostEqual(o2["p50"], 25, delta=0.5)
+        self.assertAlmostEqual(o2["p99"], 49, delta=0.5)
+
+    def test_parse_log_cache_hit(self):
+        with open(f"{self.test_log_dir}/log_1.log", 'w') as f:
+            f.write("[2024-07-19 10:00:00] INFO: First log line\n")
+
+        first = self.app.post('/parse_log/1')
+        hits = parse_cache.hits
+        second = self.app.post('/parse_log/1')
+        self.assertEqual(parse_cache.hits, hits + 1)
+        self.assertEqual(first.data, second.data)
+
+        stats = json.loads(self.app.get('/cache_stats').data)
+        self.assertEqual(stats["hits"], parse_cache.hits)
+
+    def test_parse_log_cache_append(self):
+        with open(f"{self.test_log_dir}/log_1.log", 'w') as f:
+            f.write("[2024-07-19 10:00:00] MEASUREMENT: o2 concentration - 20\n")
+        self.app.post('/parse_log/1')
+
+        self.app.put('/update_log/1?append=true', json={'content': (
+            "[2024-07-19 10:01:00] MEASUREMENT: o2 concentration - 22\n"
+            "[2024-07-19 10:02:00] WARNING: o2 alarm\n")})
+        misses = parse_cache.misses
+        data = json.loads(self.app.post('/parse_log/1').data)
+
+        self.assertEqual(parse_cache.misses, misses)
+        self.assertEqual(data["log_message_count"]["MEASUREMENT"], 2)
+        self.assertAlmostEqual(data["measurements"]["o2"]["average"], 21)
+        self.assertEqual(data["alarms"]["timestamps"], ["2024-07-19 10:02:00"])
+
+    def test_parse_log_cache_invalidated(self):
+        with open(f"{self.test_log_dir}/log_1.log", 'w') as f:
+            f.write("[2024-07-19 10:00:00] INFO: First log line\n")
+        self.app.post('/parse_log/1')
+
+        self.app.put('/update_log/1', json={'content': "[2024-07-19 10:01:00] ERROR: Replaced"})
+        data = json.loads(self.app.post('/parse_log/1').data)
+        self.assertEqual(data["log_message_count"]["ERROR"], 1)
+        self.assertEqual(data["log_message_count"]["INFO"], 0)
+
+        self.app.delete('/delete_log/1')
+        self.assertEqual(self.app.post('/parse_log/1').status_code, 404)
+
+    def write_numbered_log(self, count):
+        lines = [f"[2024-07-19 10:00:00] INFO: line {i}\n" for i in range(count)]
+        with open(f"{self.test_log_dir}/log_1.log", 'w') as f:
+            f.writelines(lines)
+        return lines
+
+    def test_get_log_offset_limit(self):
+        lines = self.write_numbered_log(20)
+        response = self.app.get('/get_log/1?offset=5&limit=3')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data["content"], "".join(lines[5:8]))
+        self.assertEqual(data["total_lines"], 20)
+        self.assertEqual(data["lines"], 3)
+
+    def test_get_log_tail(self):
+        lines = self.write_numbered_log(20)
+        data = json.loads(self.app.get('/get_log/1?tail=4').data)
+        self.assertEqual(data["content"], "".join(lines[-4:]))
+        self.assertEqual(data["offset"], 16)
+
+        self.app.put('/update_log/1?append=true', json={'content': "[2024-07-19 10:01:00] INFO: appended"})
+        data = json.loads(self.app.get('/get_log/1?tail=1').data)
+        self.assertEqual(data["content"], "[2024-07-19 10:01:00] INFO: appended\n")
+
+    def test_get_log_invalid_range(self):
+        self.write_numbered_log(2)
+        self.assertEqual(self.app.get('/get_log/1?tail=-1').status_code, 400)
+
+    def test_line_index_small_blocks(self):
+        lines = self.write_numbered_log(200)
+        with mock.patch('log_index.INDEX_BLOCK_SIZE', 50):
+            index = LineIndex(f"{self.test_log_dir}/log_1.log").refresh()
+        self.assertEqual(index.line_count, 200)
+        for start, count in [(0, 1), (37, 10), (150, 60), (199, 1)]:
+            self.assertEqual(b"".join(index.read_lines(start, count)).decode(),
+                             "".join(lines[start:start + count]))
+
+    def write_timed_log(self):
+        lines = []
+        for minute in range(60):
+            lines.append(f"[2024-07-19 10:{minute:02d}:00] INFO: minute {minute}\n")
+            if minute % 7 == 0:
+                lines.append("garbage line\n")
+                lines.append(f"[2024-07-19 10:{minute:02d}:00] WARNING: repeated alarm\n")
+        with open(f"{self.test_log_dir}/log_1.log", 'w') as f:
+            f.writelines(lines)
+        return lines
+
+    def test_find_time_window(self):
+        lines = self.write_timed_log()
+        filename = f"{self.test_log_dir}/log_1.log"
+        with open(filename, 'rb') as f:
+            content = f.read()
+
+        for start, end in [("2024-07-19 10:14:00", "2024-07-19 10:20:00"), (None, "2024-07-19 10:00:00"),
+                           ("2024-07-19 10:59:00", None), ("2024-07-19 11", None), ("2024-07-19 10:3", "2024-07-19 10:3")]:
+            begin, finish = find_time_window(filename, start, end)
+            expected = [line for line in lines if line.startswith('[')
+                        and (start is None or line[1:20] >= start) and (end is None or line[1:20][:len(end)] <= end)]
+            window = [line for line in content[begin:finish].decode().splitlines(keepends=True) if line.startswith('[')]
+            self.assertEqual(window, expected)
+
+    def test_get_log_time_window(self):
+        self.write_timed_log()
+        response = self.app.get('/get_log/1?from=2024-07-19 10:10:00&to=2024-07-19 10:11:00')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["content"],
+                         "[2024-07-19 10:10:00] INFO: minute 10\n[2024-07-19 10:11:00] INFO: minute 11\n")
+        self.assertEqual(self.app.get('/get_log/1?from=yesterday').status_code, 400)
+        self.assertEqual(self.app.get('/get_log/1?from=2024-07-19&tail=1').status_code, 400)
+
+    def test_parse_log_time_window(self):
+        self.write_timed_log()
+        data = json.loads(self.app.post('/parse_log/1?from=2024-07-19T10:00&to=2024-07-19 10:14').data)
+        self.assertEqual(data["log_message_count"]["INFO"], 15)
+        self.assertEqual(data["alarms"]["count"], 3)
+
+    def test_unordered_log_window(self):
+        content = ("[2024-07-19 10:05:00] INFO: late\n"
+                   "[2024-07-19 10:01:00] INFO: early\n"
+                   "[2024-07-19 10:09:00] INFO: latest\n")
+        new_id = json.loads(self.app.post('/save_log', json={'content': content}).data)['id']
+        self.assertFalse(is_marked_ordered(log_path(self.test_log_dir, new_id)))
+
+        data = json.loads(self.app.post(f'/parse_log/{new_id}?from=2024-07-19 10:00&to=2024-07-19 10:02').data)
+        self.assertEqual(data["log_message_count"]["INFO"], 1)
+
+        self.app.put(f'/update_log/{new_id}', json={'content': "[2024-07-19 10:01:00] INFO: ordered"})
+        self.assertTrue(is_marked_ordered(log_path(self.test_log_dir, new_id)))
+
+        self.app.put(f'/update_log/{new_id}?append=true', json={'content': "[2024-07-19 09:00:00] INFO: older"})
+        self.assertFalse(is_marked_ordered(log_path(self.test_log_dir, new_id)))
+
+    def test_external_unordered_log_window(self):
+        content = ("[2024-07-19 12:00:00] INFO: noon\n"
+                   "[2024-07-19 10:00:00] INFO: ten\n"
+                   "[2024-07-19 11:00:00] INFO: eleven\n"
+                   "[2024-07-19 13:00:00] INFO: one\n")
+        with open(f"{self.test_log_dir}/log_1.log", 'w') as f:
+            f.write(content)
+
+        response = self.app.get('/get_log/1?from=2024-07-19T10:00:00&to=2024-07-19T11:00:00')
+        self.assertEqual(json.loads(response.data)['content'],
+                         "[2024-07-19 10:00:00] INFO: ten\n[2024-07-19 11:00:00] INFO: eleven\n")
+
+    def test_preexisting_log_order_recorded(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'log_1.log'), 'w') as f:
+                f.write("[2024-07-19 12:00:00] INFO: noon\n[2024-07-19 10:00:00] INFO: ten\n")
+            with open(os.path.join(directory, 'log_2.log'), 'w') as f:
+                f.write("[2024-07-19 10:00:00] INFO: ten\n[2024-07-19 12:00:00] INFO: noon\n")
+
+            LogManager(directory)
+            self.assertFalse(is_marked_ordered(log_path(directory, 1)))
+            self.assertTrue(is_marked_ordered(log_path(directory, 2)))
+
+    def parse_without_sidecar(self, url):
+        with mock.patch('sidecar.SIDECAR_INDEX', False):
+            parse_cache.invalidate(int(url.split('?')[0].rsplit('/', 1)[1]))
+            return json.loads(self.app.post(url).data)
+
+    @unittest.skipUnless(sidecar.SIDECAR_INDEX, "sidecar indexes need NumPy")
+    def test_sidecar_matches_text_parse(self):
+        content = "\n".join(generate_lines(2000))
+        new_id = json.loads(self.app.post('/save_log', json={'content': content}).data)['id']
+        filename = log_path(self.test_log_dir, new_id)
+        self.assertIsNotNone(sidecar.Sidecar.open(filename))
+
+        self.app.put(f'/update_log/{new_id}?append=true', json={'content': "\n".join(generate_lines(500, seed=1))})
+        self.assertIsNotNone(sidecar.Sidecar.open(filename))
+
+        for query in ['?percentiles=true', '?from=2024-07-19 00:10&to=2024-07-19 00:20', '?to=2024-07-19 00:05']:
+            parse_cache.invalidate(new_id)
+            data = json.loads(self.app.post(f'/parse_log/{new_id}{query}').data)
+            expected = self.parse_without_sidecar(f'/parse_log/{new_id}{query}')
+            self.assertEqual(data["log_message_count"], expected["log_message_count"])
+            self.assertEqual(data["alarms"], expected["alarms"])
+            for gas, stats in expected["measurements"].items():
+                for key, value in stats.items():
+                    self.assertAlmostEqual(data["measurements"][gas][key], value, places=6)
+
+    @unittest.skipUnless(sidecar.SIDECAR_INDEX, "sidecar indexes need NumPy")
+    def test_sidecar_rebuilt_when_stale(self):
+        new_id = json.loads(self.app.post('/save_log', json={
+            'content': "[2024-07-19 10:00:00] MEASUREMENT: o2 concentration - 20"}).data)['id']
+        filename = log_path(self.test_log_dir, new_id)
+        with open(filename, 'a') as f:
+            f.write("[2024-07-19 10:01:00] MEASUREMENT: o2 concentration - 30\n")
+        self.assertIsNone(sidecar.Sidecar.open(filename))
+
+        data = json.loads(self.app.post(f'/parse_log/{new_id}').data)
+        self.assertAlmostEqual(data["measurements"]["o2"]["average"], 25)
+        self.assertEqual(sidecar.Sidecar.open(filename).footer["records"], 2)
+
+        with open(sidecar.sidecar_path(filename), 'r+b') as f:
+            f.truncate(10)
+        parse_cache.invalidate(new_id)
+        self.assertEqual(json.loads(self.app.post(f'/parse_log/{new_id}').data), data)
+
+        self.app.delete(f'/delete_log/{new_id}')
+        self.assertFalse(os.path.exists(sidecar.sidecar_path(filename)))
+
+    @unittest.skipUnless(sidecar.SIDECAR_INDEX, "sidecar indexes need NumPy")
+    def test_sidecar_rebuild_waits_for_writer(self):
+        new_id = json.loads(self.app.post('/save_log', json={
+            'content': "[2024-07-19 10:00:00] MEASUREMENT: o2 concentration - 20"}).data)['id']
+        filename = log_path(self.test_log_dir, new_id)
+        loaded = []
+        with FileLock(filename):
+            # a writer holding the lock may rebuild the sidecar itself
+            sidecar.remove(filename)
+            thread = threading.Thread(target=lambda: loaded.append(sidecar.load(filename)))
+            thread.start()
+            thread.join(0.2)
+            self.assertTrue(thread.is_alive())
+            append_to_file(filename, "[2024-07-19 10:01:00] MEASUREMENT: o2 concentration - 30\n")
+            sidecar.build(filename)
+        thread.join(5)
+        self.assertEqual(loaded[0].footer["records"], 2)
+
+    def test_concurrent_appends_are_not_interleaved(self):
+        new_id = json.loads(self.app.post('/save_log', json={'content': "[2024-07-19 10:00:00] INFO: start"}).data)['id']
+
+        def append(i):
+            content = "\n".join(f"[2024-07-19 10:00:01] INFO: writer {i} line {j}" for j in range(20))
+            return app.test_client().put(f'/update_log/{new_id}?append=true', json={'content': content}).status_code
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            self.assertEqual(set(executor.map(append, range(16))), {200})
+
+        with open(log_path(self.test_log_dir, new_id)) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(len(lines), 1 + 16 * 20)
+        for i in range(16):
+            writer = [line for line in lines if f"writer {i} " in line]
+            self.assertEqual(writer, [f"[2024-07-19 10:00:01] INFO: writer {i} line {j}" for j in range(20)])
+        data = json.loads(self.app.post(f'/parse_log/{new_id}').data)
+        self.assertEqual(data["log_message_count"]["INFO"], 321)
+
+    def test_overwrite_replaces_file(self):
+        new_id = json.loads(self.app.post('/save_log', json={'content': "[2024-07-19 10:00:00] INFO: old"}).data)['id']
+        filename = log_path(self.test_log_dir, new_id)
+        inode = os.stat(filename).st_ino
+        with open(filename) as reader:
+            self.app.put(f'/update_log/{new_id}', json={'content': "[2024-07-19 10:01:00] INFO: new"})
+            # a reader that opened the log before keeps the complete old version
+            self.assertEqual(reader.read(), "[2024-07-19 10:00:00] INFO: old\n")
+
+        self.assertNotEqual(os.stat(filename).st_ino, inode)
+        self.assertFalse([name for name in os.listdir(os.path.dirname(filename)) if name.endswith('.tmp')])
+        self.app.delete(f'/delete_log/{new_id}')
+        self.assertFalse(os.path.exists(filename + '.lock'))
+
+    def test_get_log_conditional(self):
+        new_id = json.loads(self.app.post('/save_log', json={'content': "[2024-07-19 10:00:00] INFO: first"}).data)['id']
+        response = self.app.get(f'/get_log/{new_id}')
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        self.assertTrue(etag.startswith('W/'))
+        self.assertEqual(json.loads(response.data)['content'], "[2024-07-19 10:00:00] INFO: first\n")
+
+        response = self.app.get(f'/get_log/{new_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        response = self.app.get(f'/get_log/{new_id}', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+        parse_etag = self.app.get(f'/parse_log/{new_id}').headers['ETag']
+        self.assertNotEqual(parse_etag, etag)
+        response = self.app.get(f'/parse_log/{new_id}', headers={'If-None-Match': parse_etag})
+        self.assertEqual(response.status_code, 304)
+        # conditional headers are ignored on POST
+        response = self.app.post(f'/parse_log/{new_id}', headers={'If-None-Match': parse_etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)["log_message_count"]["INFO"], 1)
+
+        self.app.put(f'/update_log/{new_id}', json={'content': "[2024-07-19 10:01:00] INFO: second"})
+        response = self.app.get(f'/get_log/{new_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.app.delete(f'/delete_log/{new_id}')
+
+    def test_validators_follow_rules(self):
+        content = "[2024-07-19 10:00:00] WARNING: smoke detected\n[2024-07-19 10:01:00] WARNING: alarm"
+        new_id = json.loads(self.app.post('/save_log', json={'content': content}).data)['id']
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rules.json')
+            with mock.patch('rules.rule_set', RuleSet(path)), mock.patch('rules.RULES_RELOAD_SECONDS', 0):
+                parsed = self.app.get(f'/parse_log/{new_id}')
+                rollups = self.app.get(f'/rollups/{new_id}')
+                self.assertNotIn('Last-Modified', parsed.headers)
+
+                with open(path, 'w') as f:
+                    json.dump({"alarms": [{"keywords": ["alarm", "smoke"]}]}, f)
+                response = self.app.get(f'/parse_log/{new_id}', headers={'If-None-Match': parsed.headers['ETag']})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(json.loads(response.data)["alarms"]["count"], 2)
+                response = self.app.get(f'/rollups/{new_id}', headers={'If-None-Match': rollups.headers['ETag']})
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(json.loads(response.data)["buckets"][0]["alarms"], 2)
+
+    def test_compressed_responses(self):
+        content = "\n".join(f"[2024-07-19 10:00:{second:02d}] MEASUREMENT: CO2 concentration - {second}"
+                            for second in range(60))
+        new_id = json.loads(self.app.post('/save_log', json={'content': content}).data)['id']
+        plain = self.app.get(f'/get_log/{new_id}')
+        self.assertNotIn('Content-Encoding', plain.headers)
+
+        response = self.app.get(f'/get_log/{new_id}', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertEqual(gzip.decompress(response.data), plain.data)
+
+        with mock.patch('app.COMPRESS_MIN_SIZE', 0):
+            response = self.app.post(f'/parse_log/{new_id}', headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(json.loads(zlib.decompress(response.data))['log_message_count']['MEASUREMENT'], 60)
+
+        # small bodies are not worth compressing
+        response = self.app.get('/health', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.app.delete(f'/delete_log/{new_id}')
+
+    def read_event(self, events):
+        """Next SSE event of a stream as (event, data), skipping keep-alive comments."""
+        while True:
+            chunk = next(events).decode()
+            if not chunk.startswith(':'):
+                fields = dict(line.split(': ', 1) for line in chunk.split('\n\n')[0].split('\n'))
+                return fields['event'], json.loads(fields['data'])
+
+    def test_tail_log_streams_appends(self):
+        new_id = json.loads(self.app.post('/save_log', json={'content': "[2024-07-19 10:00:00] INFO: started"}).data)['id']
+        with mock.patch('live_tail.TAIL_POLL_MS', 20), mock.patch('live_tail.TAIL_HEARTBEAT_SECONDS', 1):
+            response = self.app.get(f'/tail_log/{new_id}', buffered=False)
+            self.assertEqual(response.mimetype, 'text/event-stream')
+            events = iter(response.response)
+            event, data = self.read_event(events)
+            self.assertEqual(event, 'snapshot')
+            self.assertEqual(data['log_message_count']['INFO'], 1)
+
+            self.app.put(f'/update_log/{new_id}?append=true', json={'content': (
+                "[2024-07-19 10:01:00] MEASUREMENT: CO2 concentration - 7\n"
+                "[2024-07-19 10:02:00] WARNING: CO2 alarm")})
+            chunk = next(events).decode()
+            while chunk.startswith(':'):
+                chunk = next(events).decode()
+            lines_event, stats_event = [json.loads(part.split('data: ', 1)[1]) for part in chunk.split('\n\n')[:2]]
+            self.assertEqual(lines_event['lines'], ["[2024-07-19 10:01:00] MEASUREMENT: CO2 concentration - 7",
+                                                    "[2024-07-19 10:02:00] WARNING: CO2 alarm"])
+            self.assertEqual(stats_event['alarms'], {"count": 1, "timestamps": ["2024-07-19 10:02:00"]})
+            self.assertEqual(stats_event['measurements']['CO2']['count'], 1)
+            self.assertEqual(stats_event['log_message_count']['INFO'], 1)
+
+            self.app.delete(f'/delete_log/{new_id}')
+            self.assertEqual(self.read_event(events)[0], 'deleted')
+            response.close()
+
+    def test_tail_log_simultaneous_first_subscribers(self):
+        content = "[2024-07-19 10:00:00] INFO: started\n[2024-07-19 10:01:00] WARNING: alarm"
+        new_id = json.loads(self.app.post('/save_log', json={'content': content}).data)['id']
+        filename = log_path(self.test_log_dir, new_id)
+
+        class DelayedCondition(threading.Condition):
+            # the first subscriber to take the condition is late, the other one gets in before it
+            delayed = False
+
+            def __enter__(self):
+                if not self.delayed:
+                    self.delayed = True
+                    time.sleep(0.05)
+                return super().__enter__()
+
+        class DelayedFollowedLog(live_tail._FollowedLog):
+            def __init__(self, log_id, filename):
+                super().__init__(log_id, filename)
+                self.condition = DelayedCondition()
+
+        hub = TailHub(tail_snapshot)
+        barrier = threading.Barrier(2)
+
+        def first_event(_):
+            barrier.wait()
+            events = hub.subscribe(new_id, filename)
+            try:
+                return self.read_event(events)
+            finally:
+                events.close()
+
+        with mock.patch('live_tail._FollowedLog', DelayedFollowedLog), ThreadPoolExecutor(2) as executor:
+            results = list(executor.map(first_event, range(2)))
+        for event, data in results:
+            self.assertEqual(event, 'snapshot')
+            self.assertEqual(data['log_message_count']['INFO'], 1)
+            self.assertEqual(data['alarms']['count'], 1)
+        self.assertEqual(hub.subscriber_count(), 0)
+
+    def test_tail_log_not_found(self):
+        response = self.app.get('/tail_log/9999')
+        self.assertEqual(response.status_code, 404)
+
+    def test_flat_logs_migrated_into_shards(self):
+        with tempfile.TemporaryDirectory() as directory:
+            with open(os.path.join(directory, 'log_1234.log'), 'w') as f:
+                f.write("[2024-07-19 10:01:00] ERROR: early\n[2024-07-19 10:05:00] INFO: late\n")
+            open(os.path.join(directory, 'log_1234.log.ordered'), 'w').close()
+
+            manager = LogManager(directory)
+            self.assertEqual(log_path(directory, 1234), os.path.join(directory, '0001', 'log_1234.log'))
+            self.assertTrue(os.path.exists(log_path(directory, 1234)))
+            self.assertTrue(os.path.exists(log_path(directory, 1234) + '.ordered'))
+            self.assertFalse([name for name in os.listdir(directory) if name.startswith('log_')])
+            self.assertEqual(manager.list_log_ids(), [1234])
+
+            entry = manager.catalog.get(1234)
+            self.assertEqual(entry.path, os.path.join('0001', 'log_1234.log'))
+            self.assertEqual((entry.line_count, entry.first_timestamp, entry.last_timestamp),
+                             (2, "2024-07-19 10:01:00", "2024-07-19 10:05:00"))
+            self.assertEqual(entry.level_counts, {"INFO": 1, "ERROR": 1})
+            self.assertEqual(manager.allocate_id(), 1235)
+
+    def test_list_logs_from_catalog(self):
+        ids = [json.loads(self.app.post('/save_log', json={'content': f"[2024-07-19 10:0{i}:00] INFO: log {i}"}).data)['id']
+               for i in range(3)]
+        self.app.put(f'/update_log/{ids[0]}?append=true',
+                     json={'content': "[2024-07-19 09:00:00] WARNING: earlier"})
+        self.app.delete(f'/delete_log/{ids[2]}')
+
+        with mock.patch('os.scandir', side_effect=AssertionError("listing touched the log directory")):
+            page = json.loads(self.app.get('/logs?limit=1').data)
+            self.assertEqual([log['id'] for log in page['logs']], [ids[0]])
+            self.assertEqual(page['next'], ids[0])
+            first = page['logs'][0]
+            self.assertEqual((first['line_count'], first['first_timestamp'], first['last_timestamp']),
+                             (2, "2024-07-19 09:00:00", "2024-07-19 10:00:00"))
+            self.assertEqual(first['level_counts'], {"INFO": 1, "WARNING": 1})
+            self.assertEqual(first['size'], os.path.getsize(log_path(self.test_log_dir, ids[0])))
+
+            page = json.loads(self.app.get(f'/logs?after={page["next"]}').data)
+            self.assertEqual([log['id'] for log in page['logs']], [ids[1]])
+            self.assertIsNone(page['next'])
+        self.assertEqual(self.app.get('/logs?limit=x').status_code, 400)
+
+    def test_rollups(self):
+        content = ("[2024-07-19 10:00:10] MEASUREMENT: o2 concentration - 20\n"
+                   "[2024-07-19 10:00:50] MEASUREMENT: o2 concentration - 24\n"
+                   "[2024-07-19 10:01:00] WARNING: o2 alarm\n"
+                   "[2024-07-19 11:30:00] INFO: Started")
+        log_id = json.loads(self.app.post('/save_log', json={'content': content}).data)['id']
+        self.app.put(f'/update_log/{log_id}?append=true',
+                     json={'content': "[2024-07-19 11:30:30] MEASUREMENT: o2 concentration - 30"})
+
+        with mock.patch.object(LogManager, 'read_log_lines', side_effect=AssertionError("rollups read the log")):
+            minutes = json.loads(self.app.get(f'/rollups/{log_id}?resolution=minute').data)["buckets"]
+            self.assertEqual([bucket["start"] for bucket in minutes],
+                             ["2024-07-19 10:00:00", "2024-07-19 10:01:00", "2024-07-19 11:30:00"])
+            self.assertEqual(minutes[0]["measurements"]["o2"],
+                             {"count": 2, "average": 22, "highest": 24, "lowest": 20})
+            self.assertEqual((minutes[1]["alarms"], minutes[2]["log_message_count"]),
+                             (1, {"INFO": 1, "MEASUREMENT": 1}))
+
+            hours = json.loads(self.app.get(f'/rollups/{log_id}?resolution=hour&from=2024-07-19 11').data)
+            self.assertEqual([bucket["start"] for bucket in hours["buckets"]], ["2024-07-19 11:00:00"])
+            day = json.loads(self.app.get(f'/rollups/{log_id}?resolution=day').data)["buckets"][0]
+        parsed = json.loads(self.app.post(f'/parse_log/{log_id}').data)
+        self.assertEqual(day["measurements"]["o2"]["average"], parsed["measurements"]["o2"]["average"])
+        self.assertEqual(day["alarms"], parsed["alarms"]["count"])
+
+        # written outside the API, rebuilt from the file on the next query
+        with open(log_path(self.test_log_dir, log_id), 'a') as f:
+            f.write("[2024-07-20 08:00:00] WARNING: o2 alarm\n")
+        days = json.loads(self.app.get(f'/rollups/{log_id}?resolution=day').data)["buckets"]
+        self.assertEqual([bucket["alarms"] for bucket in days], [1, 1])
+
+        # an overwrite rebuilds them from the written lines
+        self.app.put(f'/update_log/{log_id}', json={'content': "[2024-07-21 09:00:00] INFO: Restarted"})
+        with mock.patch.object(LogManager, 'read_log_lines', side_effect=AssertionError("rollups read the log")):
+            days = json.loads(self.app.get(f'/rollups/{log_id}?resolution=day').data)["buckets"]
+        self.assertEqual([bucket["start"] for bucket in days], ["2024-07-21 00:00:00"])
+
+        self.assertEqual(self.app.get(f'/rollups/{log_id}?resolution=week').status_code, 400)
+        self.assertEqual(self.app.get('/rollups/999').status_code, 404)
+
+    def test_bulk_save_log_ndjson(self):
+        body = "\n".join([
+            json.dumps({'content': "[2024-07-19 10:00:00] INFO: First\nInvalid log"}),
+            "not json",
+            json.dumps({'content': "[2024-07-19 10:01:00] ERROR: Second"}),
+        ])
+        response = self.app.post('/bulk_save_log', data=body, content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual([file["lines"] for file in data["files"]], [1, 1])
+        self.assertEqual(data["files"][0]["rejected"], 1)
+        self.assertEqual(data["invalid_records"], 1)
+
+        with open(log_path(self.test_log_dir, data['files'][1]['id']), 'r') as f:
+            self.assertEqual(f.read(), "[2024-07-19 10:01:00] ERROR: Second\n")
+
+    def test_bulk_save_log_plain_text_stream(self):
+        body = "".join(f"[2024-07-19 10:00:{i:02d}] INFO: line {i}\n" for i in range(25)) + "garbage\n"
+        response = self.app.post('/bulk_save_log?lines_per_file=10', input_stream=io.BytesIO(body.encode()),
+                                 content_type='text/plain')
+        data = json.loads(response.data)
+        self.assertEqual([file["lines"] for file in data["files"]], [10, 10, 5])
+        self.assertEqual(data["rejected"], 1)
+
+    def test_bulk_save_log_invalid(self):
+        response = self.app.post('/bulk_save_log', data="Invalid log\n", content_type='text/plain')
+        self.assertEqual(response.status_code, 400)
+
+    def test_parse_logs_combined(self):
+        contents = [
+            "[2024-07-19 10:00:00] MEASUREMENT: o2 concentration - 20\n[2024-07-19 10:01:00] WARNING: o2 alarm\n",
+            "[2024-07-19 11:00:00] MEASUREMENT: o2 concentration - 24\n[2024-07-19 11:01:00] INFO: Done\n",
+        ]
+        for i, content in enumerate(contents, start=1):
+            with open(f"{self.test_log_dir}/log_{i}.log", 'w') as f:
+                f.write(content)
+
+        with mock.patch('parallel_parse.PARSE_WORKERS', 2):
+            response = self.app.post('/parse_logs', json={'ids': [1, 2, 999]})
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.data)
+        self.assertEqual(data["parsed"], [1, 2])
+        self.assertIn("999", data["errors"])
+        self.assertEqual(data["log_message_count"]["MEASUREMENT"], 2)
+        self.assertAlmostEqual(data["measurements"]["o2"]["average"], 22)
+        self.assertEqual(data["alarms"]["timestamps"], ["2024-07-19 10:01:00"])
+
+        combined = LogManager.parse_log_content("".join(contents).split("\n"))
+        data_all = json.loads(self.app.post('/parse_logs', json={'ids': 'all'}).data)
+        self.assertEqual(data_all["measurements"], combined["measurements"])
+        self.assertEqual(json.loads(self.app.post('/parse_logs', json={'from_id': 2, 'to_id': 5}).data)["parsed"], [2])
+
+    def test_parse_log_files_in_worker_processes(self):
+        filenames = []
+        for i in range(1, 5):
+            filenames.append(f"{self.test_log_dir}/log_{i}.log")
+            with open(filenames[-1], 'w') as f:
+                f.write("\n".join(generate_lines(500, seed=i)) + "\n")
+        filenames.append(f"{self.test_log_dir}/log_999.log")
+        expected = parallel_parse.parse_log_files(filenames)
+
+        parallel_parse.shutdown()
+        try:
+            with mock.patch('parallel_parse.PARSE_WORKERS', 2):
+                worker_pids = {parallel_parse.get_executor().submit(os.getpid).result() for _ in range(4)}
+                self.assertNotIn(os.getpid(), worker_pids)
+                results = parallel_parse.parse_log_files(filenames)
+        finally:
+            parallel_parse.shutdown()
+
+        self.assertEqual([error for _, error in results], [None] * 4 + ["Log file not found."])
+        for (summary, _), (expected_summary, _) in zip(results[:4], expected):
+            self.assertEqual(summary.to_dict(True), expected_summary.to_dict(True))
+
+    def wait_for_job(self, job_id):
+        for _ in range(200):
+            response = self.app.get(f'/parse_jobs/{job_id}')
+            if response.status_code != 202:
+                return response
+            time.sleep(0.01)
+        self.fail("Parse job did not finish.")
+
+    def test_parse_jobs(self):
+        content = "[2024-07-19 10:00:00] MEASUREMENT: o2 concentration - 20\n[2024-07-19 10:01:00] WARNING: o2 alarm"
+        response = self.app.post('/parse_jobs?percentiles=true', json={'content': content})
+        self.assertEqual(response.status_code, 202)
+        job_id = json.loads(response.data)["job_id"]
+        self.assertEqual(response.headers['Location'], f'/parse_jobs/{job_id}')
+
+        data = json.loads(self.wait_for_job(job_id).data)
+        self.assertEqual(data["status"], "done")
+        self.assertGreaterEqual(data["timing"]["run_seconds"], 0)
+        expected = json.loads(self.app.post('/parse_log?percentiles=true', json={'content': content}).data)
+        self.assertEqual({key: data[key] for key in expected}, expected)
+
+        saved = json.loads(self.app.post('/save_log', json={'content': content}).data)["id"]
+        response = self.app.post('/parse_jobs', json={'id': saved})
+        data = json.loads(self.wait_for_job(json.loads(response.data)["job_id"]).data)
+        self.assertEqual((data["log_message_count"]["MEASUREMENT"], data["log_message_count"]["WARNING"]), (1, 1))
+
+        response = self.app.post('/parse_jobs', json={'content': "Invalid log"})
+        data = json.loads(self.wait_for_job(json.loads(response.data)["job_id"]).data)
+        self.assertEqual((data["status"], data["error"]), ("failed", "No valid log file entries provided."))
+
+    def test_parse_jobs_failed(self):
+        saved = json.loads(self.app.post('/save_log', json={'content': "[2024-07-19 10:00:00] INFO: Started"}).data)["id"]
+        failures = [(FileNotFoundError(2, "No such file or directory"), "Log file not found."),
+                    (PermissionError(13, "Permission denied"), "[Errno 13] Permission denied"),
+                    (UnicodeDecodeError('utf-8', b'\xff', 0, 1, "invalid start byte"),
+                     "'utf-8' codec can't decode byte 0xff in position 0: invalid start byte")]
+        for error, message in failures:
+            parse_cache.invalidate(saved)
+            # mocks cannot be sent to worker processes
+            with mock.patch('app.summarize_log_file', side_effect=error), mock.patch('parallel_parse.PARSE_WORKERS', 1):
+                response = self.app.post('/parse_jobs', json={'id': saved})
+                data = json.loads(self.wait_for_job(json.loads(response.data)["job_id"]).data)
+            self.assertEqual((data["status"], data["error"], data["error_type"]),
+                             ("failed", message, type(error).__name__))
+
+    def test_parse_jobs_rejected(self):
+        self.assertEqual(self.app.post('/parse_jobs', json={'id': 999}).status_code, 404)
+        self.assertEqual(self.app.post('/parse_jobs', json={}).status_code, 400)
+        self.assertEqual(self.app.get('/parse_jobs/unknown').status_code, 404)
+        with mock.patch.object(job_queue, 'max_jobs', 0):
+            response = self.app.post('/parse_jobs', json={'content': "[2024-07-19 10:00:00] INFO: Started"})
+        self.assertEqual(response.status_code, 429)
+        self.assertIn('Retry-After', response.headers)
+
+    def test_parse_logs_invalid_selection(self):
+        self.assertEqual(self.app.post('/parse_logs', json={'ids': 'some'}).status_code, 400)
+
+    def test_metrics_endpoint(self):
+        accepted = metrics.LINES_ACCEPTED.value()
+        rejected = metrics.LINES_REJECTED.value()
+        parsed = metrics.STAGE_SECONDS.count('aggregation')
+        self.app.post('/parse_log', json={'content': "[2024-07-19 10:00:00] INFO: Started\nInvalid log"})
+
+        self.assertEqual(metrics.LINES_ACCEPTED.value(), accepted + 1)
+        self.assertEqual(metrics.LINES_REJECTED.value(), rejected + 1)
+        self.assertEqual(metrics.STAGE_SECONDS.count('aggregation'), parsed + 1)
+
+        response = self.app.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        body = response.data.decode()
+        self.assertIn('log_api_stage_seconds_bucket{stage="validation",le="+Inf"}', body)
+        self.assertIn('log_api_requests_total{endpoint="/parse_log",status="200"}', body)
+        self.assertIn('log_api_parse_cache_hits_total', body)
+
+    def test_metrics_disabled(self):
+        with mock.patch('metrics.METRICS_ENABLED', False):
+            count = metrics.STAGE_SECONDS.count('serialization')
+            self.app.post('/parse_log', json={'content': "[2024-07-19 10:00:00] INFO: Started"})
+            self.assertEqual(metrics.STAGE_SECONDS.count('serialization'), count)
+            self.assertEqual(self.app.get('/metrics').status_code, 404)
+
+
+class StatsTests(unittest.TestCase):
+
+    def test_measurement_stats_merge(self):
+        values = [21.0, 20.5, 19.0, 25.5, 22.0, 18.25]
+        left, right, combined = MeasurementStats(), MeasurementStats(), MeasurementStats()
+        for i, value in enumerate(values):
+            (left if i < 2 else right).add(value)
+            combined.add(value)
+
+        left.merge(right)
+        self.assertEqual(left.count, combined.count)
+        self.assertAlmostEqual(left.total, combined.total)
+        self.assertEqual((left.lowest, left.highest), (18.25, 25.5))
+        self.assertAlmostEqual(left.variance, combined.variance)
+
+    def test_measurement_stats_total_is_exact(self):
+        values = [0.1] * 10 + [1e16, 1.0, -1e16, 254.68967288564673, -0.0, 5e-324, -2.5e-310]
+        left, right, combined = MeasurementStats(), MeasurementStats(), MeasurementStats()
+        for i, value in enumerate(values):
+            (left if i % 3 else right).add(value)
+            combined.add(value)
+        self.assertEqual(left.merge(right).total, math.fsum(values))
+        self.assertEqual(combined.total, math.fsum(values))
+
+        combined.add(math.inf)
+        self.assertEqual(combined.total, math.inf)
+        combined.add(-math.inf)
+        self.assertTrue(math.isnan(combined.total))
+
+    def test_quantile_sketch_accuracy(self):
+        sketch = QuantileSketch(relative_accuracy=0.01)
+        for value in range(1, 10001):
+            sketch.add(float(value))
+
+        self.assertAlmostEqual(sketch.quantile(0.5), 5000, delta=5000 * 0.02)
+        self.assertAlmostEqual(sketch.quantile(0.99), 9900, delta=9900 * 0.02)
+
+    def test_quantile_sketch_bounded(self):
+        sketch = QuantileSketch(max_buckets=64)
+        for value in range(1, 100001):
+            sketch.add(value / 7)
+        self.assertLessEqual(len(sketch.positive), 64)
+        self.assertEqual(sketch.count, 100000)
+
+    def test_log_summary_merge(self):
+        lines = [
+            "[2024-07-19 10:00:00] MEASUREMENT: O2 concentration - 21.0",
+            "[2024-07-19 10:01:00] WARNING: Low oxygen alarm",
+            "[2024-07-19 10:02:00] MEASUREMENT: O2 concentration - 20.0",
+        ]
+        records = LogManager.tokenize_lines(lines)
+        merged = LogSummary().update(records[:1]).merge(LogSummary().update(records[1:]))
+        self.assertEqual(merged.to_dict(), LogManager.parse_log_content(lines))
+
+
+@unittest.skipUnless(columnar.np is not None, "NumPy is not installed")
+class ColumnarTests(unittest.TestCase):
+
+    def summarize(self, lines, vectorized):
+        with mock.patch('columnar.COLUMNAR_AGGREGATION', vectorized):
+            return LogSummary().update_lines(lines).to_dict(percentiles=True)
+
+    def test_matches_record_path(self):
+        lines = list(generate_lines(5000, invalid_ratio=0.05))
+        lines.append("[2024-07-19 10:00:00] MEASUREMENT: co2 concentration - n/a")
+        expected = self.summarize(lines, False)
+        result = self.summarize(lines, True)
+
+        self.assertEqual(result["log_message_count"], expected["log_message_count"])
+        self.assertEqual(result["alarms"], expected["alarms"])
+        self.assertEqual(list(result["measurements"]), list(expected["measurements"]))
+        for gas, stats in expected["measurements"].items():
+            for key, value in stats.items():
+                self.assertAlmostEqual(result["measurements"][gas][key], value, places=6)
+
+    def test_non_finite_values(self):
+        lines = [
+            "[2024-07-19 10:00:00] MEASUREMENT: O2 concentration - 21.0",
+            "[2024-07-19 10:01:00] MEASUREMENT: O2 concentration - inf",
+        ]
+        # stddev is NaN, which only compares equal once serialized
+        self.assertEqual(json.dumps(self.summarize(lines, True)), json.dumps(self.summarize(lines, False)))
+
+    def test_totals_identical_on_every_path(self):
+        rng = random.Random(3)
+        lines = [f"[2024-07-19 10:00:00] MEASUREMENT: o2 concentration - {rng.uniform(0, 500)!r}"
+                 for _ in range(5000)]
+        values = [float(line.rsplit(' ', 1)[1]) for line in lines]
+        with mock.patch('columnar.COLUMNAR_AGGREGATION', False):
+            expected = LogSummary().update_lines(lines).to_dict()
+        self.assertEqual(expected["measurements"]["o2"]["average"], math.fsum(values) / len(values))
+        for size in (7, 1000, len(lines)):
+            summary = LogSummary()
+            for batch in LogManager.iter_batches(lines, RejectedLines(), size):
+                summary.add_batch(batch)
+            self.assertEqual(json.dumps(summary.to_dict()), json.dumps(expected))
+
+        values = columnar.np.array([rng.uniform(-1e6, 1e6) for _ in range(1000)] + [5e-324, -2.5e-310, 1e300, -1e300])
+        self.assertEqual(columnar.exact_sum(values), sum(map(exact_units, values.tolist())))
+
+    def test_record_batch_columns(self):
+        lines = [
+            "[2024-07-19 10:00:00] MEASUREMENT: O2 concentration - 21.0",
+            "[2024-07-19 10:01:00] WARNING: Low oxygen alarm",
+            "invalid",
+            "[2024-07-19 10:02:00] MEASUREMENT: CO2 concentration - 400",
+        ]
+        batch = LogManager.tokenize_batch(lines, RejectedLines())
+
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(batch.gases, {"O2": 0, "CO2": 1})
+        self.assertEqual(batch.gas_codes.tolist(), [0, columnar.NO_GAS, 1])
+        self.assertEqual(batch.alarm_timestamps(), ["2024-07-19 10:01:00"])
+        self.assertEqual(batch.epoch_seconds().tolist(), [1721383200, 1721383260, 1721383320])
+
+    def test_record_batch_classifies_distinct_messages(self):
+        rules = CompiledRules({
+            "alarms": [{"levels": ["WARNING", "ERROR"], "keywords": ["alarm"]}],
+            "measurements": [{"levels": ["MEASUREMENT", "INFO"], "pattern": r"(?P<gas>\w+)=(?P<value>\S+)ppm"}]
+        })
+        messages = [("INFO", "n2=1ppm"), ("MEASUREMENT", "o2=2ppm"), ("INFO", "n2=1ppm"), ("WARNING", "o2 alarm"),
+                    ("ERROR", "no alarm=3ppm"), ("MEASUREMENT", "o2=xppm"), ("WARNING", "o2 alarm"),
+                    ("MEASUREMENT", "co=4ppm"), ("DEBUG", "co=5ppm")]
+        with mock.patch('columnar.current_rules', return_value=rules):
+            batch = columnar.RecordBatch([f"2024-07-19 10:00:{row:02d}" for row in range(len(messages))],
+                                         [level for level, _ in messages], [message for _, message in messages],
+                                         LOG_LEVELS)
+
+        # gases numbered by first row whatever level they were found in, like classify row by row
+        self.assertEqual(batch.gases, {"n2": 0, "o2": 1, "co": 2})
+        self.assertEqual(batch.gas_codes.tolist(), [0, 1, 0] + [columnar.NO_GAS] * 4 + [2, columnar.NO_GAS])
+        self.assertEqual(batch.values[[0, 1, 2, 7]].tolist(), [1, 2, 1, 4])
+        self.assertEqual(batch.alarm_flags.tolist(), [row in (3, 4, 6) for row in range(len(messages))])
+
+
+class LogFilesTests(unittest.TestCase):
+
+    def test_group_commit_batches_waiting_writes(self):
+        release = threading.Event()
+        batches = []
+
+        def commit(key, items):
+            release.wait(5)
+            batches.append(items)
+
+        group = GroupCommit(commit)
+        with ThreadPoolExecutor(max_workers=6) as executor:
+            futures = [executor.submit(group.submit, 'log', i) for i in range(6)]
+            time.sleep(0.1)
+            release.set()
+            for future in futures:
+                future.result()
+
+        self.assertEqual(sorted(item for batch in batches for item in batch), list(range(6)))
+        self.assertLess(len(batches), 6)
+        self.assertEqual(group.stats(), {"commits": len(batches), "items": 6})
+
+    def test_group_commit_raises_commit_error(self):
+        def commit(key, items):
+            raise FileNotFoundError(key)
+
+        with self.assertRaises(FileNotFoundError):
+            GroupCommit(commit).submit('missing', 1)
+
+    def test_file_lock_excludes_other_holders(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log_1.log')
+            open(filename, 'w').close()
+            acquired = threading.Event()
+
+            def acquire():
+                # a separate open file, the same as another process would have
+                with FileLock(filename):
+                    acquired.set()
+
+            with FileLock(filename):
+                thread = threading.Thread(target=acquire)
+                thread.start()
+                self.assertFalse(acquired.wait(0.2))
+            thread.join(5)
+            self.assertTrue(acquired.is_set())
+
+
+    def test_file_lock_of_removed_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'log_1.log')
+            with self.assertRaises(FileNotFoundError):
+                with FileLock(filename):
+                    pass
+            self.assertFalse(os.path.exists(filename + '.lock'))
+
+            open(filename, 'w').close()
+            acquired = threading.Event()
+
+            def acquire():
+                with FileLock(filename) as lock:
+                    # the lock file at the path is the one held, not the removed one
+                    self.assertTrue(os.path.samestat(os.fstat(lock._file.fileno()), os.stat(lock.path)))
+                    acquired.set()
+
+            with FileLock(filename):
+                thread = threading.Thread(target=acquire)
+                thread.start()
+                time.sleep(0.05)
+                remove_lock(filename)
+            thread.join(5)
+            self.assertTrue(acquired.is_set())
+
+
+class RulesTests(unittest.TestCase):
+
+    def test_compiled_rules_classify(self):
+        rules = CompiledRules({
+            "alarms": [{"levels": ["WARNING", "ERROR"], "keywords": ["alarm", "alert", "Leak Detected"]},
+                       {"levels": ["ERROR"], "keywords": ["FATAL"], "case_sensitive": True}],
+            "measurements": [{"pattern": r"(?P<gas>\w+)=(?P<value>[0-9.]+)ppm"},
+                             {"pattern": r"(?P<gas>.*?)concentration(?:(?:(?!concentration)[^-])*-)*(?P<value>(?:(?!concentration)[^-])*)"}]
+        })
+        self.assertEqual(rules.classify('MEASUREMENT', "CO2=412.5ppm"), Classification(MEASUREMENT, "CO2", "412.5"))
+        self.assertEqual(rules.classify('MEASUREMENT', "o2 concentration - 25"), Classification(MEASUREMENT, "o2", "25"))
+        self.assertEqual(rules.classify('WARNING', "gas leak detected in hall 2"), Classification(ALARM))
+        self.assertEqual(rules.classify('ERROR', "ALERT raised"), Classification(ALARM))
+        self.assertIsNone(rules.classify('ERROR', "fatal but lowercase"))
+        self.assertEqual(rules.classify('ERROR', "FATAL pump failure"), Classification(ALARM))
+        self.assertIsNone(rules.classify('INFO', "alarm in an info line"))
+        self.assertEqual(rules.levels, {'MEASUREMENT', 'WARNING', 'ERROR'})
+
+        with self.assertRaises(ValueError):
+            CompiledRules({"measurements": [{"pattern": "(?P<gas>.*) only"}]})
+
+    def test_default_rules_match_split_parser(self):
+        def split_parse(lines):
+            # measurements as parse_log_content found them before the rules existed
+            measurements = {}
+            for line in lines:
+                level, message = line.split('] ', 1)[1].split(': ', 1)
+                if level == 'MEASUREMENT' and 'concentration' in message:
+                    parts = message.split('concentration')
+                    try:
+                        value = float(parts[1].split('-')[-1].strip())
+                    except ValueError:
+                        continue
+                    measurements.setdefault(parts[0].strip(), []).append(value)
+            return {gas: {"average": sum(values) / len(values), "highest": max(values), "lowest": min(values)}
+                    for gas, values in measurements.items()}
+
+        lines = [f"[2024-07-19 10:00:00] MEASUREMENT: {message}" for message in [
+            "o2 concentration - 25 concentration - 30",
+            "o2 concentration - 20",
+            "co2 concentration 400 concentration - 1",
+            "co2 concentration - 1 - 2 concentration - 3 - 4",
+            "n2 - x concentration - -5 concentration",
+            "h2 concentrationconcentration - 4",
+        ]]
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json')) as f:
+            self.assertEqual(json.load(f), DEFAULT_RULES)
+        with tempfile.TemporaryDirectory() as directory:
+            with mock.patch('rules.rule_set', RuleSet(os.path.join(directory, 'rules.json'))):
+                measurements = LogManager.parse_log_content(lines)["measurements"]
+        self.assertEqual({gas: {key: stats[key] for key in ("average", "highest", "lowest")}
+                          for gas, stats in measurements.items()}, split_parse(lines))
+
+    def test_rules_reloaded_from_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'rules.json')
+            rule_set = RuleSet(path)
+            lines = ["[2024-07-19 10:00:00] WARNING: smoke detected",
+                     "[2024-07-19 10:01:00] MEASUREMENT: CO2=400ppm"]
+            with mock.patch('rules.rule_set', rule_set), mock.patch('rules.RULES_RELOAD_SECONDS', 0):
+                self.assertEqual(LogManager.parse_log_content(lines)["alarms"]["count"], 0)
+
+                with open(path, 'w') as f:
+                    json.dump({"alarms": [{"keywords": ["smoke"]}],
+                               "measurements": [{"pattern": r"(?P<gas>\w+)=(?P<value>[0-9.]+)ppm"}]}, f)
+                result = LogManager.parse_log_content(lines)
+                self.assertEqual(result["alarms"]["timestamps"], ["2024-07-19 10:00:00"])
+                self.assertEqual(result["measurements"]["CO2"]["average"], 400)
+                fingerprint = rule_set.current().fingerprint
+
+                # a broken file keeps the rules in use
+                with open(path, 'w') as f:
+                    f.write("{not json")
+                os.utime(path, ns=(1, 1))
+                self.assertEqual(rule_set.current().fingerprint, fingerprint)
+
+
+class RollupsTests(unittest.TestCase):
+
+    def test_columns_match_records(self):
+        lines = list(generate_lines(5000))
+        lines.append("[2024-07-19 10:00:00] MEASUREMENT: co2 concentration - inf")
+        records = LogManager.tokenize_lines(lines)
+        batch = columnar.RecordBatch.from_records(records, LOG_LEVELS)
+        expected = Rollups().update(records).buckets
+        result = Rollups().add_batch(batch).buckets
+
+        self.assertEqual(sorted(result), sorted(expected))
+        self.assertEqual({resolution for resolution, _ in result}, set(ROLLUP_RESOLUTIONS))
+        for key, bucket in expected.items():
+            self.assertEqual((result[key].level_counts, result[key].alarms), (bucket.level_counts, bucket.alarms))
+            for gas, stats in bucket.measurements.items():
+                for value, result_value in zip(stats, result[key].measurements[gas]):
+                    self.assertAlmostEqual(result_value, value, places=6)
+
+    def test_bucket_range(self):
+        self.assertEqual(bucket_range('hour', "2024-07-19 10:30", "2024-07-19"), ("2024-07-19 10", "2024-07-19~"))
+        self.assertEqual(bucket_range('minute', None, None), ("", "~"))
+
+
+class AppLoggingTests(unittest.TestCase):
+
+    def test_configure_logging_writes_in_background(self):
+        logger = logging.getLogger('test_app.background')
+        logger.propagate = False
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, 'app.log')
+            listener = configure_logging(logger, filename=filename, rate_limit=0)
+            logger.info("Written by the listener")
+            listener.stop()
+            for handler in list(logger.handlers):
+                logger.removeHandler(handler)
+            for handler in listener.handlers:
+                handler.close()
+
+            with open(filename, 'r') as f:
+                self.assertIn("Written by the listener", f.read())
+
+    def test_bounded_queue_drops_when_full(self):
+        handler = BoundedQueueHandler(queue.Queue(maxsize=2))
+        for i in range(5):
+            handler.emit(logging.LogRecord('test', logging.INFO, __file__, 0, f"record {i}", None, None))
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
+
+    def test_rate_limit_filter(self):
+        rate_filter = RateLimitFilter(rate=10)
+        records = [logging.LogRecord('test', logging.ERROR, __file__, 0, "failure", None, None) for _ in range(100)]
+        with mock.patch('app_logging.time.monotonic', return_value=1.0):
+            passed = sum(rate_filter.filter(record) for record in records)
+        self.assertEqual(passed, 10)
+        self.assertEqual(rate_filter.suppressed, 90)
+
+
+class BenchmarkTests(unittest.TestCase):
+
+    def test_generate_lines_mix(self):
+        lines = list(generate_lines(2000, {'MEASUREMENT': 1.0}, invalid_ratio=0.1, seed=1))
+        records = LogManager.tokenize_lines(lines)
+        self.assertEqual(len(lines), 2000)
+        self.assertAlmostEqual(len(records) / 2000, 0.9, delta=0.03)
+        self.assertTrue(all(record.level == 'MEASUREMENT' for record in records))
+        self.assertTrue(LogManager.parse_log_records(records)["measurements"])
+
+    def test_compare_results(self):
+        baseline = {"parse_log[n=1000]": 0.100, "get_log[n=1000]": 0.001}
+        results = {"parse_log[n=1000]": 0.150, "get_log[n=1000]": 0.002, "new[n=1000]": 1.0}
+        regressions = compare_results(results, baseline, threshold=0.25)
+        self.assertEqual(len(regressions), 1)
+        self.assertTrue(regressions[0].startswith("parse_log[n=1000]"))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,22 @@
-from datetime import datetime
-from typing import Dict, List, Any
+from calendar import monthrange
+from itertools import islice
+from typing import Dict, List, Any, Iterable, Iterator, NamedTuple, Optional
 import logging
 import os
+import re
+import sqlite3
+import threading
+import time
+
+from app_logging import configure_logging
+from catalog import CATALOG_FILENAME, LOG_CATALOG, CatalogEntry, LogCatalog
+from columnar import RecordBatch
+from log_index import mark_ordered, scan_ordered
+from log_layout import find_log, flat_path, iter_log_files, log_path, migrate
+from rules import ALARM, CompiledRules, current_rules
+from stats import MeasurementStats
+import columnar
+import metrics
 
 
 class LogValidationError(Exception):
@@ -9,13 +24,43 @@ class LogValidationError(Exception):
     pass
 
 
-# logging configuration
-logging.basicConfig(filename='app.log', level=logging.INFO,
-                    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+# logging configuration, records are written to app.log by a background thread
+configure_logging()
 
 # environment variable for LOG_DIRECTORY or fallback value
 LOG_DIRECTORY = os.getenv('LOG_DIRECTORY', 'logs')
 
+# buffer size used when streaming stored log files
+READ_BUFFER_SIZE = 1024 * 1024
+
+# rejected lines quoted in a validation failure summary
+VALIDATION_SAMPLES = int(os.getenv('VALIDATION_SAMPLES', 3))
+
+
+LOG_LEVELS = ('ERROR', 'INFO', 'MEASUREMENT', 'WARNING', 'DEBUG')
+
+# fixed-width "[YYYY-MM-DD HH:MM:SS] LEVEL: message", field ranges are checked by the pattern itself
+LOG_ENTRY_PATTERN = re.compile(
+    r'\[(?P<timestamp>(?P<year>[0-9]{4})-(?P<month>0[1-9]|1[0-2])-(?P<day>0[1-9]|[12][0-9]|3[01])'
+    r' (?:[01][0-9]|2[0-3]):[0-5][0-9]:[0-5][0-9])\] '
+    r'(?P<level>' + '|'.join(LOG_LEVELS) + r'): (?P<message>.*)',
+    re.DOTALL
+)
+
+
+class LogRecord(NamedTuple):
+    """A validated log line split into its parts."""
+    timestamp: str
+    level: str
+    message: str
+    line: str
+
+
+def is_valid_date(year: str, month: str, day: str) -> bool:
+    """Calendar check of a date whose fields already passed LOG_ENTRY_PATTERN."""
+    # the pattern only lets through days 01-31, so only the month ends need a real check
+    return year != '0000' and (day <= '28' or int(day) <= monthrange(int(year), int(month))[1])
+
 
 def is_numeric(value):
     try:
@@ -25,26 +70,333 @@ def is_numeric(value):
         return False
 
 
+class LogIdAllocator:
+    """
+    Hand out unique log IDs without listing the log directory.
+    The next ID is kept in memory and persisted to a small counter file,
+    while the log file itself is reserved with O_CREAT | O_EXCL, so two
+    threads or processes can never be given the same ID.
+    """
+    COUNTER_FILENAME = '.next_id'
+
+    def __init__(self, log_directory: str):
+        self.log_directory = log_directory
+        self.counter_path = os.path.join(log_directory, self.COUNTER_FILENAME)
+        self._lock = threading.Lock()
+        self._next_id = self.reconcile()
+
+    def reconcile(self) -> int:
+        """
+        Recover the next free ID after a crash or a manual change of the
+        log directory. This is the only place that scans the directory
+        and it runs once, on startup.
+        """
+        highest = max((log_id for log_id, _ in iter_log_files(self.log_directory)), default=0)
+        return max(self._read_counter(), highest + 1)
+
+    def allocate(self) -> int:
+        """Reserve a new log file and return its ID."""
+        with self._lock:
+            candidate = self._next_id
+            while True:
+                filename = log_path(self.log_directory, candidate)
+                try:
+                    fd = os.open(filename, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+                except FileExistsError:
+                    # another worker got there first, skip ahead to its counter
+                    candidate = max(candidate + 1, self._read_counter())
+                    continue
+                except FileNotFoundError:
+                    os.makedirs(os.path.dirname(filename), exist_ok=True)
+                    continue
+                os.close(fd)
+                flat = flat_path(self.log_directory, candidate)
+                if flat != filename and os.path.exists(flat):
+                    # a flat log placed in the directory since startup holds this ID
+                    os.remove(filename)
+                    candidate += 1
+                    continue
+                self._next_id = candidate + 1
+                self._write_counter(self._next_id)
+                return candidate
+
+    def _read_counter(self) -> int:
+        try:
+            with open(self.counter_path, 'r') as file:
+                return int(file.read().strip() or 0)
+        except (OSError, ValueError):
+            return 0
+
+    def _write_counter(self, value: int) -> None:
+        # the counter is only a hint for other workers, uniqueness comes from O_EXCL
+        temp_path = f"{self.counter_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(temp_path, 'w') as file:
+                file.write(str(value))
+            os.replace(temp_path, self.counter_path)
+        except OSError as e:
+            logging.warning(f"Could not persist next log ID: {str(e)}")
+
+
+class LogSummary:
+    """
+    Running aggregate behind parse_log_content. Summaries of separate
+    chunks or files can be merged into one.
+    """
+
+    def __init__(self):
+        self.log_counts: Dict[str, int] = {level: 0 for level in LOG_LEVELS}
+        self.measurements: Dict[str, MeasurementStats] = {}
+        self.alarms: List[str] = []
+
+    def add(self, record: LogRecord, rules: Optional[CompiledRules] = None) -> None:
+        timestamp, log_level, message, _ = record
+        self.log_counts[log_level] += 1
+
+        classification = (rules or current_rules()).classify(log_level, message)
+        if classification is None:
+            return
+        if classification.kind == ALARM:
+            self.alarms.append(timestamp)
+        elif is_numeric(classification.value):
+            stats = self.measurements.get(classification.gas)
+            if stats is None:
+                stats = self.measurements[classification.gas] = MeasurementStats()
+            stats.add(float(classification.value))
+        else:
+            logging.warning(f"Invalid measurement value: {message}")
+
+    def add_batch(self, batch: RecordBatch) -> None:
+        """Fold in a columnar batch, aggregated with vectorized NumPy operations."""
+        for level, count in batch.level_counts().items():
+            self.log_counts[level] += count
+        for gas_type, stats in batch.measurements().items():
+            existing = self.measurements.get(gas_type)
+            if existing is None:
+                self.measurements[gas_type] = stats
+            else:
+                existing.merge(stats)
+        self.alarms.extend(batch.alarm_timestamps())
+
+    def update(self, records: Iterable[LogRecord]) -> 'LogSummary':
+        rules = current_rules()
+        for record in records:
+            self.add(record, rules)
+        return self
+
+    def update_lines(self, lines: Iterable[str], rejected_lines: Optional['RejectedLines'] = None,
+                     durations: Optional[Dict[Optional[str], float]] = None) -> 'LogSummary':
+        """
+        Validate and aggregate raw log lines, in columnar batches when NumPy
+        is available and record by record otherwise. With durations, all
+        lines are validated before any is aggregated and the seconds of both
+        are added to its 'validation' and 'aggregation' entries, so pass
+        the lines batch by batch then.
+        """
+        if durations is None:
+            if columnar.COLUMNAR_AGGREGATION:
+                for batch in LogManager.iter_batches(lines, rejected_lines):
+                    self.add_batch(batch)
+                return self
+            return self.update(LogManager.iter_records(lines, rejected_lines))
+
+        start = time.perf_counter()
+        if columnar.COLUMNAR_AGGREGATION:
+            batches = list(LogManager.iter_batches(lines, rejected_lines))
+        else:
+            records = list(LogManager.iter_records(lines, rejected_lines))
+        validated = time.perf_counter()
+        if columnar.COLUMNAR_AGGREGATION:
+            for batch in batches:
+                self.add_batch(batch)
+        else:
+            self.update(records)
+        durations['validation'] += validated - start
+        durations['aggregation'] += time.perf_counter() - validated
+        return self
+
+    def merge(self, other: 'LogSummary') -> 'LogSummary':
+        for level, count in other.log_counts.items():
+            self.log_counts[level] += count
+        for gas_type, stats in other.measurements.items():
+            self.measurements.setdefault(gas_type, MeasurementStats()).merge(stats)
+        self.alarms.extend(other.alarms)
+        return self
+
+    @property
+    def line_count(self) -> int:
+        return sum(self.log_counts.values())
+
+    def to_dict(self, percentiles: bool = False) -> Dict[str, Any]:
+        return {
+            "log_message_count": dict(self.log_counts),
+            "measurements": {gas: stats.to_dict(percentiles) for gas, stats in self.measurements.items()},
+            "alarms": {
+                "count": len(self.alarms),
+                "timestamps": list(self.alarms)
+            }
+        }
+
+
+class RejectedLines:
+    """
+    Collect the lines rejected while handling one request, so they are
+    logged as a single summary with a count and a few samples.
+    """
+
+    def __init__(self, max_samples: int = VALIDATION_SAMPLES):
+        self.max_samples = max_samples
+        self.count = 0
+        self.samples: List[str] = []
+
+    def add(self, line: str) -> None:
+        self.count += 1
+        if len(self.samples) < self.max_samples:
+            self.samples.append(line[:100])
+
+    def report(self) -> None:
+        if self.count:
+            logging.error(f"Log validation failed for {self.count} entries, samples: {self.samples!r}")
+
+
+class LogWriter:
+    """
+    Write validated lines into a new log file as they arrive. The log ID is
+    only reserved once the first valid line shows up.
+    """
+
+    def __init__(self, log_manager: 'LogManager', rejected_lines: Optional['RejectedLines'] = None):
+        self.log_manager = log_manager
+        self.rejected_lines = rejected_lines
+        self.id: Optional[int] = None
+        self.filename: Optional[str] = None
+        self.lines = 0
+        self.rejected = 0
+        self.bytes_written = 0
+        self.ordered = True
+        self.level_counts: Dict[str, int] = {}
+        self.first_timestamp: Optional[str] = None
+        self.latest_timestamp: Optional[str] = None
+        self._file = None
+        self._last_timestamp: Optional[str] = None
+
+    def write_line(self, line: str) -> None:
+        record = LogManager.tokenize_log_entry(line)
+        if record is None:
+            if line.strip():
+                self.rejected += 1
+                if self.rejected_lines is not None:
+                    self.rejected_lines.add(line)
+            return
+
+        if self._file is None:
+            self.id = self.log_manager.allocate_id()
+            self.filename = self.log_manager.log_path(self.id)
+            self._file = open(self.filename, 'w', buffering=READ_BUFFER_SIZE)
+        self._file.write(record.line + '\n')
+        self.lines += 1
+        self.bytes_written += len(record.line) + 1
+
+        if self._last_timestamp is not None and record.timestamp < self._last_timestamp:
+            self.ordered = False
+        self._last_timestamp = record.timestamp
+        self.level_counts[record.level] = self.level_counts.get(record.level, 0) + 1
+        if self.first_timestamp is None or record.timestamp < self.first_timestamp:
+            self.first_timestamp = record.timestamp
+        if self.latest_timestamp is None or record.timestamp > self.latest_timestamp:
+            self.latest_timestamp = record.timestamp
+
+    def write_lines(self, lines: Iterable[str]) -> 'LogWriter':
+        for line in lines:
+            self.write_line(line)
+        return self
+
+    def close(self) -> Dict[str, Any]:
+        """Finish the file and report what was written."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            mark_ordered(self.filename, self.ordered)
+            self.log_manager.catalog.put(CatalogEntry(
+                self.id, self.log_manager.relative_path(self.filename), self.bytes_written, self.lines,
+                self.first_timestamp, self.latest_timestamp, self.level_counts))
+        metrics.count_lines(self.lines, self.rejected)
+        metrics.count_bytes_written(self.bytes_written)
+        return {"id": self.id, "lines": self.lines, "rejected": self.rejected}
+
+
 class LogManager:
     def __init__(self, log_directory: str):
         self.log_directory = log_directory
         if not os.path.exists(self.log_directory):
             os.makedirs(self.log_directory)
+        migrate(self.log_directory)
+        self.id_allocator = LogIdAllocator(self.log_directory)
+        self.catalog = LogCatalog(LOG_CATALOG or os.path.join(self.log_directory, CATALOG_FILENAME))
+        self.sync_catalog()
 
-    @staticmethod
-    def get_next_id() -> int:
-        """Get possible log ID."""
-        existing_logs = [f for f in os.listdir(LOG_DIRECTORY) if f.endswith('.log')]
-        return len(existing_logs) + 1
+    def allocate_id(self) -> int:
+        """Reserve an empty log file and return its ID."""
+        return self.id_allocator.allocate()
+
+    def log_path(self, log_id: int) -> str:
+        """Path of a stored log, or where a new one goes."""
+        return find_log(self.log_directory, log_id)
+
+    def relative_path(self, filename: str) -> str:
+        return os.path.relpath(filename, self.log_directory)
+
+    def list_log_ids(self) -> List[int]:
+        """IDs of all stored logs, in ascending order."""
+        return sorted(log_id for log_id, _ in iter_log_files(self.log_directory))
+
+    def catalog_entry(self, log_id: int, filename: str) -> CatalogEntry:
+        """Catalog entry of a log read from its file."""
+        with open(filename, 'rb') as file:
+            size = file.seek(0, os.SEEK_END)
+        return CatalogEntry.from_records(log_id, self.relative_path(filename), size,
+                                         self.iter_records(self.read_log_lines(filename), RejectedLines()))
+
+    def sync_catalog(self) -> None:
+        """
+        Bring the catalog in line with the log directory on startup: logs it
+        misses are read once, entries of removed logs are dropped. The logs
+        read were not written through the API, their timestamp order is
+        recorded for time window reads.
+        """
+        try:
+            cataloged = self.catalog.paths()
+        except sqlite3.Error as e:
+            logging.warning(f"Could not read log catalog {self.catalog.path}: {str(e)}")
+            return
+        stored = dict(iter_log_files(self.log_directory))
+        missing, moved = [], []
+        for log_id, filename in stored.items():
+            path = self.relative_path(filename)
+            if log_id not in cataloged:
+                try:
+                    missing.append(self.catalog_entry(log_id, filename))
+                    mark_ordered(filename, scan_ordered(filename))
+                except OSError:
+                    continue
+            elif cataloged[log_id] != path:
+                moved.append((log_id, path))
+        if missing:
+            self.catalog.put(*missing)
+        if moved:
+            self.catalog.move(*moved)
+        removed = [log_id for log_id in cataloged if log_id not in stored]
+        if removed:
+            self.catalog.remove(*removed)
 
     @staticmethod
-    def get_highest_log_id() -> int:
-        """Get the highest existing log ID."""
-        existing_logs = [f for f in os.listdir(LOG_DIRECTORY) if f.endswith('.log')]
-        log_ids = []
-        for log in existing_logs:
-            log_ids.append(int(log.removeprefix("log_").removesuffix(".log")))
-        return max(log_ids) + 1
+    def ends_with_newline(filename: str) -> bool:
+        """Check whether a log file is empty or its last line is terminated."""
+        with open(filename, 'rb') as file:
+            if file.seek(0, os.SEEK_END) == 0:
+                return True
+            file.seek(-1, os.SEEK_END)
+            return file.read(1) == b'\n'
 
     @staticmethod
     def request_body_formatting(body: str) -> str:
@@ -62,26 +414,163 @@ class LogManager:
         return first_part + modified_rest
 
     @staticmethod
-    def validate_log_entry(entry: str) -> bool:
+    def tokenize_log_entry(entry: str) -> Optional[LogRecord]:
         """
-        Validate a single log entry. The log entry must have this
+        Validate a single log entry and split it into its parts in one pass.
+        Returns None when the entry does not have this
         structure -> "[2024-07-19 10:00:00] INFO: System started"
         """
-        try:
-            timestamp, rest = entry.split('] ', 1)
-            timestamp = timestamp[1:]
-            datetime.strptime(timestamp, '%Y-%m-%d %H:%M:%S')
+        match = LOG_ENTRY_PATTERN.match(entry)
+        if match is None:
+            return None
+
+        timestamp, year, month, day, level, message = match.groups()
+        if not is_valid_date(year, month, day):
+            return None
 
-            level, message = rest.split(': ', 1)
+        return LogRecord(timestamp, level, message, entry)
 
-            # factually this might be incorrect as hardcoding is a big no no
-            if level not in ['INFO', 'ERROR', 'MEASUREMENT', 'WARNING', 'DEBUG']:
-                raise LogValidationError(f"Invalid log level: {level}")
+    @staticmethod
+    def iter_records(lines: Iterable[str], rejected_lines: Optional[RejectedLines] = None) -> Iterator[LogRecord]:
+        """
+        Lazily tokenize log lines, dropping invalid ones. Rejected lines are
+        collected in rejected_lines, or reported with one summary record
+        once the lines are exhausted when none is given.
+        """
+        report = rejected_lines is None
+        if report:
+            rejected_lines = RejectedLines()
+        accepted = 0
+        rejected = 0
+        # tokenize_log_entry inlined, like tokenize_batch does
+        match_entry = LOG_ENTRY_PATTERN.match
+        for line in lines:
+            match = match_entry(line)
+            if match is not None:
+                timestamp, year, month, day, level, message = match.groups()
+                if is_valid_date(year, month, day):
+                    accepted += 1
+                    yield LogRecord(timestamp, level, message, line)
+                    continue
+            if line.strip():
+                rejected += 1
+                rejected_lines.add(line)
+
+        metrics.count_lines(accepted, rejected)
+        if report:
+            rejected_lines.report()
+
+    @staticmethod
+    def tokenize_batch(lines: Iterable[str], rejected_lines: RejectedLines) -> RecordBatch:
+        """Validate log lines straight into a columnar batch, without a LogRecord per line."""
+        timestamps, levels, messages = [], [], []
+        rejected = 0
+        match_entry = LOG_ENTRY_PATTERN.match
+        for line in lines:
+            match = match_entry(line)
+            if match is not None:
+                timestamp, year, month, day, level, message = match.groups()
+                if is_valid_date(year, month, day):
+                    timestamps.append(timestamp)
+                    levels.append(level)
+                    messages.append(message)
+                    continue
+            if line.strip():
+                rejected += 1
+                rejected_lines.add(line)
+
+        metrics.count_lines(len(timestamps), rejected)
+        return RecordBatch(timestamps, levels, messages, LOG_LEVELS)
 
-            return True
-        except (ValueError, IndexError, LogValidationError) as e:
-            logging.error(f"Log validation failed: {str(e)}")
+    @staticmethod
+    def iter_batches(lines: Iterable[str], rejected_lines: Optional[RejectedLines] = None,
+                     size: int = columnar.COLUMNAR_BATCH_SIZE) -> Iterator[RecordBatch]:
+        """
+        Columnar counterpart of iter_records: validate lines into batches of
+        at most size lines, rejected lines are handled the same way.
+        """
+        report = rejected_lines is None
+        if report:
+            rejected_lines = RejectedLines()
+        lines = iter(lines)
+        while True:
+            chunk = list(islice(lines, size))
+            if not chunk:
+                break
+            yield LogManager.tokenize_batch(chunk, rejected_lines)
+
+        if report:
+            rejected_lines.report()
+
+    @staticmethod
+    def tokenize_lines(lines: Iterable[str]) -> List[LogRecord]:
+        """Tokenize a batch of log lines, dropping invalid ones."""
+        return list(LogManager.iter_records(lines))
+
+    @staticmethod
+    def read_log_lines(filename: str) -> Iterator[str]:
+        """
+        Stream the lines of a stored log file in buffered chunks. Yields the
+        same lines as splitting request_body_formatting(file.read()) on new
+        lines, without holding the whole file in memory.
+        """
+        with open(filename, 'r', buffering=READ_BUFFER_SIZE) as file:
+            metrics.count_bytes_read(os.fstat(file.fileno()).st_size)
+            # request_body_formatting leaves the body untouched once a line after
+            # the first timestamp starts with '[', which is always true for saved logs
+            head = []
+            seen_bracket = False
+            for line in file:
+                head.append(line)
+                if not seen_bracket:
+                    seen_bracket = ']' in line
+                elif line.startswith('['):
+                    break
+            else:
+                yield from LogManager.request_body_formatting(''.join(head)).split('\n')
+                return
+
+            for line in head:
+                yield line.rstrip('\n')
+            for line in file:
+                yield line.rstrip('\n')
+
+    @staticmethod
+    def read_stream_lines(stream, chunk_size: int = READ_BUFFER_SIZE) -> Iterator[str]:
+        """
+        Yield the lines of a binary stream (e.g. a request body) while it is
+        being read, so memory is bounded by the chunk and the longest line.
+        """
+        pending = b''
+        while True:
+            chunk = stream.read(chunk_size)
+            if not chunk:
+                break
+            lines = (pending + chunk).split(b'\n')
+            pending = lines.pop()
+            for line in lines:
+                yield line.decode('utf-8', errors='replace').rstrip('\r')
+        if pending:
+            yield pending.decode('utf-8', errors='replace').rstrip('\r')
+
+    def create_log_writer(self, rejected_lines: Optional[RejectedLines] = None) -> LogWriter:
+        return LogWriter(self, rejected_lines)
+
+    @staticmethod
+    def validate_log_entry(entry: str, rejected_lines: Optional[RejectedLines] = None) -> bool:
+        """
+        Validate a single log entry. The log entry must have this
+        structure -> "[2024-07-19 10:00:00] INFO: System started"
+        An invalid entry is added to rejected_lines, which reports it with
+        the others, or only logged at debug level without one.
+        """
+        if LogManager.tokenize_log_entry(entry) is None:
+            if rejected_lines is not None:
+                rejected_lines.add(entry)
+            else:
+                logging.debug(f"Log validation failed: {entry[:100]!r}")
             return False
+        return True
 
     @staticmethod
     def parse_log_content(valid_lines: List[str]) -> Dict[str, Any]:
@@ -92,45 +581,13 @@ class LogManager:
          2. gets average, highest, lowest MEASUREMENTS values;
          3. counts alarms and returns their timestamps.
         """
-        log_counts: Dict[str, int] = {'ERROR': 0, 'INFO': 0, 'MEASUREMENT': 0, 'WARNING': 0, 'DEBUG': 0}
-        measurements: Dict[str, List[float]] = {}
-        alarms: List[str] = []
-
-        for line in valid_lines:
-            timestamp, rest = line.split('] ', 1)
-            timestamp = timestamp[1:]
-            log_level, message = rest.split(': ', 1)
-            log_counts[log_level] += 1
-
-            if log_level == 'MEASUREMENT' and 'concentration' in message:
-                parts = message.split('concentration')
-                if len(parts) >= 2:
-                    gas_type = parts[0].strip()
-                    value_part = parts[1].split('-')[-1].strip()
-                    if is_numeric(value_part):
-                        gas_value = float(value_part)
-                        measurements.setdefault(gas_type, []).append(gas_value)
-                    else:
-                        logging.warning(f"Invalid measurement value: {message}")
-                else:
-                    logging.warning(f"Malformed measurement message: {message}")
-            elif log_level == 'WARNING' and 'alarm' in message.lower():
-                alarms.append(timestamp)
-
-        result = {
-            "log_message_count": log_counts,
-            "measurements": {},
-            "alarms": {
-                "count": len(alarms),
-                "timestamps": alarms
-            }
-        }
-
-        for gas, values in measurements.items():
-            result["measurements"][gas] = {
-                "average": sum(values) / len(values) if values else None,
-                "highest": max(values) if values else None,
-                "lowest": min(values) if values else None
-            }
+        return LogSummary().update_lines(valid_lines, RejectedLines()).to_dict()
 
-        return result
+    @staticmethod
+    def parse_log_records(records: Iterable[LogRecord], percentiles: bool = False) -> Dict[str, Any]:
+        """
+        Same as parse_log_content, but for lines that were already
+        tokenized by tokenize_log_entry. With percentiles set, every
+        measurement also gets its count, stddev and approximate p50/p95/p99.
+        """
+        return LogSummary().update(records).to_dict(percentiles)